@@ -0,0 +1,102 @@
+# Capture benchmark: takes pictures through cam.py's takePicture() with
+# the fake camera (see harness.py), saving to a scratch directory, and
+# reports shutter-to-return time per press, camera reconfigurations per
+# press (pipeline restarts, the main cost on real hardware; set
+# --restart to charge each one), the capture pipeline's stage times and
+# write throughput & latency per storage target.  Burst runs also report
+# the last burst's sustained capture & write rates and the frame where
+# the writer fell behind, if it did.
+#
+# Usage: python bench/capture.py [-n presses] [-b burst] [-z]
+#        [--restart sec] [--sync shot|batch|none] [--dir path]
+
+import argparse
+import os
+import sys
+import time
+
+import harness
+from harness import Stage
+
+def main():
+	p = argparse.ArgumentParser(description='Capture benchmark')
+	p.add_argument('-n', '--presses', type=int, default=20)
+	p.add_argument('-b', '--burst', type=int, default=0,
+	  help='frames per press (burst mode)')
+	p.add_argument('-z', '--zsl', action='store_true',
+	  help='pre-shutter mode')
+	p.add_argument('-m', '--mode', type=int, default=0, help='sizeMode')
+	p.add_argument('--restart', type=float, default=0.0,
+	  help='simulated camera restart time (sec)')
+	p.add_argument('--sync', choices=('shot', 'batch', 'none'),
+	  help='syncMode (default as in cam.py)')
+	p.add_argument('--dir',
+	  help='directory to save to, e.g. on slow media (default scratch)')
+	a = p.parse_args()
+
+	harness.PiCamera.restartDelay = a.restart
+	cam = harness.load(harness.frameSource([], (320, 240)))
+	try:
+	  run(cam, a)
+	finally:
+	  harness.unload(cam)
+
+def run(cam, a):
+	path = a.dir or os.path.join(cam.scratch, 'Photos')
+	cam.pathData[:] = [path] * len(cam.pathData)
+	if a.sync: cam.syncMode = a.sync
+	before = set(os.listdir(path)) if os.path.isdir(path) else set()
+	cam.sizeModeCallback(a.mode)
+	cam.setBurstCount(a.burst)
+	cam.setPreShutter(a.zsl)
+	cam.previewFrame() # Viewfinder running, as when shutter is tapped
+	if a.zsl: time.sleep(0.2) # Let pre-shutter buffer fill
+
+	camera = cam.camera
+	press  = Stage('press')
+	writes, reconfigs = camera.writes, camera.reconfigs
+	for i in range(a.presses):
+	  t = time.time()
+	  cam.takePicture()
+	  press.add(time.time() - t)
+	  press.endFrame(True)
+	  cam.previewFrame() # Main loop resumes viewfinder between presses
+	t = time.time()
+	cam.pipeline.drain()
+	drain = time.time() - t
+
+	print '%d presses, %s, sizeMode %d' % (a.presses,
+	  'pre-shutter' if a.zsl else
+	  'burst of %d' % a.burst if a.burst > 1 else 'single shot', a.mode)
+	harness.printStages((press,))
+	print 'Final drain %.1f ms, %d files written' % (drain * 1000.0,
+	  len(set(os.listdir(path)) - before))
+	print 'Camera: %.2f property writes, %.2f reconfigurations per press' % (
+	  float(camera.writes - writes) / a.presses,
+	  float(camera.reconfigs - reconfigs) / a.presses)
+	if a.burst > 1 and cam.lastBurst:
+	  b = cam.lastBurst.stats()
+	  print 'Last burst: %d frames, %.1f fps capture, %.1f fps written, ' \
+	    '%d dropped, %d stalls, %s' % (b['frames'], b['captureFps'],
+	    b['writeFps'], b['dropped'], b['stalls'],
+	    'writer behind from frame %d' % b['behindAt']
+	    if b['behindAt'] is not None else 'writer kept up')
+	stats = cam.pipeline.stats()
+	if stats:
+	  print
+	  print '%-14s %6s %9s %9s' % ('pipeline', 'count', 'mean ms', 'max')
+	  for k in sorted(stats):
+	    n, mean, most = stats[k]
+	    print '%-14s %6d %9.3f %9.3f' % (k, n, mean * 1000.0, most * 1000.0)
+	print
+	print 'Storage (syncMode %s)' % cam.syncMode
+	for p, s in sorted(cam.stores.items()):
+	  n, mean, most = s.latencyStats()
+	  print '%s: %d files, %.1f MB/s, %d syncs, %d stalls (%.1f ms)' % (
+	    p, s.files, s.throughput() / 1e6, s.syncs, s.stalls,
+	    s.stallTime * 1000.0)
+	  print '  latency (queued to in place) mean %.1f ms, max %.1f ms' % (
+	    mean * 1000.0, most * 1000.0)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,137 @@
+# YUV->RGB converter check & benchmark: compares every yuv2rgb variant
+# (convert, convert_parallel at several thread counts and formats,
+# convert_scaled with several crops & sizes) byte for byte against a
+# plain Python reference converter, then times each in frames/sec.
+# Frames are recorded YUV420 files (see harness.py) or synthetic.  The
+# check (untimed) is then repeated at odd, non-aligned frame sizes (-c),
+# where padding and chroma rounding are easiest to get wrong.
+#
+# Usage: python bench/convert.py [FILE...] [-s WxH] [-r repeat]
+#        [-t threads] [-c WxH,...]
+
+import argparse
+import sys
+import time
+
+import harness
+import yuv2rgb
+
+formats = (('RGB24' , yuv2rgb.RGB24 , 3), ('RGB565', yuv2rgb.RGB565, 2),
+           ('BGRA32', yuv2rgb.BGRA32, 4), ('GRAY'  , yuv2rgb.GRAY  , 1))
+
+def clamp(c):
+	return 255 if c > 255 else 0 if c < 0 else c
+
+# Reference converter, same integer math as the original convert().
+# Converts the (x, y, w, h) crop of the srcW x srcH frame (padded layout)
+# to dstW x dstH pixels, nearest neighbor sampled at the center of each
+# output pixel's footprint.  Output is tightly packed in format fmt.
+def reference(yuv, src, crop, dst, fmt):
+	sw, sh = harness.padded(*src)
+	uOff   = sw * sh
+	vOff   = uOff + uOff / 4
+	out    = bytearray()
+	xs     = [crop[0] + ((2 * i + 1) * crop[2]) / (2 * dst[0])
+	          for i in range(dst[0])]
+	for j in range(dst[1]):
+	  sy = crop[1] + ((2 * j + 1) * crop[3]) / (2 * dst[1])
+	  for sx in xs:
+	    y = yuv[sy * sw + sx]
+	    if fmt == yuv2rgb.GRAY:
+	      out.append(y)
+	      continue
+	    c = (sy / 2) * (sw / 2) + sx / 2
+	    u = yuv[uOff + c] - 128
+	    v = yuv[vOff + c] - 128
+	    r = clamp(y +  ((359 * v)             >> 8))
+	    g = clamp(y - (((183 * v) + (88 * u)) >> 8))
+	    b = clamp(y +  ((454 * u)             >> 8))
+	    if fmt == yuv2rgb.RGB24:
+	      out.extend((r, g, b))
+	    elif fmt == yuv2rgb.RGB565:
+	      p = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+	      out.extend((p & 255, p >> 8))
+	    else:
+	      out.extend((b, g, r, 255))
+	return out
+
+# Variants as (name, function(yuv, out), expected output)
+def variants(yuv, size, threads):
+	w, h   = size
+	pw, ph = harness.padded(w, h)
+	full   = (0, 0, w, h)
+	v      = []
+	# Original and parallel RGB24 write the padded frame
+	ref = reference(yuv, size, (0, 0, pw, ph), (pw, ph), yuv2rgb.RGB24)
+	v.append(('convert', lambda o: yuv2rgb.convert(yuv, o, w, h), ref))
+	for n in threads:
+	  v.append(('parallel RGB24 x%d' % n, lambda o, n=n:
+	    yuv2rgb.convert_parallel(yuv, o, w, h, n), ref))
+	for name, fmt, bpp in formats[1:]:
+	  ref = reference(yuv, size, full, size, fmt)
+	  for n in threads:
+	    v.append(('parallel %s x%d' % (name, n), lambda o, n=n, fmt=fmt:
+	      yuv2rgb.convert_parallel(yuv, o, w, h, n, fmt), ref))
+	# Scaled: viewfinder sizes & crop windows as in cam.py sizeData
+	for crop, dst in (((0.0, 0.0, 1.0, 1.0), (320, 240)),
+	                  ((0.1296, 0.2222, 0.7408, 0.5556), (320, 180)),
+	                  ((0.2222, 0.2222, 0.5556, 0.5556), (320, 240)),
+	                  ((0.0, 0.0, 1.0, 1.0), (w / 2, h / 2))):
+	  c = (int(crop[0] * w), int(crop[1] * h),
+	       max(1, int(crop[2] * w)), max(1, int(crop[3] * h)))
+	  for name, fmt, bpp in formats:
+	    v.append(('scaled %s %dx%d' % (name, dst[0], dst[1]),
+	      lambda o, c=c, dst=dst, fmt=fmt:
+	        yuv2rgb.convert_scaled(yuv, o, size, c, dst, 0, 0, fmt),
+	      reference(yuv, size, c, dst, fmt)))
+	return v
+
+def main():
+	p = argparse.ArgumentParser(description='yuv2rgb check & benchmark')
+	p.add_argument('files', nargs='*', help='raw YUV420 frame files')
+	p.add_argument('-s', '--size', default='320x240',
+	  help='frame size, WxH (default 320x240)')
+	p.add_argument('-r', '--repeat', type=int, default=200,
+	  help='conversions timed per variant')
+	p.add_argument('-t', '--threads', default='1,2,4',
+	  help='thread counts for parallel variants')
+	p.add_argument('-c', '--check', default='317x203,33x17',
+	  help='extra frame sizes to check, not timed (\'\' for none)')
+	a = p.parse_args()
+
+	size    = tuple(int(x) for x in a.size.split('x'))
+	threads = [int(x) for x in a.threads.split(',')]
+	source  = harness.frameSource(a.files, size)
+	yuv     = source.frames(size)[0]
+	failed  = 0
+
+	print 'Frame %dx%d, %d conversions per variant' % (size + (a.repeat,))
+	print '%-28s %6s %10s %9s' % ('variant', 'check', 'frames/sec', 'ms')
+	for name, fn, ref in variants(yuv, size, threads):
+	  out = bytearray(len(ref))
+	  fn(out)
+	  ok  = out == ref
+	  if not ok: failed += 1
+	  t = time.time()
+	  for i in range(a.repeat): fn(out)
+	  t = time.time() - t
+	  print '%-28s %6s %10.1f %9.3f' % (name, 'ok' if ok else 'FAIL',
+	    a.repeat / t, t * 1000.0 / a.repeat)
+
+	for check in [c for c in a.check.split(',') if c]:
+	  size = tuple(int(x) for x in check.split('x'))
+	  bad  = []
+	  v    = variants(source.frames(size)[0], size, threads)
+	  for name, fn, ref in v:
+	    out = bytearray(len(ref))
+	    fn(out)
+	    if out != ref: bad.append(name)
+	  failed += len(bad)
+	  print
+	  print 'Frame %dx%d: %d variants, %s' % (size + (len(v),
+	    'FAIL: ' + ', '.join(bad) if bad else 'all ok'))
+	if failed: print '%d variant(s) differ from reference' % failed
+	return 1 if failed else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
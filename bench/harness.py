@@ -0,0 +1,349 @@
+# Benchmark harness: runs cam.py on a plain Linux box, no Pi, PiTFT or
+# root required.  A fake picamera module replays recorded YUV frames
+# (or synthetic ones) and SDL uses its dummy (headless) video driver.
+# cam.py is loaded as a module up to its main loop, so benchmarks can
+# wrap functions and objects before running the real main loop with
+# mainLoop(), which ends (raising Done) after a given number of frames.
+#
+# Frame files are raw YUV420 (I420) as the camera's video port delivers
+# them: width padded to a multiple of 32, height to 16, frames back to
+# back.  Frames are resampled (nearest neighbor, once per size) to
+# whatever size cam.py asks the fake camera for.
+#
+# The yuv2rgb module must be built for this machine first (make).
+
+import array
+import ctypes
+import gc
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+benchPath = os.path.dirname(os.path.abspath(__file__))
+repoPath  = os.path.dirname(benchPath)
+sys.path.insert(0, repoPath)
+
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+import pygame
+
+
+# Frame sources ------------------------------------------------------------
+
+def padded(w, h):
+	return (w + 31) & ~31, (h + 15) & ~15
+
+def frameBytes(w, h):
+	pw, ph = padded(w, h)
+	return pw * ph * 3 / 2
+
+# Read all complete w x h frames from a raw YUV420 file, as bytearrays
+def readFrames(path, w, h):
+	n      = frameBytes(w, h)
+	frames = []
+	with open(path, 'rb') as f:
+	  while True:
+	    b = f.read(n)
+	    if len(b) < n: break
+	    frames.append(bytearray(b))
+	return frames
+
+# Make n w x h frames of a moving test pattern (luma ramps, chroma bars)
+def syntheticFrames(w, h, n=30):
+	pw, ph = padded(w, h)
+	frames = []
+	for i in range(n):
+	  f = bytearray(pw * ph * 3 / 2)
+	  for y in range(h):
+	    f[y * pw:y * pw + w] = bytearray(
+	      (x + y + i * 8) & 255 for x in range(w))
+	  cw, ch = pw / 2, ph / 2
+	  u      = bytearray((x * 255 / cw) for x in range(cw)) * ch
+	  v      = bytearray(((x + i * 4) & 255) for x in range(cw)) * ch
+	  f[pw * ph:pw * ph + cw * ch] = u
+	  f[pw * ph + cw * ch:]        = v
+	  frames.append(f)
+	return frames
+
+# Nearest-neighbor resample of a planar YUV420 frame (padded layout)
+def resample(frame, src, dst):
+	spw, sph = padded(*src)
+	dpw, dph = padded(*dst)
+	out      = bytearray(dpw * dph * 3 / 2)
+	planes   = ((0, 0, spw, dpw, dst[0], dst[1], 1),
+	            (spw * sph, dpw * dph, spw / 2, dpw / 2,
+	             (dst[0] + 1) / 2, (dst[1] + 1) / 2, 2),
+	            (spw * sph * 5 / 4, dpw * dph * 5 / 4, spw / 2, dpw / 2,
+	             (dst[0] + 1) / 2, (dst[1] + 1) / 2, 2))
+	for sOff, dOff, sStride, dStride, w, h, sub in planes:
+	  xs = [(x * sub * src[0] / dst[0]) / sub for x in range(w)]
+	  for y in range(h):
+	    row = sOff + ((y * sub * src[1] / dst[1]) / sub) * sStride
+	    d   = dOff + y * dStride
+	    out[d:d + w] = bytearray(frame[row + x] for x in xs)
+	return out
+
+# Recorded (or synthetic) frames, resampled on demand per size
+class FrameSource:
+
+	def __init__(self, frames, size):
+	  self.size  = size
+	  self.sizes = { size : frames }
+
+	def frames(self, size):
+	  f = self.sizes.get(size)
+	  if f is None:
+	    f = self.sizes[size] = [resample(x, self.size, size)
+	      for x in self.sizes[self.size]]
+	  return f
+
+def frameSource(files, size):
+	frames = []
+	for path in files: frames.extend(readFrames(path, size[0], size[1]))
+	if files and not frames:
+	  raise ValueError('No complete %dx%d frames in input' % size)
+	return FrameSource(frames or syntheticFrames(*size), size)
+
+
+# Fake picamera ------------------------------------------------------------
+
+# Stands in for picamera.PiCamera.  Property writes are counted, and
+# changes of resolution or framerate (which restart the camera pipeline
+# on real hardware) are counted as reconfigurations, optionally costing
+# 'restartDelay' seconds.  capture_continuous() plays back the frame
+# source ('raw'/'yuv') or emits a fixed JPEG per frame ('jpeg'), paced
+# to the framerate if 'realtime' is set, otherwise as fast as consumed.
+# capture() takes 'stillDelay' seconds (exposure & readout), default 0,
+# and writes a JPEG, or ('raw'/'yuv') the next frame of the source, as
+# cam.py's original viewfinder loop captured on the video port.
+
+class PiCamera(object):
+
+	source       = None  # FrameSource, set by install()
+	realtime     = False
+	restartDelay = 0.0
+	stillDelay   = 0.0
+	properties   = ('resolution', 'framerate', 'crop', 'ISO',
+	                'image_effect', 'sensor_mode')
+	restart      = ('resolution', 'framerate', 'sensor_mode')
+
+	def __init__(self):
+	  object.__setattr__(self, 'values', { 'resolution'  : (1280, 720),
+	    'framerate' : 30, 'crop' : (0.0, 0.0, 1.0, 1.0), 'ISO' : 0,
+	    'image_effect' : 'none', 'sensor_mode' : 0 })
+	  object.__setattr__(self, 'writes'   , 0)
+	  object.__setattr__(self, 'reconfigs', 0)
+	  object.__setattr__(self, 'frames'   , 0)
+	  object.__setattr__(self, 'stills'   , 0)
+
+	def __getattr__(self, name):
+	  if name in PiCamera.properties: return self.values[name]
+	  raise AttributeError(name)
+
+	def __setattr__(self, name, value):
+	  if name not in PiCamera.properties:
+	    object.__setattr__(self, name, value)
+	    return
+	  self.writes += 1
+	  if name in PiCamera.restart and self.values[name] != value:
+	    self.reconfigs += 1
+	    if self.restartDelay: time.sleep(self.restartDelay)
+	  self.values[name] = value
+
+	def capture_continuous(self, output, format='jpeg',
+	  use_video_port=False, resize=None, splitter_port=0, **kwargs):
+	  size = tuple(resize or self.values['resolution'])
+	  if format in ('raw', 'yuv'):
+	    frames = self.source.frames(size)
+	  else:
+	    frames = [jpeg(size)]
+	  period = 1.0 / self.values['framerate']
+	  t      = time.time()
+	  i      = 0
+	  while True:
+	    if self.realtime:
+	      t += period
+	      d  = t - time.time()
+	      if d > 0: time.sleep(d)
+	    output.write(frames[i % len(frames)])
+	    if hasattr(output, 'flush'): output.flush()
+	    self.frames += 1
+	    i           += 1
+	    yield output
+
+	def capture(self, output, format='jpeg', use_video_port=False,
+	  resize=None, **kwargs):
+	  if self.stillDelay: time.sleep(self.stillDelay)
+	  size = tuple(resize or self.values['resolution'])
+	  if format in ('raw', 'yuv'):
+	    frames = self.source.frames(size)
+	    output.write(frames[self.stills % len(frames)])
+	  else:
+	    output.write(jpeg(size))
+	  self.stills += 1
+
+	def close(self):
+	  pass
+
+jpegs = {}
+
+# A JPEG of the given size (gray), made once per size
+def jpeg(size):
+	data = jpegs.get(size)
+	if data is None:
+	  d, path = tempfile.mkstemp('.jpg')
+	  os.close(d)
+	  try:
+	    s = pygame.Surface(size, 0, 24)
+	    s.fill((128, 128, 128))
+	    pygame.image.save(s, path)
+	    with open(path, 'rb') as f: data = jpegs[size] = f.read()
+	  finally:
+	    os.remove(path)
+	return data
+
+# Install the fake picamera module (once), with the given frame source
+def install(source):
+	m = sys.modules.get('picamera')
+	if m is None or not hasattr(m, 'fake'):
+	  m          = imp.new_module('picamera')
+	  m.fake     = True
+	  m.PiCamera = PiCamera
+	  sys.modules['picamera'] = m
+	PiCamera.source = source
+	return m
+
+
+# Loading cam.py -----------------------------------------------------------
+
+class Done(Exception):
+	pass
+
+# Load cam.py as module 'cam', running everything up to the main loop.
+# Runs in a scratch directory (returned as cam.scratch) holding a link to
+# the icons, so settings, icon atlas, upload journal etc. don't touch the
+# working tree.  depth sets the dummy display's bits per pixel (PiTFT is
+# 16).  The screen is 320x240 as on the PiTFT.
+def load(source, depth=16):
+	install(source)
+	scratch = tempfile.mkdtemp(prefix='picam-bench-')
+	os.symlink(os.path.join(repoPath, 'icons'),
+	  os.path.join(scratch, 'icons'))
+
+	src   = open(os.path.join(repoPath, 'cam.py')).read()
+	split = src.index('\n# Main loop ---')
+	cam   = imp.new_module('cam')
+	cam.__file__ = os.path.join(repoPath, 'cam.py')
+	cam.scratch  = scratch
+	# Main loop compiled separately, padded to keep line numbers right
+	cam.mainCode = compile('\n' * src[:split].count('\n') + src[split:],
+	  cam.__file__, 'exec')
+
+	putenv  = os.putenv
+	setMode = pygame.display.set_mode
+	cwd     = os.getcwd()
+	# cam.py selects the PiTFT framebuffer & touchscreen; keep dummy SDL
+	os.putenv = lambda k, v: None if k.startswith('SDL_') else putenv(k, v)
+	pygame.display.set_mode = lambda size, flags=0, d=0: setMode(
+	  (320, 240), 0, depth)
+	os.chdir(scratch)
+	try:
+	  exec compile(src[:split], cam.__file__, 'exec') in cam.__dict__
+	finally:
+	  os.putenv               = putenv
+	  pygame.display.set_mode = setMode
+	sys.modules['cam'] = cam
+	return cam
+
+def unload(cam):
+	cam.previewStop() # Ends pre-shutter thread, if running
+	os.chdir(repoPath)
+	shutil.rmtree(cam.scratch, True)
+
+# Run cam.py's main loop (in its scratch directory) until Done is raised
+# (e.g. by a wrapped function after n frames)
+def mainLoop(cam):
+	os.chdir(cam.scratch)
+	try:
+	  exec cam.mainCode in cam.__dict__
+	except Done:
+	  pass
+
+
+# Measurement --------------------------------------------------------------
+
+# Accumulates per-frame times (sec) for one stage
+class Stage:
+
+	def __init__(self, name):
+	  self.name  = name
+	  self.times = array.array('d') # Not floats, so none are kept alive
+	  self.t     = 0.0 # Time within current frame
+
+	def add(self, t):
+	  self.t += t
+
+	def endFrame(self, keep):
+	  if keep: self.times.append(self.t)
+	  self.t = 0.0
+
+	# (mean, median, 95th percentile, max) in milliseconds
+	def stats(self):
+	  if not self.times: return (0.0, 0.0, 0.0, 0.0)
+	  s = sorted(self.times)
+	  n = len(s)
+	  return (sum(s) * 1000.0 / n, s[n / 2] * 1000.0,
+	    s[min(n - 1, int(n * 0.95))] * 1000.0, s[-1] * 1000.0)
+
+# Wrap callable fn so time spent in it is added to stage
+def timed(stage, fn):
+	def wrapper(*args, **kwargs):
+	  t = time.time()
+	  try:
+	    return fn(*args, **kwargs)
+	  finally:
+	    stage.add(time.time() - t)
+	return wrapper
+
+# Count calls to fn in counter[key]
+def counted(counter, key, fn):
+	def wrapper(*args, **kwargs):
+	  counter[key] = counter.get(key, 0) + 1
+	  return fn(*args, **kwargs)
+	return wrapper
+
+def printStages(stages, title='stage'):
+	print '%-10s %9s %9s %9s %9s' % (title, 'mean ms', 'median',
+	  '95%', 'max')
+	for s in stages:
+	  print '%-10s %9.3f %9.3f %9.3f %9.3f' % ((s.name,) + s.stats())
+
+# Net GC-tracked (container) objects allocated; with the collector
+# disabled, the difference between two readings is objects created and
+# not yet freed in between
+def liveObjects():
+	return gc.get_count()[0]
+
+class mallinfo(ctypes.Structure):
+	_fields_ = [(name, ctypes.c_size_t) for name in ('arena', 'ordblks',
+	  'smblks', 'hblks', 'hblkhd', 'usmblks', 'fsmblks', 'uordblks',
+	  'fordblks', 'keepcost')]
+
+try:
+  libc = ctypes.CDLL(None)
+  libc.mallinfo2.restype = mallinfo
+except (OSError, AttributeError):
+  libc = None
+
+# Bytes of C heap in use (glibc mallinfo2(): malloc'ed plus mmap'ed
+# blocks), or None if unavailable.  Buffers, strings & Surface pixels
+# too large for Python's small-object allocator come from here, so the
+# difference between two readings is such memory allocated and not yet
+# freed in between.
+def heapBytes():
+	if libc is None: return None
+	m = libc.mallinfo2()
+	return m.uordblks + m.hblkhd
@@ -0,0 +1,190 @@
+# Headless capture benchmark: runs cam.py's headless main loop (fake
+# camera, see harness.py) and scripts shots over the control socket, as
+# a fleet or test script would.  Each client keeps up to 'window' shoot
+# requests outstanding (pipelined; 1 = wait for each reply), and the
+# sustained rate is reported as captures/minute, counted from the first
+# request until every photo is on disk, along with request latency
+# (sent to reply) and what the controller & storage saw.  A few other
+# requests (set, get, a bad one) are checked first.
+#
+# Usage: python bench/headless.py [-n shots] [-c clients] [-w window]
+#        [-b burst] [--exposure sec] [--sync shot|batch|none] [--dir path]
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import harness
+from harness import Done
+
+# Control socket client, one request & reply at a time
+class Connection:
+
+	def __init__(self, path):
+	  self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	  self.sock.connect(path)
+	  self.file = self.sock.makefile('rb')
+
+	def send(self, line):
+	  self.sock.sendall(line + '\n')
+
+	def reply(self):
+	  return json.loads(self.file.readline())
+
+	def request(self, line):
+	  self.send(line)
+	  return self.reply()
+
+	def close(self):
+	  self.file.close()
+	  self.sock.close()
+
+# Sends n shoot requests, at most window unanswered at any time
+class Client(threading.Thread):
+
+	def __init__(self, path, n, window):
+	  threading.Thread.__init__(self)
+	  self.daemon  = True
+	  self.conn    = Connection(path)
+	  self.n       = n
+	  self.slots   = threading.Semaphore(window)
+	  self.sent    = []  # Send time of each request
+	  self.latency = []  # Sent to reply (sec)
+	  self.files   = 0
+	  self.errors  = []
+	  self.start()
+
+	def run(self):
+	  r = threading.Thread(target=self.reader)
+	  r.daemon = True
+	  r.start()
+	  for i in range(self.n):
+	    self.slots.acquire()
+	    self.sent.append(time.time())
+	    self.conn.send('shoot')
+	  r.join()
+	  self.conn.close()
+
+	def reader(self):
+	  for i in range(self.n):
+	    reply = self.conn.reply()
+	    self.latency.append(time.time() - self.sent[i])
+	    self.slots.release()
+	    if 'ok' in reply: self.files += len(reply['ok'])
+	    else:             self.errors.append(reply['error'])
+
+def check(conn):
+	for line, test in (
+	  ('set fx 3' , lambda r: r['ok']['fx'] == 3),
+	  ('set fx 0' , lambda r: r['ok']['fx'] == 0),
+	  ('set iso 99', lambda r: 'error' in r),
+	  ('get'      , lambda r: 'size' in r['ok']),
+	  ('bogus'    , lambda r: 'error' in r)):
+	  r = conn.request(line)
+	  print '%-12s %-5s %s' % (line, 'ok' if test(r) else 'FAIL',
+	    json.dumps(r)[:60])
+
+def percentile(values, p):
+	v = sorted(values)
+	return v[min(len(v) - 1, int(len(v) * p))]
+
+def main():
+	p = argparse.ArgumentParser(description='Headless capture benchmark')
+	p.add_argument('-n', '--shots', type=int, default=1000,
+	  help='shoot requests per client')
+	p.add_argument('-c', '--clients', type=int, default=1)
+	p.add_argument('-w', '--window', type=int, default=8,
+	  help='requests outstanding per client (1 = no pipelining)')
+	p.add_argument('-b', '--burst', type=int, default=0,
+	  help='frames per shoot request (burst mode)')
+	p.add_argument('--exposure', type=float, default=0.0,
+	  help='simulated still capture time (sec)')
+	p.add_argument('--sync', choices=('shot', 'batch', 'none'),
+	  help='syncMode (default as in cam.py)')
+	p.add_argument('--dir',
+	  help='directory to save to, e.g. on slow media (default scratch)')
+	a = p.parse_args()
+
+	harness.PiCamera.stillDelay = a.exposure
+	cam = harness.load(harness.frameSource([], (320, 240)))
+	try:
+	  run(cam, a)
+	finally:
+	  harness.unload(cam)
+
+def run(cam, a):
+	path = a.dir or os.path.join(cam.scratch, 'Photos')
+	cam.pathData[:] = [path] * len(cam.pathData)
+	if a.sync: cam.syncMode = a.sync
+	before = set(os.listdir(path)) if os.path.isdir(path) else set()
+	cam.setBurstCount(a.burst)
+	cam.headless = True
+	sock = os.path.join(cam.scratch, 'cam.sock')
+	cam.control.serve(sock)
+	result = {}
+	done   = threading.Event()
+
+	poll = cam.control.poll
+	def stoppable(block=False):
+	  if done.is_set(): raise Done
+	  return poll(block)
+	cam.control.poll = stoppable
+
+	def controller():
+	  try:
+	    conn = Connection(sock)
+	    check(conn)
+	    t       = time.time()
+	    clients = [Client(sock, a.shots, a.window) for i in range(a.clients)]
+	    for c in clients: c.join()
+	    result['replied'] = time.time() - t
+	    conn.request('drain')
+	    result['elapsed'] = time.time() - t
+	    result['stats']   = conn.request('stats')['ok']
+	    result['clients'] = clients
+	    conn.close()
+	  finally:
+	    done.set()
+	    cam.control.wake()
+
+	t = threading.Thread(target=controller)
+	t.daemon = True
+	t.start()
+	harness.mainLoop(cam)
+	t.join()
+	cam.control.close()
+	if 'clients' not in result: return 1
+
+	clients = result['clients']
+	files   = sum(c.files for c in clients)
+	latency = [l for c in clients for l in c.latency]
+	errors  = [e for c in clients for e in c.errors]
+	stats   = result['stats']
+	print
+	print '%d client(s) x %d shoot requests, window %d, %s' % (a.clients,
+	  a.shots, a.window,
+	  'burst of %d' % a.burst if a.burst > 1 else 'single shot')
+	print '%d files reported, %d on disk, %d errors%s' % (files,
+	  len(set(os.listdir(path)) - before), len(errors),
+	  ' (%s)' % errors[0] if errors else '')
+	print 'Sustained: %.0f captures/minute (all replied in %.2f s, ' \
+	  'on disk in %.2f s)' % (files * 60.0 / result['elapsed'],
+	  result['replied'], result['elapsed'])
+	print 'Request latency: mean %.1f ms, 95%% %.1f ms, max %.1f ms' % (
+	  sum(latency) * 1000.0 / len(latency),
+	  percentile(latency, 0.95) * 1000.0, max(latency) * 1000.0)
+	print 'Controller: %d requests, %d errors, %.0f shots/minute' % (
+	  stats['requests'], stats['errors'], stats['perMinute'])
+	for p, s in sorted(stats['storage'].items()):
+	  print 'Storage %s: %d files, %.1f MB, %d failures' % (p, s['files'],
+	  s['bytes'] / 1e6, s['failures'])
+	  print '  %.1f MB/s, latency (queued to in place) mean %.1f ms, ' \
+	    'max %.1f ms' % (s['throughput'] / 1e6, s['latency'][1] * 1000.0,
+	    s['latency'][2] * 1000.0)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,145 @@
+# Live view benchmark: runs cam.py's main loop (fake camera paced at its
+# frame rate, see harness.py) with the live view HTTP server on
+# localhost, and connects 0, 1, 2, 4... MJPEG clients in turn.  For each
+# step it reports viewfinder frames/sec (should not drop as clients are
+# added), frames/sec received by each client, frames dropped for slow
+# clients and process CPU use, from which the cost per extra client
+# follows.  A snapshot request is checked too.  With --slow, one extra
+# client reads only one frame per second, to show it's dropped frames
+# rather than holding up the others.
+#
+# Usage: python bench/live.py [-c 0,1,2,4] [-t seconds] [--slow]
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+import harness
+from harness import Done
+
+# MJPEG client: counts frames received until stop is set
+class Client(threading.Thread):
+
+	def __init__(self, port, stop, delay=0.0):
+	  threading.Thread.__init__(self)
+	  self.daemon = True
+	  self.port   = port
+	  self.stop   = stop
+	  self.delay  = delay # Seconds to sleep per frame (slow client)
+	  self.frames = 0
+	  self.start()
+
+	def run(self):
+	  s = socket.create_connection(('127.0.0.1', self.port))
+	  s.sendall('GET /stream.mjpg HTTP/1.0\r\n\r\n')
+	  f = s.makefile('rb')
+	  while f.readline().strip(): pass # Response headers
+	  while not self.stop.is_set():
+	    length = 0
+	    line   = f.readline() # Boundary
+	    if not line: break
+	    while True:
+	      line = f.readline().strip()
+	      if not line: break
+	      if line.lower().startswith('content-length:'):
+	        length = int(line.split(':')[1])
+	    data = f.read(length)
+	    f.readline()
+	    if not data.startswith('\xff\xd8'): raise ValueError('Bad frame')
+	    self.frames += 1
+	    if self.delay: time.sleep(self.delay)
+	  s.close()
+
+def snapshot(port):
+	s = socket.create_connection(('127.0.0.1', port))
+	s.sendall('GET /snapshot.jpg HTTP/1.0\r\n\r\n')
+	data = ''
+	while True:
+	  b = s.recv(65536)
+	  if not b: break
+	  data += b
+	s.close()
+	head, body = data.split('\r\n\r\n', 1)
+	return head.split('\r\n')[0], body
+
+def cpuTime():
+	return sum(os.times()[0:2])
+
+def main():
+	p = argparse.ArgumentParser(description='Live view benchmark')
+	p.add_argument('-c', '--clients', default='0,1,2,4',
+	  help='client counts to step through')
+	p.add_argument('-t', '--time', type=float, default=5.0,
+	  help='seconds per step')
+	p.add_argument('--slow', action='store_true',
+	  help='add a client reading 1 frame/sec to each step')
+	a = p.parse_args()
+
+	harness.PiCamera.realtime = True
+	cam = harness.load(harness.frameSource([], (320, 240)))
+	try:
+	  run(cam, a)
+	finally:
+	  harness.unload(cam)
+
+def run(cam, a):
+	cam.liveView.serve(0, '127.0.0.1')
+	port    = cam.liveView.server.server_address[1]
+	steps   = [int(x) for x in a.clients.split(',')]
+	frames  = [0]
+	results = []
+	done    = threading.Event()
+
+	previewFrame = cam.previewFrame
+	def frame():
+	  if done.is_set(): raise Done
+	  previewFrame()
+	  frames[0] += 1
+	cam.previewFrame = frame
+
+	def controller():
+	  try:
+	    time.sleep(1.0) # Viewfinder warmup
+	    status, body = snapshot(port)
+	    print 'Snapshot: %s, %d bytes%s' % (status, len(body),
+	      '' if body.startswith('\xff\xd8') else ' (NOT JPEG)')
+	    for n in steps:
+	      stop    = threading.Event()
+	      clients = [Client(port, stop) for i in range(n)]
+	      if a.slow: clients.append(Client(port, stop, 1.0))
+	      time.sleep(0.5) # Let capture start
+	      f0, c0, t0 = frames[0], cpuTime(), time.time()
+	      r0         = [c.frames for c in clients]
+	      time.sleep(a.time)
+	      t = time.time() - t0
+	      fps   = [(c.frames - r) / t for c, r in zip(clients, r0)]
+	      stats = cam.liveView.clientStats()
+	      stop.set()
+	      results.append((n, (frames[0] - f0) / t, (cpuTime() - c0) / t,
+	        fps, sum(s[3] for s in stats)))
+	      time.sleep(0.5) # Clients disconnect; capture stops
+	  finally:
+	    done.set()
+
+	t = threading.Thread(target=controller)
+	t.daemon = True
+	t.start()
+	harness.mainLoop(cam)
+	t.join()
+
+	print
+	print '%-8s %8s %8s %s' % ('clients', 'vf fps', 'CPU %', 'client fps')
+	for n, vf, cpu, fps, dropped in results:
+	  print '%-8d %8.1f %8.1f %s%s' % (n, vf, cpu * 100.0,
+	    ' '.join('%.1f' % f for f in fps),
+	    '  (%d dropped)' % dropped if dropped else '')
+	if len(results) > 1 and results[-1][0] > results[0][0]:
+	  n0, n1 = results[0][0], results[-1][0]
+	  print 'CPU per extra client: %.2f%%' % (
+	    (results[-1][2] - results[0][2]) * 100.0 / (n1 - n0))
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,130 @@
+# Motion trigger check & benchmark: runs viewfinder frames through
+# cam.py's MotionTrigger (hold time 0, so every triggering frame shows)
+# and checks which frames trigger, then times yuv2rgb.luma_motion()
+# alone (frames/sec).  Runs cam.py via harness.py.
+#
+# Without files, a synthetic scene is checked (-s sets its size): a
+# still test pattern with global brightness flicker below threshold,
+# which must never trigger; on frame 'small' an object under the area
+# limit, for that frame only, which mustn't trigger either; from frame
+# 'enter' on, an object over the area limit, which must trigger on that
+# frame, and stop triggering once the background has adapted to it.
+#
+# Frame files are raw YUV420 (I420) as the camera's video port delivers
+# them (see harness.py), e.g. on the Pi:
+#   raspiyuv -w 320 -h 240 -tl 100 -t 10000 -o - > frames.yuv
+# or capture_continuous(..., format='yuv', use_video_port=True).  With
+# --expect, the triggering frames must be exactly those listed.
+#
+# Usage: python bench/motion.py [FILE...] [-s WxH] [-f factor]
+#        [-t threshold] [-a area] [--settle n] [-r repeat]
+#        [--expect i,j,...]
+
+import argparse
+import sys
+import time
+
+import harness
+import yuv2rgb
+
+small = 15 # Synthetic scene: frame with the small object
+enter = 25 # Synthetic scene: frame the large object appears
+count = 80 # Synthetic scene: frames in all
+
+# Set the Y plane of frame (padded layout) to the test pattern inverted
+# (128 levels off) within rect, so it differs from the still pattern
+def paint(frame, size, rect):
+	pw, ph = harness.padded(*size)
+	x, y, w, h = rect
+	for row in range(y, y + h):
+	  i = row * pw + x
+	  frame[i:i + w] = bytearray((c + 128) & 255 for c in frame[i:i + w])
+
+# Synthetic scene as described above; the objects cover area / 4 and
+# area * 4 of the frame
+def scene(size, area):
+	pw, ph  = harness.padded(*size)
+	still   = harness.syntheticFrames(size[0], size[1], 1)[0]
+	frames  = []
+	for i in range(count):
+	  f = bytearray(still)
+	  d = (-4, 0, 4)[i % 3] # Flicker, well under threshold
+	  f[:pw * ph] = f[:pw * ph].translate(
+	    bytearray(min(255, max(0, c + d)) for c in range(256)))
+	  for first, last, a in ((small, small, area / 4),
+	                         (enter, count, area * 4)):
+	    if first <= i <= last:
+	      w = int(size[0] * a ** 0.5)
+	      h = int(size[1] * a ** 0.5)
+	      paint(f, size, ((size[0] - w) / 2, (size[1] - h) / 2, w, h))
+	  frames.append(f)
+	return frames
+
+def main():
+	p = argparse.ArgumentParser(description='Motion trigger check & benchmark')
+	p.add_argument('files', nargs='*', help='raw YUV420 frame files')
+	p.add_argument('-s', '--size', default='320x240',
+	  help='frame size, WxH (default 320x240)')
+	p.add_argument('-f', '--factor'   , type=int  , default=8)
+	p.add_argument('-t', '--threshold', type=int  , default=24)
+	p.add_argument('-a', '--area'     , type=float, default=0.02)
+	p.add_argument(      '--settle'   , type=int  , default=5)
+	p.add_argument('-r', '--repeat'   , type=int  , default=10,
+	  help='passes over the frames for timing')
+	p.add_argument('--expect',
+	  help='frames that must trigger (recorded files), e.g. 12,13,40')
+	a = p.parse_args()
+
+	size   = tuple(int(x) for x in a.size.split('x'))
+	frames = []
+	for path in a.files: frames.extend(harness.readFrames(path, *size))
+	if a.files and not frames:
+	  print 'No complete %dx%d frames in input' % size
+	  return 1
+
+	cam = harness.load(harness.frameSource([], (320, 240)))
+	try:
+	  return run(cam, a, size, frames or scene(size, a.area))
+	finally:
+	  harness.unload(cam)
+
+def run(cam, a, size, frames):
+	# Detection pass (fresh background, as when the viewfinder starts)
+	motion = cam.MotionTrigger(a.factor, a.threshold, a.area,
+	  settle=a.settle, hold=0.0)
+	fired  = [i for i, yuv in enumerate(frames) if motion.update(yuv, size)]
+
+	# Timing passes
+	bg = bytearray(motion.bg)
+	t  = time.time()
+	for r in range(a.repeat):
+	  for yuv in frames:
+	    yuv2rgb.luma_motion(yuv, bg, size, a.factor, a.threshold)
+	t = time.time() - t
+
+	print '%d frames %dx%d%s, %d cells, trigger above %d changed' % (
+	  len(frames), size[0], size[1], '' if a.files else ' (synthetic)',
+	  motion.cells[2] * motion.cells[3], motion.limit)
+	print 'Triggering frames: %s' % (', '.join(map(str, fired)) or 'none')
+	print '%.1f frames/sec (%.3f ms/frame)' % (
+	  len(frames) * a.repeat / t, t * 1000.0 / (len(frames) * a.repeat))
+
+	if a.expect is not None:
+	  want = [int(i) for i in a.expect.split(',') if i]
+	  ok   = fired == want
+	  print 'Expected %s: %s' % (', '.join(map(str, want)) or 'none',
+	    'ok' if ok else 'FAIL')
+	elif not a.files:
+	  checks = (
+	    ('quiet before object', not [i for i in fired if i < enter]),
+	    ('triggers on entry'  , enter in fired),
+	    ('adapts to object'   , not [i for i in fired if i >= count - 5]))
+	  for name, passed in checks:
+	    print '%-20s %s' % (name, 'ok' if passed else 'FAIL')
+	  ok = all(passed for name, passed in checks)
+	else:
+	  ok = True
+	return 0 if ok else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,206 @@
+# Viewfinder benchmark: runs cam.py's real main loop on recorded (or
+# synthetic) YUV frames through the fake camera and dummy display (see
+# harness.py) and reports per-stage times per frame:
+#   capture - previewFrame(): frame from camera into the YUV buffer
+#   convert - FrameBuffer.convert(): crop, scale & YUV->display format
+#   blit    - Renderer.frame() less overlay & update (image to screen)
+#   overlay - Button.draw(): UI icons atop the image
+#   update  - pygame.display.update(): screen to display
+#   frame   - whole main loop iteration
+# plus frames/sec and allocations per frame, over the whole loop
+# iteration: Surfaces created, net C heap bytes (buffers, large strings,
+# Surface pixels; glibc only) and net objects (GC-tracked) allocated.
+# In the steady state all three should be zero (heap bytes only about
+# zero with -z, as the pre-shutter thread's JPEG buffer churns alongside).
+# Camera property writes and reconfigurations (pipeline restarts) are
+# reported too.  Then, for comparison, cam.py's original viewfinder loop
+# (a camera.capture() into a new BytesIO per frame, readinto(), RGB24
+# convert() and a sliced copy for frombuffer()) runs on the same fake
+# camera at the same sizeData viewfinder size.  The fake camera doesn't
+# model the cost of re-arming the capture for every frame, which is the
+# larger part of the difference on a Pi.
+#
+# Usage: python bench/preview.py [FILE...] [-s WxH] [-n frames]
+#        [-d depth] [-m sizeMode] [-z] [-t threads] [--realtime]
+
+import argparse
+import gc
+import io
+import sys
+import time
+
+import harness
+import yuv2rgb
+from harness import Done, Stage, pygame, timed
+
+# Stands in for cam.py's pygame Clock, so the loop isn't held to previewFps
+class Unthrottled:
+	def tick(self, fps=0):
+	  return 0
+
+def main():
+	p = argparse.ArgumentParser(description='Viewfinder benchmark')
+	p.add_argument('files', nargs='*', help='raw YUV420 frame files')
+	p.add_argument('-s', '--size', default='320x240',
+	  help='frame file size, WxH (default 320x240)')
+	p.add_argument('-n', '--frames', type=int, default=300)
+	p.add_argument('-w', '--warmup', type=int, default=10,
+	  help='frames run before measuring')
+	p.add_argument('-d', '--depth', type=int, default=16,
+	  help='display bits per pixel (PiTFT = 16)')
+	p.add_argument('-m', '--mode', type=int, default=0,
+	  help='sizeMode (0 = Large, 1 = Med, 2 = Small)')
+	p.add_argument('-z', '--zsl', action='store_true',
+	  help='pre-shutter mode')
+	p.add_argument('-t', '--threads', type=int, default=0,
+	  help='conversion threads (0 = one per core)')
+	p.add_argument('--realtime', action='store_true',
+	  help='pace camera & loop to frame rate (else unthrottled)')
+	a = p.parse_args()
+
+	size = tuple(int(x) for x in a.size.split('x'))
+	harness.PiCamera.realtime = a.realtime
+	cam  = harness.load(harness.frameSource(a.files, size), a.depth)
+	try:
+	  run(cam, a)
+	finally:
+	  harness.unload(cam)
+
+def run(cam, a):
+	if not a.realtime: cam.clock = Unthrottled()
+	cam.convertThreads = a.threads
+	cam.sizeModeCallback(a.mode)
+	cam.setPreShutter(a.zsl)
+
+	capture = Stage('capture')
+	convert = Stage('convert')
+	render  = Stage('render')
+	overlay = Stage('overlay')
+	update  = Stage('update')
+	whole   = Stage('frame')
+	stages  = (capture, convert, render, overlay, update, whole)
+	counts  = { 'surfaces' : 0, 'heap' : 0, 'objects' : 0 }
+	state   = { 'n' : 0, 't' : None, 'objects' : 0, 'heap' : 0,
+	            'start' : 0.0 }
+	heap    = harness.heapBytes() is not None
+
+	previewFrame = cam.previewFrame
+	surface      = pygame.Surface
+	frombuffer   = pygame.image.frombuffer
+	draw         = cam.Button.draw
+	display      = pygame.display.update
+
+	def newSurface(*args, **kwargs):
+	  counts['surfaces'] += 1
+	  return surface(*args, **kwargs)
+
+	def newFromBuffer(*args, **kwargs):
+	  counts['surfaces'] += 1
+	  return frombuffer(*args, **kwargs)
+
+	# Each previewFrame() call starts a new main loop iteration
+	def frame():
+	  t    = time.time()
+	  keep = state['n'] > a.warmup
+	  if state['t'] is not None:
+	    if keep: # Before the bookkeeping below, which allocates
+	      counts['objects'] += harness.liveObjects() - state['objects']
+	      if heap: counts['heap'] += harness.heapBytes() - state['heap']
+	    whole.add(t - state['t'])
+	    for s in stages: s.endFrame(keep)
+	  if state['n'] == a.warmup:
+	    counts['surfaces'] = 0
+	    state['start']     = t
+	  if state['n'] == a.warmup + a.frames:
+	    state['end'] = t
+	    raise Done
+	  state['n']      += 1
+	  state['t']       = t
+	  state['objects'] = harness.liveObjects()
+	  if heap: state['heap'] = harness.heapBytes()
+	  t = time.time()
+	  previewFrame()
+	  capture.add(time.time() - t)
+
+	cam.previewFrame          = frame
+	cam.frameBuf.convert      = timed(convert, cam.frameBuf.convert)
+	cam.renderer.frame        = timed(render , cam.renderer.frame)
+	cam.Button.draw           = timed(overlay, cam.Button.draw)
+	pygame.display.update     = timed(update , pygame.display.update)
+	pygame.Surface            = newSurface
+	pygame.image.frombuffer   = newFromBuffer
+
+	camera = cam.camera
+	writes, reconfigs = camera.writes, camera.reconfigs
+	gc.disable() # So net object counts aren't reset by collections
+	try:
+	  harness.mainLoop(cam)
+	finally:
+	  gc.enable()
+	  pygame.Surface          = surface
+	  pygame.image.frombuffer = frombuffer
+	  cam.Button.draw         = draw
+	  pygame.display.update   = display
+
+	# Blit is what's left of render after overlay & update
+	blit = Stage('blit')
+	blit.times = [r - o - u for r, o, u in
+	  zip(render.times, overlay.times, update.times)]
+
+	n = len(whole.times)
+	print 'cam.py viewfinder, %d frames (%dx%d source), %d bpp display' % (
+	  n, cam.previewSize[0], cam.previewSize[1], a.depth)
+	print 'sizeMode %d -> %dx%d%s, %s conversion' % (a.mode,
+	  cam.sizeData[a.mode][1][0], cam.sizeData[a.mode][1][1],
+	  ' (pre-shutter)' if a.zsl else '',
+	  ('RGB24', 'RGB565', 'BGRA32', 'GRAY')[cam.frameBuf.format])
+	print
+	harness.printStages((capture, convert, blit, overlay, update, whole))
+	print
+	print '%.1f frames/sec' % (n / (state['end'] - state['start']))
+	print 'Per frame: %.2f Surfaces, %s heap bytes, %.1f objects' % (
+	  float(counts['surfaces']) / n,
+	  '%.0f' % (float(counts['heap']) / n) if heap else 'n/a',
+	  float(counts['objects']) / n)
+	print 'Camera: %d property writes, %d reconfigurations' % (
+	  camera.writes - writes, camera.reconfigs - reconfigs)
+
+	cam.previewStop()
+	old = original(cam, a)
+	new = n / (state['end'] - state['start'])
+	print
+	print 'Original loop (capture per frame), %dx%d: %.1f frames/sec' % (
+	  cam.sizeData[a.mode][1] + (old,))
+	print 'Current loop: %.1f frames/sec, %.2fx' % (new, new / old)
+
+# cam.py's original viewfinder loop (before the continuous capture), on
+# the same fake camera; returns frames/sec
+def original(cam, a):
+	camera = cam.camera
+	screen = cam.screen
+	size   = cam.sizeData[a.mode][1]
+	w, h   = harness.padded(*size)
+	yuv    = bytearray(w * h * 3 / 2)
+	rgb    = bytearray(w * h * 3)
+	camera.resolution = size
+	camera.crop       = (0.0, 0.0, 1.0, 1.0)
+	for i in range(a.warmup + a.frames):
+	  if i == a.warmup: t = time.time()
+	  pygame.event.get()
+	  stream = io.BytesIO() # Capture into in-memory stream
+	  camera.capture(stream, use_video_port=True, format='raw')
+	  stream.seek(0)
+	  stream.readinto(yuv)  # stream -> YUV buffer
+	  stream.close()
+	  yuv2rgb.convert(yuv, rgb, size[0], size[1])
+	  img = pygame.image.frombuffer(rgb[0:(size[0] * size[1] * 3)],
+	    size, 'RGB')
+	  if img.get_height() < 240: screen.fill(0)
+	  screen.blit(img, ((320 - img.get_width() ) / 2,
+	                    (240 - img.get_height()) / 2))
+	  for b in cam.buttons[3]: b.draw(screen)
+	  pygame.display.update()
+	return a.frames / (time.time() - t)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,143 @@
+# Instrumentation benchmark: measures what cam.py's timing stats cost.
+# First the raw cost of a span (start() & end()) and a counter, disabled
+# and enabled; then the viewfinder main loop (fake camera, unthrottled,
+# see harness.py) with stats off, on, and on with the overlay, as
+# frames/sec and time per frame relative to off.  Then takes a few shots
+# and plays them back so every span has data, prints the summary, and
+# checks the periodic dump.  --png saves the screen with overlay.
+#
+# Usage: python bench/stats.py [-n frames] [-k rounds] [-r repeat]
+#        [--png file]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import harness
+from harness import Done, pygame
+
+# Stands in for cam.py's pygame Clock, so the loop isn't held to previewFps
+class Unthrottled:
+	def tick(self, fps=0):
+	  return 0
+
+def perCall(fn, repeat):
+	t = time.time()
+	for i in xrange(repeat): fn()
+	return (time.time() - t) * 1e9 / repeat # Nanoseconds
+
+def main():
+	p = argparse.ArgumentParser(description='Instrumentation benchmark')
+	p.add_argument('-n', '--frames', type=int, default=500,
+	  help='viewfinder frames per run')
+	p.add_argument('-k', '--rounds', type=int, default=3,
+	  help='runs of each viewfinder configuration')
+	p.add_argument('-r', '--repeat', type=int, default=200000,
+	  help='calls timed for span & counter costs')
+	p.add_argument('--png', help='save screen with overlay to this file')
+	a = p.parse_args()
+
+	cam = harness.load(harness.frameSource([], (320, 240)))
+	try:
+	  run(cam, a)
+	finally:
+	  harness.unload(cam)
+
+# Run main loop for n viewfinder frames; returns seconds per frame
+def loop(cam, n):
+	state = { 'n' : 0 }
+	previewFrame = cam.previewFrame
+	def frame():
+	  if state['n'] == 10: state['t'] = time.time() # After warmup
+	  if state['n'] == 10 + n: raise Done
+	  state['n'] += 1
+	  previewFrame()
+	cam.previewFrame = frame
+	try:
+	  harness.mainLoop(cam)
+	finally:
+	  cam.previewFrame = previewFrame
+	return (time.time() - state['t']) / n
+
+def run(cam, a):
+	cam.clock          = Unthrottled()
+	cam.convertThreads = 1 # Steadier timing than a thread per core
+	stats              = cam.stats
+
+	def span():
+	  stats.end('x', stats.start())
+	def count():
+	  stats.count('x')
+
+	print 'Per call (nsec)   disabled  enabled'
+	for name, fn in (('span', span), ('counter', count)):
+	  stats.enabled = False
+	  off = perCall(fn, a.repeat)
+	  stats.enabled = True
+	  on  = perCall(fn, a.repeat)
+	  print '%-16s %9.0f %8.0f' % (name, off, on)
+	stats.enabled = False
+	print
+
+	# Runs interleaved, best of each kept, to even out machine noise
+	runs = (('off', False, False), ('on', True, False),
+	        ('on + overlay', True, True))
+	best = [None] * len(runs)
+	for r in range(a.rounds):
+	  for i, (name, enabled, overlay) in enumerate(runs):
+	    stats.enabled    = enabled
+	    cam.statsOverlay = overlay
+	    t = loop(cam, a.frames)
+	    if best[i] is None or t < best[i]: best[i] = t
+	print 'Viewfinder, %d frames, best of %d   fps  usec/frame  vs off' % (
+	  a.frames, a.rounds)
+	for (name, enabled, overlay), t in zip(runs, best):
+	  print '%-30s %7.1f %10.1f %+8.1f' % (name, 1.0 / t, t * 1e6,
+	    (t - best[0]) * 1e6)
+
+	# Exercise shot & playback spans, and the dump
+	path = os.path.join(cam.scratch, 'stats.log')
+	stats.reset()
+	stats.enabled    = True
+	cam.statsOverlay = True
+	stats.dump(path, 0.2)
+	cam.pathData[:] = [os.path.join(cam.scratch, 'Photos')] * 3
+	for i in range(5):
+	  cam.takePicture()
+	  cam.previewFrame()
+	cam.pipeline.drain()
+	cam.playCache.items.clear() # So showImage() decodes
+	r = cam.imgRange(cam.pathData[0])
+	for i in range(r[0], r[1] + 1): cam.showImage(i)
+	cam.screenMode = 3
+	loop(cam, 30)
+	time.sleep(0.5)
+
+	s = stats.summary()
+	print
+	print '%-18s %6s %8s %8s %8s %8s' % ('span', 'count', 'mean ms',
+	  'median', '95%', 'max')
+	for k in sorted(s['spans']):
+	  n, mean, median, p95, most = s['spans'][k]
+	  print '%-18s %6d %8.3f %8.3f %8.3f %8.3f' % (k, n, mean * 1000.0,
+	    median * 1000.0, p95 * 1000.0, most * 1000.0)
+	print 'Counters:', ', '.join('%s %d' % i for i in sorted(s['counts'].items()))
+	print '%.1f fps' % s['fps']
+
+	stats.dump(None, 0)
+	with open(path) as f: lines = f.readlines()
+	ok = lines and all('spans' in json.loads(l) for l in lines)
+	print 'Dump: %d lines, %s' % (len(lines), 'ok' if ok else 'BAD')
+	if a.png:
+	  cam.overlay.due = 0.0
+	  cam.renderer.frame(cam.frameBuf.convert(cam.yuv, cam.previewSize,
+	    cam.previewRect, cam.sizeData[cam.sizeMode][1]),
+	    cam.buttons[3], True)
+	  pygame.image.save(cam.screen, a.png)
+	  print 'Saved', a.png
+	return 0 if ok else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
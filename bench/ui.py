@@ -0,0 +1,134 @@
+# UI benchmark: times touch dispatch (buttonAt(), bounds precomputed, vs.
+# computing each Button's bounds on every test, as cam.py originally
+# did), Button.setBg() (icon looked up in the dict
+# registry filled from the atlas vs. by scanning a list of Icons for the
+# name, as originally done), drawing each screen's Buttons, and
+# imgRange() (ImageIndex vs. listing the directory, as originally done)
+# for a directory of n images.  Runs cam.py via harness.py.
+#
+# Usage: python bench/ui.py [-n images] [-r repeat]
+
+import argparse
+import fnmatch
+import os
+import random
+import sys
+import time
+
+import harness
+
+# imgRange() as originally written: list the directory every call
+def listRange(path):
+	min = 9999
+	max = 0
+	for file in os.listdir(path):
+	  if fnmatch.fnmatch(file, 'IMG_[0-9][0-9][0-9][0-9].JPG'):
+	    i = int(file[4:8])
+	    if(i < min): min = i
+	    if(i > max): max = i
+	return None if min > max else (min, max)
+
+# Touch dispatch as originally written (Button.selected() less the
+# callback): first Button containing pos, bounds computed per test
+def originalFind(buttons, pos):
+	for b in buttons:
+	  x1 = b.rect[0]
+	  y1 = b.rect[1]
+	  x2 = x1 + b.rect[2] - 1
+	  y2 = y1 + b.rect[3] - 1
+	  if ((pos[0] >= x1) and (pos[0] <= x2) and
+	      (pos[1] >= y1) and (pos[1] <= y2)):
+	    return b
+	return None
+
+# Button.setBg() as originally written: scan the Icon list for name
+def linearSetBg(button, iconList, name):
+	if name is None:
+	  button.iconBg = None
+	else:
+	  for i in iconList:
+	    if name == i.name:
+	      button.iconBg = i
+	      break
+	button.layer = None # Recomposite on next draw, as setBg() does
+
+def timeit(fn, repeat):
+	t = time.time()
+	for i in range(repeat): fn()
+	return (time.time() - t) * 1e6 / repeat # Microseconds per call
+
+def main():
+	p = argparse.ArgumentParser(description='UI benchmark')
+	p.add_argument('-n', '--images', type=int, default=2000,
+	  help='images in test directory for imgRange()')
+	p.add_argument('-r', '--repeat', type=int, default=1000)
+	a = p.parse_args()
+
+	cam = harness.load(harness.frameSource([], (320, 240)))
+	try:
+	  run(cam, a)
+	finally:
+	  harness.unload(cam)
+
+def run(cam, a):
+	taps = [(random.randrange(320), random.randrange(240))
+	  for i in range(a.repeat)]
+
+	print 'Touch dispatch, %d random taps (usec/tap)' % len(taps)
+	print '%-6s %8s %9s %9s' % ('screen', 'buttons', 'buttonAt', 'original')
+	for mode, buttons in enumerate(cam.buttons):
+	  for pos in taps:
+	    assert cam.buttonAt(buttons, pos) is originalFind(buttons, pos)
+	  it = iter(taps * 2)
+	  h  = timeit(lambda: cam.buttonAt(buttons, next(it)), len(taps))
+	  it = iter(taps * 2)
+	  l  = timeit(lambda: originalFind(buttons, next(it)), len(taps))
+	  print '%-6d %8d %9.2f %9.2f' % (mode, len(buttons), h, l)
+
+	# Every icon name, plus the spinner's sequence as it runs (the most
+	# frequent caller), in random order
+	names = cam.icons.keys() + ['working'] + ['work-%d' % (i % 5)
+	  for i in range(20)]
+	random.shuffle(names)
+	iconList = [cam.icons[n] for n in sorted(cam.icons)]
+	button   = cam.buttons[3][3]
+	for name in names:
+	  linearSetBg(button, iconList, name)
+	  i = button.iconBg
+	  button.setBg(name)
+	  assert button.iconBg is i
+	print
+	print 'setBg(), %d icons (usec/call)' % len(iconList)
+	it = iter(names * (a.repeat / len(names) + 2))
+	d  = timeit(lambda: button.setBg(next(it)), a.repeat)
+	it = iter(names * (a.repeat / len(names) + 2))
+	l  = timeit(lambda: linearSetBg(button, iconList, next(it)), a.repeat)
+	print 'dict       %9.2f' % d
+	print 'list scan  %9.2f' % l
+	button.setBg(None)
+
+	print
+	print 'Drawing Buttons (usec/screen, cached layers)'
+	screen = cam.screen
+	for mode, buttons in enumerate(cam.buttons):
+	  def draw():
+	    for b in buttons: b.draw(screen)
+	  print '%-6d %9.1f' % (mode, timeit(draw, a.repeat / 10 or 1))
+
+	print
+	path = os.path.join(cam.scratch, 'Photos')
+	os.mkdir(path)
+	for i in random.sample(range(1, 10000), a.images):
+	  open(os.path.join(path, 'IMG_%04d.JPG' % i), 'w').close()
+	t     = time.time()
+	index = cam.imageIndex(path)
+	t     = (time.time() - t) * 1e6
+	assert cam.imgRange(path) == listRange(path)
+	print 'imgRange(), %d images (usec/call)' % a.images
+	print 'ImageIndex %9.2f (initial scan %.0f)' % (
+	  timeit(lambda: cam.imgRange(path), a.repeat), t)
+	print 'listdir    %9.2f' % timeit(lambda: listRange(path),
+	  a.repeat / 100 or 1)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,166 @@
+# Upload queue benchmark: runs cam.py's UploadQueue against the stand-in
+# uploader (bench/uploader.py, in place of dropbox_uploader.sh) and
+# checks the three things it's for:
+#   batching  n files queued at once go up in calls of at most 'batch'
+#             files; reports calls, batch sizes and files/sec
+#   backoff   a file whose first k uploads fail is retried after
+#             retryMin, 2 x retryMin, ... (capped at retryMax), then sent
+#   replay    files queued while the uploader is failing are still in the
+#             journal after a 'restart' (a new queue on the same journal),
+#             which uploads them all and leaves the journal empty
+# --delay and --perfile set the stand-in's time per call & per file.
+#
+# Usage: python bench/upload.py [-n files] [-w workers] [-k batch]
+#        [--delay sec] [--perfile sec]
+
+import argparse
+import os
+import sys
+import time
+
+import harness
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Stand-in uploader's config & call log, in its own directory per test
+class Uploader:
+
+	def __init__(self, cam, name, **config):
+	  self.dest   = os.path.join(cam.scratch, name)
+	  self.config = os.path.join(cam.scratch, name + '.conf')
+	  config['DEST'] = self.dest
+	  with open(self.config, 'w') as f:
+	    for k, v in config.items(): f.write('%s=%s\n' % (k, v))
+	  cam.uploader = os.path.join(here, 'uploader.py')
+	  cam.upconfig = self.config
+
+	def set(self, k, v):
+	  with open(self.config, 'a') as f: f.write('%s=%s\n' % (k, v))
+
+	# (time, ok, files) per call so far
+	def calls(self):
+	  try:
+	    with open(os.path.join(self.dest, 'calls.log')) as f:
+	      return [(float(t), ok == '1', int(n))
+	        for t, ok, n in (l.split() for l in f)]
+	  except IOError:
+	    return []
+
+	def uploaded(self):
+	  d = os.path.join(self.dest, 'Photos')
+	  return set(os.listdir(d)) if os.path.isdir(d) else set()
+
+# n small files standing in for photos
+def photos(cam, name, n):
+	d = os.path.join(cam.scratch, name)
+	os.mkdir(d)
+	paths = []
+	for i in range(n):
+	  p = os.path.join(d, 'IMG_%04d.JPG' % i)
+	  with open(p, 'wb') as f: f.write(harness.jpeg((64, 48)))
+	  paths.append(p)
+	return paths
+
+def wait(test, timeout):
+	t = time.time() + timeout
+	while not test():
+	  if time.time() > t: return False
+	  time.sleep(0.01)
+	return True
+
+def journaled(path):
+	try:
+	  with open(path) as f: return [l.rstrip('\n') for l in f if l.strip()]
+	except IOError:
+	  return []
+
+def report(name, ok, detail):
+	print '%-9s %-5s %s' % (name, 'ok' if ok else 'FAIL', detail)
+	return ok
+
+def batching(cam, a):
+	up    = Uploader(cam, 'batching', DELAY=a.delay, PERFILE=a.perfile)
+	files = photos(cam, 'batching-in', a.files)
+	q     = cam.UploadQueue(os.path.join(cam.scratch, 'batching.journal'),
+	  workers=a.workers, batch=a.batch)
+	t = time.time()
+	for p in files: q.add(p)
+	done  = wait(lambda: q.depth() == 0, 60)
+	t     = time.time() - t
+	calls = up.calls()
+	sizes = [n for _, _, n in calls] or [0]
+	fps, bps = q.throughput()
+	ok = (done and len(up.uploaded()) == len(files) and
+	  max(sizes) <= a.batch and not journaled(q.journal))
+	return report('batching', ok, '%d files in %d calls (%d-%d per call), '
+	  '%.2f s, %.0f files/sec (%.0f while uploading)' % (len(files),
+	  len(calls), min(sizes), max(sizes), t, len(files) / t, fps))
+
+def backoff(cam, a):
+	fail  = 3
+	up    = Uploader(cam, 'backoff', FAIL=fail)
+	files = photos(cam, 'backoff-in', 1)
+	q     = cam.UploadQueue(os.path.join(cam.scratch, 'backoff.journal'),
+	  workers=1, retryMin=0.1, retryMax=0.25)
+	q.add(files[0])
+	done  = wait(lambda: q.depth() == 0, 10)
+	calls = up.calls()
+	gaps  = [y[0] - x[0] for x, y in zip(calls, calls[1:])]
+	want  = [min(0.1 * 2 ** i, 0.25) for i in range(fail)]
+	# Each gap is the backoff plus one uploader run, so a little over
+	ok = (done and len(calls) == fail + 1 and q.failures == fail and
+	  all(w <= g < w + 0.2 for g, w in zip(gaps, want)) and
+	  len(up.uploaded()) == 1)
+	return report('backoff', ok, '%d failures, retried after %s s '
+	  '(expected %s)' % (q.failures, ', '.join('%.2f' % g for g in gaps),
+	  ', '.join('%.2f' % w for w in want)))
+
+def replay(cam, a):
+	journal = os.path.join(cam.scratch, 'replay.journal')
+	up      = Uploader(cam, 'replay', FAIL=1000000)
+	files   = photos(cam, 'replay-in', a.batch * 2 + 1)
+	# With a long backoff, once every file has failed once the queue sits
+	# on its journal as if the camera had been shut down
+	q = cam.UploadQueue(journal, workers=1, batch=a.batch, retryMin=3600.0)
+	for p in files: q.add(p)
+	wait(lambda: q.depth() == len(files) and
+	  all(e[0] for e in q.pending.values()), 10)
+	kept = journaled(journal)
+	# That queue is gone now; empty it (journal untouched) so its worker
+	# idles instead of polling out the backoff
+	with q.cond:
+	  q.pending.clear()
+	  q.cond.notify_all()
+	# 'Restart': a new queue on the same journal, uploader working again
+	up.set('FAIL', 0)
+	q = cam.UploadQueue(journal, workers=a.workers, batch=a.batch)
+	done = wait(lambda: q.depth() == 0, 30)
+	ok = (kept == files and done and
+	  up.uploaded() == set(os.path.basename(p) for p in files) and
+	  not journaled(journal))
+	return report('replay', ok, '%d of %d files in journal at restart, '
+	  '%d uploaded after, journal %s' % (len(kept), len(files),
+	  len(up.uploaded()), 'empty' if not journaled(journal) else 'NOT empty'))
+
+def main():
+	p = argparse.ArgumentParser(description='Upload queue benchmark')
+	p.add_argument('-n', '--files', type=int, default=100,
+	  help='files queued in the batching test')
+	p.add_argument('-w', '--workers', type=int, default=2)
+	p.add_argument('-k', '--batch', type=int, default=8,
+	  help='files per uploader call')
+	p.add_argument('--delay', type=float, default=0.0,
+	  help='simulated time per uploader call (sec)')
+	p.add_argument('--perfile', type=float, default=0.0,
+	  help='simulated upload time per file (sec)')
+	a = p.parse_args()
+
+	cam = harness.load(harness.frameSource([], (320, 240)))
+	try:
+	  ok = all([batching(cam, a), backoff(cam, a), replay(cam, a)])
+	finally:
+	  harness.unload(cam)
+	return 0 if ok else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Stand-in for dropbox_uploader.sh, for testing cam.py's UploadQueue
+# without a network or Dropbox account: set cam.py's uploader to this
+# script and upconfig to a config file of KEY=value lines (as in the
+# real uploader's config):
+#
+#   DEST=/path   'Uploads' go here (DEST/Photos/...), default ./uploaded
+#   DELAY=sec    Time per call, plus PERFILE=sec per file (default 0)
+#   FAIL=n       Fail the next n calls (counts down, rewritten each call)
+#
+# Each call is appended to DEST/calls.log as 'time ok files', so callers
+# can check batch sizes and retry timing.
+#
+# Usage: uploader.py [-f config] upload FILE... DEST/
+
+import os
+import shutil
+import sys
+import time
+
+def readConfig(path):
+	config = {}
+	if path:
+	  with open(path) as f:
+	    for line in f:
+	      k, s, v = line.strip().partition('=')
+	      if s: config[k] = v
+	return config
+
+def writeConfig(path, config):
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+	  for k, v in sorted(config.items()):
+	    f.write('%s=%s\n' % (k, v))
+	os.rename(tmp, path)
+
+def makedirs(d): # Concurrent calls may race to create it
+	try:
+	  os.makedirs(d)
+	except OSError:
+	  if not os.path.isdir(d): raise
+
+def main(args):
+	t    = time.time()
+	path = None
+	if args[:1] == ['-f']:
+	  path = args[1]
+	  args = args[2:]
+	if len(args) < 3 or args[0] != 'upload':
+	  sys.stderr.write('Usage: uploader.py [-f config] upload FILE... DEST/\n')
+	  return 2
+	files  = args[1:-1]
+	config = readConfig(path)
+	dest   = config.get('DEST', 'uploaded')
+	fail   = int(config.get('FAIL', 0))
+	time.sleep(float(config.get('DELAY', 0)) +
+	  float(config.get('PERFILE', 0)) * len(files))
+	if fail > 0:
+	  config['FAIL'] = fail - 1
+	  writeConfig(path, config)
+	else:
+	  d = os.path.join(dest, args[-1])
+	  makedirs(d)
+	  for f in files: shutil.copy(f, d)
+	makedirs(dest)
+	with open(os.path.join(dest, 'calls.log'), 'a') as f:
+	  f.write('%.6f %d %d\n' % (t, fail <= 0, len(files)))
+	return 1 if fail > 0 else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -22,22 +22,35 @@
 # Written by Phil Burgess / Paint Your Dragon for Adafruit Industries.
 # BSD license, all text above must be included in any redistribution.
 
+import BaseHTTPServer
+import Queue
+import SocketServer
 import atexit
+import bisect
 import cPickle as pickle
+import collections
+import ctypes
 import errno
 import fnmatch
 import io
+import json
 import os
 import os.path
 import picamera
 import pygame
+import re
+import socket
 import stat
+import struct
+import sys
 import threading
 import time
 import yuv2rgb
 from pygame.locals import *
 from subprocess import call  
 
+startTime = time.time() # For measuring time to first viewfinder frame
+
 
 # UI classes ---------------------------------------------------------------
 
@@ -48,15 +61,121 @@ from subprocess import call
 # Icon is a very simple bitmap class, just associates a name and a pygame
 # image (PNG loaded from icons directory) for each.
 # There isn't a globally-declared fixed list of Icons.  Instead, the list
-# is populated at runtime from the contents of the 'icons' directory.
+# is populated at runtime from the contents of the 'icons' directory,
+# into the global icons{} dict (keyed by name).  Bitmaps are fetched from
+# the IconAtlas (below) and converted to the display format only on first
+# use; many (e.g. most fx-* and iso-* images) may never be shown.
+# bitmap is None if the image couldn't be loaded.
+
+class Icon(object):
 
-class Icon:
+	__slots__ = ('name', '_bitmap')
 
 	def __init__(self, name):
-	  self.name = name
+	  self.name    = name
+	  self._bitmap = False # Not yet loaded
+
+	@property
+	def bitmap(self):
+	  if self._bitmap is False:
+	    self._bitmap = atlas.bitmap(self.name)
+	  return self._bitmap
+
+# Decoding dozens of PNGs is a large part of startup time, so all icons
+# are kept pre-decoded in a single atlas file: a small header (index of
+# icon rects plus the name/mtime/size of each source PNG) followed by
+# raw RGBA pixels, loaded with one read and wrapped as a Surface without
+# copying.  If any PNG is added, removed or changed, the atlas is rebuilt
+# (and rewritten if the directory is writable).
+
+class IconAtlas(object):
+
+	__slots__ = ('path', 'dir', 'index', 'surface', 'data')
+
+	magic = 'PiCamAtlas1\n'
+	width = 512 # Atlas width in pixels
+
+	def __init__(self, path, dir):
+	  self.path    = path
+	  self.dir     = dir
+	  self.index   = {}   # Icon name -> (x, y, w, h) within atlas
+	  self.surface = None
+	  self.data    = None # Pixel data backing surface
+	  sig = self.signature()
+	  if not self.load(sig): self.build(sig)
+
+	def names(self):
+	  return self.index.keys()
+
+	# Return Icon bitmap (in display format) from atlas, or None
+	def bitmap(self, name):
+	  rect = self.index.get(name)
+	  if rect is None: return None
+	  return self.surface.subsurface(rect).convert_alpha()
+
+	def signature(self):
+	  sig = []
+	  for file in sorted(os.listdir(self.dir)):
+	    if fnmatch.fnmatch(file, '*.png'):
+	      st = os.stat(self.dir + '/' + file)
+	      sig.append((file, st.st_mtime, st.st_size))
+	  return sig
+
+	def load(self, sig):
+	  try:
+	    with open(self.path, 'rb') as f:
+	      data = f.read()
+	    if not data.startswith(self.magic): return False
+	    pos    = len(self.magic)
+	    n      = struct.unpack('<I', data[pos:pos + 4])[0]
+	    header = pickle.loads(data[pos + 4:pos + 4 + n])
+	    if header['sig'] != sig: return False
+	    self.surface = pygame.image.frombuffer(
+	      buffer(data, pos + 4 + n), header['size'], 'RGBA')
+	    self.data    = data
+	    self.index   = header['index']
+	    return True
+	  except (IOError, OSError, EOFError, ValueError, KeyError, IndexError,
+	    struct.error, pickle.UnpicklingError, pygame.error):
+	    return False # Missing, stale or damaged; rebuilt
+
+	def build(self, sig):
+	  images = {}
+	  for file, mtime, size in sig:
+	    try:
+	      img = pygame.image.load(self.dir + '/' + file)
+	      images[file.split('.')[0]] = (img.get_size(),
+	        pygame.image.tostring(img, 'RGBA'))
+	    except pygame.error:
+	      pass
+	  # Shelf packing, tallest first
+	  x = y = rowHeight = 0
+	  for name in sorted(images, key=lambda n: -images[n][0][1]):
+	    w, h = images[name][0]
+	    if x + w > self.width:
+	      x          = 0
+	      y         += rowHeight
+	      rowHeight  = 0
+	    self.index[name] = (x, y, w, h)
+	    x         += w
+	    rowHeight  = max(rowHeight, h)
+	  size   = (self.width, max(y + rowHeight, 1))
+	  pixels = bytearray(size[0] * size[1] * 4)
+	  for name, (x, y, w, h) in self.index.iteritems():
+	    src = images[name][1]
+	    for row in range(h): # Copy raw rows; no blending
+	      i = ((y + row) * size[0] + x) * 4
+	      pixels[i:i + w * 4] = src[row * w * 4:(row + 1) * w * 4]
+	  self.data    = pixels
+	  self.surface = pygame.image.frombuffer(pixels, size, 'RGBA')
+	  header = pickle.dumps({ 'sig': sig, 'size': size, 'index': self.index },
+	    pickle.HIGHEST_PROTOCOL)
 	  try:
-	    self.bitmap = pygame.image.load(iconPath + '/' + name + '.png')
-	  except:
+	    with open(self.path + '.tmp', 'wb') as f:
+	      f.write(self.magic + struct.pack('<I', len(header)) + header)
+	      f.write(pixels)
+	    os.rename(self.path + '.tmp', self.path)
+	  except (IOError, OSError):
 	    pass
 
 # Button is a simple tappable screen region.  Each has:
@@ -74,8 +193,15 @@ class Icon:
 # may take input precedence (e.g. the Effect labels & buttons).
 # After Icons are loaded at runtime, a pass is made through the global
 # buttons[] list to assign the Icon objects (from names) to each Button.
+# Touch dispatch tests the current screen's Buttons in order (there are
+# few enough per screen that a spatial index only slows it down; see
+# bench/ui.py); the rect is a property so bounds are precomputed once,
+# not on every test.
 
-class Button:
+class Button(object):
+
+	__slots__ = ('_rect', 'x1', 'y1', 'x2', 'y2', 'color', 'iconBg',
+	  'iconFg', 'bg', 'fg', 'callback', 'value', 'layer')
 
 	def __init__(self, rect, **kwargs):
 	  self.rect     = rect # Bounds
@@ -86,6 +212,7 @@ class Button:
 	  self.fg       = None # Foreground Icon name
 	  self.callback = None # Callback function
 	  self.value    = None # Value passed to callback
+	  self.layer    = None # Cached (Surface, offset) of Icons, () if none
 	  for key, value in kwargs.iteritems():
 	    if   key == 'color': self.color    = value
 	    elif key == 'bg'   : self.bg       = value
@@ -93,39 +220,138 @@ class Button:
 	    elif key == 'cb'   : self.callback = value
 	    elif key == 'value': self.value    = value
 
+	@property
+	def rect(self):
+	  return self._rect
+
+	@rect.setter
+	def rect(self, rect):
+	  self._rect = rect
+	  self.x1    = rect[0]
+	  self.y1    = rect[1]
+	  self.x2    = rect[0] + rect[2] - 1
+	  self.y2    = rect[1] + rect[3] - 1
+
+	def contains(self, pos):
+	  return self.x1 <= pos[0] <= self.x2 and self.y1 <= pos[1] <= self.y2
+
+	def select(self):
+	  if self.callback:
+	    if self.value is None: self.callback()
+	    else:                  self.callback(self.value)
+
 	def selected(self, pos):
-	  x1 = self.rect[0]
-	  y1 = self.rect[1]
-	  x2 = x1 + self.rect[2] - 1
-	  y2 = y1 + self.rect[3] - 1
-	  if ((pos[0] >= x1) and (pos[0] <= x2) and
-	      (pos[1] >= y1) and (pos[1] <= y2)):
-	    if self.callback:
-	      if self.value is None: self.callback()
-	      else:                  self.callback(self.value)
+	  if self.contains(pos):
+	    self.select()
 	    return True
 	  return False
 
+	# Background & foreground Icons are composited once into a single
+	# cached layer, so each draw is at most a fill and one blit.
+	def compose(self):
+	  icons = [i.bitmap for i in (self.iconBg, self.iconFg) if i and i.bitmap]
+	  if not icons:
+	    self.layer = ()
+	  elif len(icons) == 1:
+	    self.layer = (icons[0],
+	      ((self.rect[2] - icons[0].get_width() ) / 2,
+	       (self.rect[3] - icons[0].get_height()) / 2))
+	  else:
+	    s = pygame.Surface(self.rect[2:4], pygame.SRCALPHA, 32)
+	    for i in icons:
+	      s.blit(i, ((self.rect[2] - i.get_width() ) / 2,
+	                 (self.rect[3] - i.get_height()) / 2))
+	    self.layer = (s, (0, 0))
+
+	# True if the Button draws anything (else it's an input region only)
+	def visible(self):
+	  if self.layer is None: self.compose()
+	  return bool(self.color or self.layer)
+
 	def draw(self, screen):
 	  if self.color:
 	    screen.fill(self.color, self.rect)
-	  if self.iconBg:
-	    screen.blit(self.iconBg.bitmap,
-	      (self.rect[0]+(self.rect[2]-self.iconBg.bitmap.get_width())/2,
-	       self.rect[1]+(self.rect[3]-self.iconBg.bitmap.get_height())/2))
-	  if self.iconFg:
-	    screen.blit(self.iconFg.bitmap,
-	      (self.rect[0]+(self.rect[2]-self.iconFg.bitmap.get_width())/2,
-	       self.rect[1]+(self.rect[3]-self.iconFg.bitmap.get_height())/2))
+	  if self.layer is None: self.compose()
+	  if self.layer:
+	    screen.blit(self.layer[0], (self.rect[0] + self.layer[1][0],
+	                                self.rect[1] + self.layer[1][1]))
 
 	def setBg(self, name):
 	  if name is None:
 	    self.iconBg = None
 	  else:
-	    for i in icons:
-	      if name == i.name:
-	        self.iconBg = i
-	        break
+	    i = icons.get(name)
+	    if i: self.iconBg = i
+	  self.layer = None # Recomposite on next draw
+
+# Return first Button in list (input precedence) containing pos, or None
+def buttonAt(buttons, pos):
+	for b in buttons:
+	  if b.contains(pos): return b
+	return None
+
+# All drawing to the screen goes through a single Renderer, which holds a
+# lock so the spinner thread and main loop can't interleave, and sends
+# only changed areas to the display (over SPI for the PiTFT): a spinner
+# frame updates just its own rect, and a letterboxed viewfinder frame
+# updates the image and visible Buttons but not the unchanging bars.
+# When the image area changes (e.g. sizeMode switch), the bars around the
+# new image are sent as well, clearing what the old image left there.
+
+class Renderer:
+
+	def __init__(self, screen):
+	  self.screen  = screen
+	  self.lock    = threading.RLock()
+	  self.imgRect = None # Image area in last frame()
+
+	# Screen areas outside rect r (the letterbox bars), as Rects
+	@staticmethod
+	def bars(r):
+	  return [b for b in (pygame.Rect(0, 0, 320, r.top),
+	    pygame.Rect(0, r.bottom, 320, 240 - r.bottom),
+	    pygame.Rect(0, r.top, r.left, r.height),
+	    pygame.Rect(r.right, r.top, 320 - r.right, r.height))
+	    if b.width > 0 and b.height > 0]
+
+	# Draw a single Button and update just its area of the display
+	def drawButton(self, b):
+	  with self.lock:
+	    b.draw(self.screen)
+	    pygame.display.update(b.rect)
+
+	def clear(self):
+	  with self.lock:
+	    self.screen.fill(0)
+	    pygame.display.update()
+
+	# Draw image centered (letterboxed if needed), Buttons atop.
+	# Unless 'full' is set (e.g. screen mode changed), only the image
+	# and visible Button areas are updated on the display.
+	def frame(self, img, buttons, full):
+	  t = stats.start()
+	  with self.lock:
+	    rects = []
+	    if (img is None or img.get_width() < 320 or
+	        img.get_height() < 240): # Letterbox
+	      self.screen.fill(0)
+	    r = None
+	    if img:
+	      r = pygame.Rect(((320 - img.get_width() ) / 2,
+	                       (240 - img.get_height()) / 2), img.get_size())
+	      self.screen.blit(img, r)
+	      rects.append(r)
+	      if r != self.imgRect: rects.extend(self.bars(r))
+	    self.imgRect = r
+	    for b in buttons:
+	      b.draw(self.screen)
+	      if b.visible(): rects.append(pygame.Rect(b.rect))
+	    if statsOverlay and stats.enabled:
+	      overlay.draw(self.screen)
+	      rects.append(pygame.Rect(overlay.rect))
+	    if full or img is None: pygame.display.update()
+	    else:                   pygame.display.update(rects)
+	  stats.end('draw', t)
 
 
 # UI callbacks -------------------------------------------------------------
@@ -148,6 +374,7 @@ def fxCallback(n): # Pass 1 (next effect) or -1 (prev effect)
 
 def quitCallback(): # Quit confirmation button
 	saveSettings()
+	pipeline.drain() # Finish writing/uploading photos already taken
 	raise SystemExit
 
 def viewCallback(n): # Viewfinder buttons
@@ -156,8 +383,7 @@ def viewCallback(n): # Viewfinder buttons
 	if n is 0:   # Gear icon (settings)
 	  screenMode = settingMode # Switch to last settings mode
 	elif n is 1: # Play icon (image playback)
-	  if scaled: # Last photo is already memory-resident
-	    loadIdx         = saveIdx
+	  if scaled: # Last photo is already memory-resident (at loadIdx)
 	    screenMode      =  0 # Image playback
 	    screenModePrior = -1 # Force screen refresh
 	  else:      # Load image
@@ -165,7 +391,13 @@ def viewCallback(n): # Viewfinder buttons
 	    if r: showImage(r[1]) # Show last image in directory
 	    else: screenMode = 2  # No images
 	else: # Rest of screen = shutter
-	  takePicture()
+	  if lapse.running:
+	    lapse.stop() # Any tap ends a time-lapse; viewfinder resumes
+	    screenModePrior = -1
+	  elif lapseInterval > 0:
+	    startTimeLapse()
+	  else:
+	    takePicture()
 
 def doneCallback(): # Exit settings
 	global screenMode, settingMode
@@ -182,14 +414,15 @@ def imageCallback(n): # Pass 1 (next image), -1 (prev image) or 0 (delete)
 	  showNextImage(n)
 
 def deleteCallback(n): # Delete confirmation
-	global loadIdx, scaled, screenMode, storeMode
+	global loadIdx, scaled, screenMode, screenModePrior, storeMode
 	screenMode      =  0
 	screenModePrior = -1
 	if n is True:
 	  os.remove(pathData[storeMode] + '/IMG_' + '%04d' % loadIdx + '.JPG')
+	  playCache.discard(pathData[storeMode] + '/IMG_' + '%04d' % loadIdx + '.JPG')
+	  imageIndex(pathData[storeMode]).remove(loadIdx)
 	  if(imgRange(pathData[storeMode])):
-	    screen.fill(0)
-	    pygame.display.update()
+	    renderer.clear()
 	    showNextImage(-1)
 	  else: # Last image deleteted; go to 'no images' mode
 	    screenMode = 2
@@ -207,8 +440,7 @@ def sizeModeCallback(n): # Radio buttons on size settings screen
 	buttons[5][sizeMode + 3].setBg('radio3-0')
 	sizeMode = n
 	buttons[5][sizeMode + 3].setBg('radio3-1')
-	camera.resolution = sizeData[sizeMode][1]
-#	camera.crop       = sizeData[sizeMode][2]
+	previewStop() # Main loop restarts it, reconfigured for new size
 
 
 # Global stuff -------------------------------------------------------------
@@ -222,9 +454,54 @@ sizeMode        =  0      # Image size; default = Large
 fxMode          =  0      # Image effect; default = Normal
 isoMode         =  0      # ISO settingl default = Auto
 iconPath        = 'icons' # Subdirectory containing UI bitmaps (PNG format)
+atlasPath       = 'icons.atlas' # Prebuilt icon atlas (made from iconPath)
+bootTime        = None    # Seconds from start to first viewfinder frame
+burstCount      = 0       # Frames per shutter press (0 or 1 = single shot)
+burstRate       = 10      # Burst capture rate (frames/sec)
+burstSlots      = 8       # Burst ring buffer size (frames)
+burstSlotBytes  = 3 * 1024 * 1024 # Max size of one burst frame (JPEG)
+lastBurst       = None    # BurstRing from last burst, for stats
+zslEnabled      = False   # Pre-shutter ('zero shutter lag') capture mode
+zslRes          = (1296, 972) # Camera resolution in pre-shutter mode
+zslQuality      = 85      # JPEG quality of pre-shutter frames
+zslMemory       = 24 * 1024 * 1024 # Pre-shutter buffer limit (bytes)
+zslBefore       = 0       # Extra frames saved from before the tap
+zslAfter        = 0       # Extra frames saved from after the tap
+livePort        = 0       # Live view HTTP server port (0 = off, e.g. 8080)
+liveRes         = (640, 480) # Live view stream resolution
+liveQuality     = 50      # Live view JPEG quality
+headless        = False   # No display; control socket only (or --headless)
+controlPath     = ''      # Control socket path ('' = none unless headless)
+statsEnabled    = False   # Collect timing stats (or --stats)
+statsOverlay    = False   # Draw stats atop screen (if statsEnabled)
+statsPath       = ''      # Stats dump file, or host:port for UDP ('' = none)
+statsInterval   = 10.0    # Seconds between stats dumps
+syncMode        = 'batch' # Photo fsync policy: 'shot', 'batch' or 'none'
+syncBatch       = 8       # Photos per fsync in 'batch' mode
+writeBuffer     = 32 * 1024 * 1024 # Write-behind buffer per storage target
+lapseInterval   = 0       # Time-lapse interval (sec; 0 = shutter is manual)
+lapseOverrun    = 'skip'  # 'skip' or 'queue' shots missed during overrun
+lapseAlign      = True    # Time-lapse shots on multiples of wall clock
+motionEnabled   = False   # Take picture when motion seen in viewfinder
 saveIdx         = -1      # Image index for saving (-1 = none set yet)
 loadIdx         = -1      # Image index for loading
 scaled          = None    # pygame Surface w/last-loaded image
+reviewTime      = 2.5     # Seconds to show each new photo after capture
+reviewUntil     = 0.0     # monotonic() time when current review ends
+thumbQuality    = 60      # JPEG quality of screen-sized EXIF thumbnail
+WAKE            = USEREVENT # Event posted to wake an idle main loop
+wakeups         = 0       # Times main loop has woken from idle wait
+idleWall        = 0.0     # Total time spent in idle screen modes (sec)
+idleCpu         = 0.0     # CPU time used in idle screen modes (sec)
+previewFps      = 30      # Viewfinder frame rate (frames/sec)
+previewFrames   = None    # capture_continuous() generator while running
+fps             = 0.0     # Measured viewfinder frame rate
+fpsCount        = 0       # Frames since last FPS measurement
+fpsTime         = 0.0     # Time of last FPS measurement
+convertThreads  = 0       # YUV->RGB worker threads (0 = one per CPU core)
+previewRes      = (640, 480) # Viewfinder stream size in pre-shutter mode
+previewSize     = previewRes # Current viewfinder stream size
+previewRect     = (0, 0) + previewRes # Viewfinder crop within stream
 
 # To use Dropbox uploader, must have previously run the dropbox_uploader.sh
 # script to set up the app key and such.  If this was done as the normal pi
@@ -261,7 +538,7 @@ pathData = [
   '/boot/DCIM/CANON999', # Path for storeMode = 1 (Boot partition)
   '/home/pi/Photos']     # Path for storeMode = 2 (Dropbox)
 
-icons = [] # This list gets populated at startup
+icons = {} # This dict gets populated at startup (name -> Icon)
 
 # buttons[] is a list of lists; each top-level list element corresponds
 # to one screen mode (e.g. viewfinder, image playback, storage settings),
@@ -359,82 +636,154 @@ buttons = [
 def setFxMode(n):
 	global fxMode
 	fxMode = n
-	camera.image_effect = fxData[fxMode]
+	cfg.set(('image_effect', fxData[fxMode]))
 	buttons[6][5].setBg('fx-' + fxData[fxMode])
 
 def setIsoMode(n):
 	global isoMode
 	isoMode    = n
-	camera.ISO = isoData[isoMode][0]
+	cfg.set(('ISO', isoData[isoMode][0]))
 	buttons[7][5].setBg('iso-' + str(isoData[isoMode][0]))
 	buttons[7][7].rect = ((isoData[isoMode][1] - 10,) +
 	  buttons[7][7].rect[1:])
 
+def setBurstCount(n):
+	global burstCount
+	burstCount = n
+
+def setPreShutter(enable):
+	global zslEnabled
+	previewStop() # Restarted in new mode by main loop
+	zslEnabled = enable
+
+def setMotion(enable):
+	global motionEnabled
+	motionEnabled = enable
+	motion.reset()
+
+def setTimeLapse(interval):
+	global lapseInterval
+	lapseInterval = interval
+
+# Begin time-lapse capture at lapseInterval.  The viewfinder is paused
+# between shots (camera stays configured, so no restart per shot).
+def startTimeLapse():
+	previewStop()
+	lapse.start(lapseInterval, lapseOverrun, lapseAlign)
+
+# Take the time-lapse shot that's due (called from main loop)
+def takeTimeLapse():
+	global screenModePrior
+	t = monotonic()
+	takeStill(False)
+	lapse.taken(t)
+	screenModePrior = -1 # Force refresh to show the new shot
+
+# Current settings as a dictionary (rather than 'raw' values) so
+# the number & order of things can change without breaking.
+def settings():
+	return { 'fx'    : fxMode,
+	         'iso'   : isoMode,
+	         'size'  : sizeMode,
+	         'store' : storeMode,
+	         'burst' : burstCount,
+	         'zsl'   : zslEnabled,
+	         'lapse' : lapseInterval,
+	         'motion': motionEnabled }
+
+# Apply settings from dictionary d (any subset of settings())
+def applySettings(d):
+	if 'fx'    in d: setFxMode(   d['fx'])
+	if 'iso'   in d: setIsoMode(  d['iso'])
+	if 'size'  in d: sizeModeCallback( d['size'])
+	if 'store' in d: storeModeCallback(d['store'])
+	if 'burst' in d: setBurstCount(  d['burst'])
+	if 'zsl'   in d: setPreShutter(  d['zsl'])
+	if 'lapse' in d: setTimeLapse(   d['lapse'])
+	if 'motion'in d: setMotion(      d['motion'])
+
 def saveSettings():
 	try:
 	  outfile = open('cam.pkl', 'wb')
-	  # Use a dictionary (rather than pickling 'raw' values) so
-	  # the number & order of things can change without breaking.
-	  d = { 'fx'    : fxMode,
-	        'iso'   : isoMode,
-	        'size'  : sizeMode,
-	        'store' : storeMode }
-	  pickle.dump(d, outfile)
+	  pickle.dump(settings(), outfile)
 	  outfile.close()
-	except:
-	  pass
+	except (IOError, OSError, pickle.PicklingError) as e:
+	  print 'cam.pkl', e
 
 def loadSettings():
 	try:
 	  infile = open('cam.pkl', 'rb')
 	  d      = pickle.load(infile)
 	  infile.close()
-	  if 'fx'    in d: setFxMode(   d['fx'])
-	  if 'iso'   in d: setIsoMode(  d['iso'])
-	  if 'size'  in d: sizeModeCallback( d['size'])
-	  if 'store' in d: storeModeCallback(d['store'])
-	except:
-	  pass
+	  applySettings(d)
+	except (IOError, OSError, EOFError, ValueError, KeyError, IndexError,
+	  TypeError, pickle.UnpicklingError):
+	  pass # No saved settings (or unusable); keep defaults
 
-# Scan files in a directory, locating JPEGs with names matching the
-# software's convention (IMG_XXXX.JPG), returning a tuple with the
-# lowest and highest indices (or None if no matching files).
+# Return a tuple with the lowest and highest indices of images
+# (IMG_XXXX.JPG) in a directory, or None if there are none.
 def imgRange(path):
-	min = 9999
-	max = 0
-	try:
-	  for file in os.listdir(path):
-	    if fnmatch.fnmatch(file, 'IMG_[0-9][0-9][0-9][0-9].JPG'):
-	      i = int(file[4:8])
-	      if(i < min): min = i
-	      if(i > max): max = i
-	finally:
-	  return None if min > max else (min, max)
-
-# Busy indicator.  To use, run in separate thread, set global 'busy'
-# to False when done.
-def spinner():
-	global busy, screenMode, screenModePrior
-
-	buttons[screenMode][3].setBg('working')
-	buttons[screenMode][3].draw(screen)
-	pygame.display.update()
-
-	busy = True
-	n    = 0
-	while busy is True:
-	  buttons[screenMode][4].setBg('work-' + str(n))
-	  buttons[screenMode][4].draw(screen)
-	  pygame.display.update()
+	return imageIndex(path).range()
+
+# Pass touch at pos to the topmost Button there on the current screen
+def dispatch(pos):
+	b = buttonAt(buttons[screenMode], pos)
+	if b: b.select()
+
+# Wake main loop if it's idle-waiting for input (e.g. after a background
+# thread changes something that needs redrawing).  Safe from any thread.
+def wake():
+	if headless: control.wake() # Headless loop waits on control socket
+	else:        pygame.event.post(pygame.event.Event(WAKE))
+
+# Fraction of a CPU used while in idle (non-viewfinder) screen modes
+def idleLoad():
+	return idleCpu / idleWall if idleWall > 0.0 else 0.0
+
+# Busy indicator, animated by its own thread.  startSpinner() shows it and
+# returns a threading.Event; set that when done.  The caller doesn't wait
+# for the spinner to go (up to one animation step; nothing to hold up a
+# capture for).  Each spinner first waits for the previous one to clear,
+# so they can't overlap.
+spinThread = None
+
+def startSpinner():
+	global spinThread
+	done       = threading.Event()
+	spinThread = threading.Thread(target=spinner, args=(done, spinThread))
+	spinThread.daemon = True
+	spinThread.start()
+	return done
+
+def spinner(done, prior):
+	global screenModePrior
+
+	if prior: prior.join()
+	if done.is_set(): return # Finished before there was anything to show
+
+	t    = stats.start()
+	mode = screenMode
+	buttons[mode][3].setBg('working')
+	renderer.drawButton(buttons[mode][3])
+
+	n = 0
+	while True:
+	  buttons[mode][4].setBg('work-' + str(n))
+	  renderer.drawButton(buttons[mode][4])
 	  n = (n + 1) % 5
-	  time.sleep(0.15)
+	  if done.wait(0.15): break
 
-	buttons[screenMode][3].setBg(None)
-	buttons[screenMode][4].setBg(None)
+	buttons[mode][3].setBg(None)
+	buttons[mode][4].setBg(None)
 	screenModePrior = -1 # Force refresh
+	stats.end('spinner', t)
 
-def takePicture():
-	global busy, gid, loadIdx, saveIdx, scaled, sizeMode, storeMode, storeModePrior, uid
+# Make sure the current storage directory exists, then find the next n
+# free image indices (IMG_XXXX) there and reserve them in the index
+# (earlier shots may still be in the write queue, not on disk yet).
+# Returns list of indices, or None on error.
+def reserveSlots(n):
+	global gid, saveIdx, storeMode, storeModePrior, uid
 
 	if not os.path.isdir(pathData[storeMode]):
 	  try:
@@ -448,7 +797,7 @@ def takePicture():
 	  except OSError as e:
 	    # errno = 2 if can't create folder
 	    print errno.errorcode[e.errno]
-	    return
+	    return None
 
 	# If this is the first time accessing this directory,
 	# scan for the max image index, start at next pos.
@@ -461,96 +810,2253 @@ def takePicture():
 	    if saveIdx > 9999: saveIdx = 0
 	  storeModePrior = storeMode
 
-	# Scan for next available image slot
-	while True:
-	  filename = pathData[storeMode] + '/IMG_' + '%04d' % saveIdx + '.JPG'
-	  if not os.path.isfile(filename): break
-	  saveIdx += 1
-	  if saveIdx > 9999: saveIdx = 0
+	index = imageIndex(pathData[storeMode])
+	slots = []
+	while len(slots) < n:
+	  idx = index.free(saveIdx)
+	  if idx is None:
+	    print 'No free image slots in ' + pathData[storeMode]
+	    for idx in slots: index.remove(idx)
+	    return None
+	  index.add(idx)
+	  saveIdx = (idx + 1) % 10000
+	  # Without pyinotify, files added by other programs aren't in the
+	  # index; one stat() per slot keeps them from being overwritten.
+	  if not os.path.exists(pathData[storeMode] + '/IMG_' + '%04d' % idx +
+	    '.JPG'): slots.append(idx)
+	return slots
+
+# Returns list of image indices taken, or None on error
+def takePicture():
+	t = stats.start()
 
-	t = threading.Thread(target=spinner)
-	t.start()
+	if zslEnabled:
+	  slots = takePreShutter()
+	elif burstCount > 1:
+	  slots = takeBurst(burstCount)
+	else:
+	  slots = takeStill(not headless) # Headless: no one to show spinner to
 
-	scaled = None
-	camera.resolution = sizeData[sizeMode][0]
-	camera.crop       = sizeData[sizeMode][2]
-	try:
-	  camera.capture(filename, use_video_port=False, format='jpeg',
-	    thumbnail=None)
-	  # Set image file ownership to pi user, mode to 644
-	  # os.chown(filename, uid, gid) # Not working, why?
-	  os.chmod(filename,
-	    stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
-	  img    = pygame.image.load(filename)
-	  scaled = pygame.transform.scale(img, sizeData[sizeMode][1])
-	  if storeMode == 2: # Dropbox
-	    if upconfig:
-	      cmd = uploader + ' -f ' + upconfig + ' upload ' + filename + ' Photos/' + os.path.basename(filename)
-	    else:
-	      cmd = uploader + ' upload ' + filename + ' Photos/' + os.path.basename(filename)
-	    call ([cmd], shell=True)
+	stats.end('shutter', t)
+	if slots: stats.count('shots', len(slots))
+	return slots
+
+# Capture a single still through the still port, with busy indicator if
+# spin is set (not for unattended shots, e.g. time-lapse).
+def takeStill(spin):
+	global sizeMode, storeMode
 
+	slots = reserveSlots(1)
+	if slots is None: return None
+	n        = slots[0]
+	filename = pathData[storeMode] + '/IMG_' + '%04d' % n + '.JPG'
+	shot     = Shot(n, filename)
+
+	if spin: spin = startSpinner()
+	try:
+	  # Normally the camera is already at still resolution & crop (the
+	  # viewfinder is a resized video port stream), so nothing is written
+	  # and the pipeline isn't restarted.
+	  cfg.set(('resolution', sizeData[sizeMode][0]),
+	          ('crop'      , sizeData[sizeMode][2]))
+	  stream = io.BytesIO()
+	  # Embed a screen-sized EXIF thumbnail for quick review & playback
+	  camera.capture(stream, use_video_port=False, format='jpeg',
+	    thumbnail=sizeData[sizeMode][1] + (thumbQuality,))
+	  shot.data = stream.getvalue()
+	  stream.close()
+	finally:
+	  if spin: spin.set()
+
+	# The GPU encodes a screen-sized thumbnail from the same exposure
+	# into the in-memory JPEG; decoding just that (a few ms) gives the
+	# review image straight away, no waiting on the file write and no
+	# re-reading from disk.  (Headless, there's nothing to review on.)
+	reviewed = headless
+	thumb    = not headless and exifThumbnail(shot.data)
+	if thumb:
+	  img = pygame.image.load(io.BytesIO(thumb), 'THUMB.JPG')
+	  if img.get_size() == shot.size:
+	    pipeline.review(shot, img)
+	    reviewed = True
+
+	# Sensor readout is done; the rest happens in the background
+	# and the viewfinder resumes immediately.
+	pipeline.submit(shot, reviewed)
+	return slots
+
+# Capture n frames in quick succession through the video port at
+# burstRate frames/sec.  Frames go into a preallocated ring buffer in
+# memory and a writer thread drains it to the storage directory, while
+# the camera is free to continue.  Stats are left in lastBurst.
+def takeBurst(n):
+	global lastBurst, loadIdx, scaled, sizeMode, storeMode
+
+	slots = reserveSlots(n)
+	if slots is None: return None
+	names = [pathData[storeMode] + '/IMG_' + '%04d' % i + '.JPG'
+	         for i in slots]
+
+	spin = None if headless else startSpinner()
+
+	ring = lastBurst = BurstRing(burstSlots, burstSlotBytes)
+	w    = threading.Thread(target=ring.writer,
+	         args=(names, storeMode == 2))
+	w.daemon = True
+	w.start()
+	pipeline.bursts = [b for b in pipeline.bursts if b.is_alive()] + [w]
+
+	previewStop()
+	cfg.set(('resolution', sizeData[sizeMode][0]),
+	        ('crop'      , sizeData[sizeMode][2]),
+	        ('framerate' , burstRate))
+	frames = camera.capture_continuous(ring, format='jpeg',
+	  use_video_port=True)
+	try:
+	  for i in range(n):
+	    next(frames)
+	    ring.commit()
 	finally:
-	  # Add error handling/indicator (disk full, etc.)
-	  camera.resolution = sizeData[sizeMode][1]
-	  camera.crop       = (0.0, 0.0, 1.0, 1.0)
-
-	busy = False
-	t.join()
-
-	if scaled:
-	  if scaled.get_height() < 240: # Letterbox
-	    screen.fill(0)
-	  screen.blit(scaled,
-	    ((320 - scaled.get_width() ) / 2,
-	     (240 - scaled.get_height()) / 2))
-	  pygame.display.update()
-	  time.sleep(2.5)
-	  loadIdx = saveIdx
+	  frames.close()
+	  ring.close()
+	  # Release slots reserved for frames that weren't captured
+	  for i in slots[ring.frames:]:
+	    imageIndex(pathData[storeMode]).remove(i)
+	  if spin: spin.set()
+
+	scaled  = None # Playback will load from the files
+	loadIdx = slots[0]
+	return slots[:ring.frames]
+
+# Pre-shutter ('zero shutter lag') capture: rather than reconfigure the
+# camera and expose a new frame, save the buffered frame nearest the
+# moment of the tap (plus zslBefore/zslAfter neighbors, if set).
+# The viewfinder keeps running throughout.  Buffered frames are full
+# field of view at zslRes; the pipeline crops & scales them to the
+# sizeMode setting before writing (see CapturePipeline.encode()).  Without
+# PIL they're saved as they are, whatever sizeMode, and reviewed at
+# their own aspect ratio.
+def takePreShutter():
+	global storeMode
+	tap    = monotonic()
+	frames = zsl.pick(tap, zslBefore, zslAfter)
+	if not frames: return None
+	slots  = reserveSlots(len(frames))
+	if slots is None: return None
+	for idx, (t, data) in zip(slots, frames):
+	  shot      = Shot(idx, pathData[storeMode] + '/IMG_' + '%04d' % idx + '.JPG')
+	  shot.time = tap
+	  shot.data = data
+	  if Image: shot.crop = (sizeData[sizeMode][2], sizeData[sizeMode][0])
+	  else:     shot.size = fitSize(zslRes, shot.size)
+	  pipeline.submit(shot)
+	return slots
 
 def showNextImage(direction):
-	global busy, loadIdx
+	n = imageIndex(pathData[storeMode]).next(loadIdx, direction)
+	if n is not None: showImage(n, direction)
 
-	t = threading.Thread(target=spinner)
-	t.start()
+# Show image n.  If it can't be loaded (e.g. deleted or damaged by another
+# program), it's dropped from the index and the next image in 'direction'
+# is tried instead, ending in 'No Photos' mode if none are left.
+def showImage(n, direction=-1):
+	global loadIdx, scaled, screenMode, screenModePrior, sizeMode, storeMode
+
+	size  = sizeData[sizeMode][1]
+	index = imageIndex(pathData[storeMode])
+	start = stats.start()
 
-	n = loadIdx
 	while True:
-	  n += direction
-	  if(n > 9999): n = 0
-	  elif(n < 0):  n = 9999
-	  if os.path.exists(pathData[storeMode]+'/IMG_'+'%04d'%n+'.JPG'):
-	    showImage(n)
-	    break
+	  path = pathData[storeMode] + '/IMG_' + '%04d' % n + '.JPG'
+	  hit  = playCache.cached(path, size) # Already decoded; no spinner
+	  if not hit: spin = startSpinner()
+	  try:
+	    img = playCache.get(path, size)
+	  except (IOError, pygame.error) as e:
+	    print path, e
+	    img = None
+	  if not hit: spin.set()
+	  stats.count('show-hit' if hit else 'show-miss')
+	  if img is not None: break
+	  index.remove(n)
+	  playCache.discard(path)
+	  n = index.next(n, direction)
+	  if n is None: # Nothing left to show
+	    scaled          = None
+	    loadIdx         = -1
+	    screenMode      =  2 # 'No Photos'
+	    screenModePrior = -1
+	    return
 
-	busy = False
-	t.join()
+	scaled  = img
+	loadIdx = n
+	stats.end('show', start)
 
-def showImage(n):
-	global busy, loadIdx, scaled, screenMode, screenModePrior, sizeMode, storeMode
+	# Decode neighbors in background for quick next/prev
+	for d in (1, -1):
+	  i = index.next(n, d)
+	  if i is not None and i != n:
+	    playCache.prefetch(pathData[storeMode] + '/IMG_' + '%04d' % i + '.JPG',
+	      size)
 
-	t = threading.Thread(target=spinner)
-	t.start()
+	screenMode      =  0 # Photo playback
+	screenModePrior = -1 # Force screen refresh
 
-	img      = pygame.image.load(
-	            pathData[storeMode] + '/IMG_' + '%04d' % n + '.JPG')
-	scaled   = pygame.transform.scale(img, sizeData[sizeMode][1])
-	loadIdx  = n
 
-	busy = False
-	t.join()
+# Image index --------------------------------------------------------------
 
-	screenMode      =  0 # Photo playback
-	screenModePrior = -1 # Force screen refresh
+# ImageIndex keeps a sorted list of the image numbers (IMG_XXXX.JPG) in a
+# directory, scanned once and then updated as photos are taken & deleted,
+# so finding the image range, next/prev image or a free slot is a binary
+# search rather than a directory listing or thousands of stat() calls.
+# If pyinotify is installed, changes made by other programs (or a card
+# swap) are picked up too.  Use imageIndex(path) to get the (shared)
+# index for a path.
+
+imgPattern = re.compile('^IMG_([0-9]{4})\.JPG$')
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+class ImageIndex:
+
+	def __init__(self, path):
+	  self.path  = path
+	  self.lock  = threading.Lock()
+	  self.items = [] # Sorted image indices
+	  self.scan()
+	  self.watch()
+
+	def scan(self):
+	  items = []
+	  try:
+	    for file in os.listdir(self.path):
+	      m = imgPattern.match(file)
+	      if m: items.append(int(m.group(1)))
+	  except OSError:
+	    pass
+	  items.sort()
+	  with self.lock:
+	    self.items = items
+
+	def watch(self):
+	  if pyinotify is None: return
+	  index = self
+	  class Handler(pyinotify.ProcessEvent):
+	    def process_default(self, event):
+	      m = imgPattern.match(event.name)
+	      if m is None: return
+	      if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+	        index.remove(int(m.group(1)))
+	      else:
+	        index.add(int(m.group(1)))
+	  try:
+	    wm       = pyinotify.WatchManager()
+	    notifier = pyinotify.ThreadedNotifier(wm, Handler())
+	    notifier.daemon = True
+	    notifier.start()
+	    wm.add_watch(self.path, pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+	      pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+	  except (OSError, IOError, pyinotify.PyinotifyError):
+	    pass # Index still works, just not updated by other programs
+
+	def add(self, n):
+	  with self.lock:
+	    i = bisect.bisect_left(self.items, n)
+	    if i == len(self.items) or self.items[i] != n:
+	      self.items.insert(i, n)
+
+	def remove(self, n):
+	  with self.lock:
+	    i = bisect.bisect_left(self.items, n)
+	    if i < len(self.items) and self.items[i] == n:
+	      del self.items[i]
+
+	def __contains__(self, n):
+	  with self.lock:
+	    i = bisect.bisect_left(self.items, n)
+	    return i < len(self.items) and self.items[i] == n
+
+	def __len__(self):
+	  return len(self.items)
+
+	# (lowest, highest) index, or None if no images
+	def range(self):
+	  with self.lock:
+	    if not self.items: return None
+	    return (self.items[0], self.items[-1])
+
+	# Next image after n (direction = 1) or before it (-1), wrapping
+	# around; None if no images.  n itself needn't exist.
+	def next(self, n, direction):
+	  with self.lock:
+	    if not self.items: return None
+	    if direction > 0:
+	      i = bisect.bisect_right(self.items, n)
+	      return self.items[i] if i < len(self.items) else self.items[0]
+	    i = bisect.bisect_left(self.items, n)
+	    return self.items[i - 1] if i > 0 else self.items[-1]
+
+	# First unused index at or after n, wrapping from 9999 to 0;
+	# None if all 10000 are taken.
+	def free(self, n):
+	  with self.lock:
+	    items = self.items
+	    for start in (n, 0):
+	      i = bisect.bisect_left(items, start)
+	      if i == len(items) or items[i] != start: return start
+	      # items[i:] begins a run of consecutive indices; since
+	      # items[j] - j never decreases, binary search for its end.
+	      lo, hi = i, len(items) - 1
+	      while lo < hi:
+	        mid = (lo + hi + 1) / 2
+	        if items[mid] - mid == items[i] - i: lo = mid
+	        else:                                hi = mid - 1
+	      if items[lo] < 9999: return items[lo] + 1
+	    return None
+
+indexes = {} # ImageIndex objects, keyed by path
+
+def imageIndex(path):
+	index = indexes.get(path)
+	if index is None:
+	  index = indexes[path] = ImageIndex(path)
+	return index
+
+
+# JPEG decoding ------------------------------------------------------------
+
+# Photos are only ever shown at screen size, so rather than decode every
+# pixel of a multi-megapixel JPEG and scale it down, loadJPEG() uses the
+# screen-sized thumbnail that takePicture() embeds in the EXIF data.
+# For files without one (or with a tiny one, e.g. from other cameras),
+# PIL's draft mode is used if available, which has libjpeg decode at
+# 1/2, 1/4 or 1/8 scale in the IDCT.  Full decode is the last resort.
+
+try:
+  from PIL import Image
+except ImportError:
+  try:
+    import Image
+  except ImportError:
+    Image = None
+
+# Return embedded EXIF thumbnail JPEG (str) from JPEG data, or None.
+# Only the first 64K or so of the file is needed (APP1 segment size is
+# limited to that).
+def exifThumbnail(data):
+	try:
+	  if data[0:2] != '\xff\xd8': return None
+	  pos = 2
+	  while pos + 4 <= len(data) and data[pos] == '\xff':
+	    marker = ord(data[pos + 1])
+	    length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+	    if marker == 0xE1 and data[pos + 4:pos + 10] == 'Exif\0\0':
+	      tiff   = data[pos + 10:pos + 2 + length]
+	      endian = '<' if tiff[0:2] == 'II' else '>'
+	      # Skip IFD0 to get offset of IFD1 (thumbnail IFD)
+	      ifd    = struct.unpack(endian + 'I', tiff[4:8])[0]
+	      n      = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+	      ifd    = struct.unpack(endian + 'I',
+	                 tiff[ifd + 2 + n * 12:ifd + 6 + n * 12])[0]
+	      if ifd == 0: return None
+	      n      = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+	      offset = size = None
+	      for i in range(n):
+	        tag, type, count, value = struct.unpack(endian + 'HHII',
+	          tiff[ifd + 2 + i * 12:ifd + 14 + i * 12])
+	        if   tag == 0x0201: offset = value # JPEGInterchangeFormat
+	        elif tag == 0x0202: size   = value # ...Length
+	      if offset is None or not size: return None
+	      thumb = tiff[offset:offset + size]
+	      return thumb if len(thumb) == size else None
+	    if marker == 0xDA: break # Start of scan; no more headers
+	    pos += 2 + length
+	except struct.error:
+	  pass
+	return None
+
+# Load JPEG (from path, or str of JPEG data) as a Surface of given size
+def loadJPEG(src, size):
+	t   = stats.start()
+	img = decodeJPEG(src, size)
+	stats.end('decode', t)
+	return img
+
+def decodeJPEG(src, size):
+	if src[0:2] != '\xff\xd8': # Not JPEG data; treat as path
+	  path = src
+	  with open(path, 'rb') as f:
+	    head = f.read(65536 + 16)
+	else:
+	  path = None
+	  head = src
+
+	# Use EXIF thumbnail if it's at least half the display size
+	thumb = exifThumbnail(head)
+	if thumb:
+	  img = pygame.image.load(io.BytesIO(thumb), 'THUMB.JPG')
+	  if img.get_width() * 2 >= size[0] and img.get_height() * 2 >= size[1]:
+	    if img.get_size() == size: return img
+	    return pygame.transform.scale(img, size)
+
+	# Else DCT-domain downscaled decode, if PIL is available
+	if Image:
+	  try:
+	    im = Image.open(path if path else io.BytesIO(src))
+	    im.draft('RGB', size)
+	    im = im.convert('RGB')
+	    img = pygame.image.fromstring(
+	      im.tobytes() if hasattr(im, 'tobytes') else im.tostring(),
+	      im.size, 'RGB')
+	    return pygame.transform.scale(img, size)
+	  except IOError:
+	    pass
+
+	# Else full decode
+	img = pygame.image.load(path if path else io.BytesIO(src), 'IMG.JPG')
+	return pygame.transform.scale(img, size)
+
+# Crop JPEG data (str) to the crop window (fractions of width & height, as
+# in sizeData), scale to size and re-encode at the given quality.  Needs
+# PIL; pre-shutter frames (full field of view) go through this so they
+# match the viewfinder & size setting.
+def cropJPEG(data, crop, size, quality):
+	im = Image.open(io.BytesIO(data))
+	w, h = im.size
+	im = im.crop((int(crop[0] * w + 0.5), int(crop[1] * h + 0.5),
+	  int((crop[0] + crop[2]) * w + 0.5), int((crop[1] + crop[3]) * h + 0.5)))
+	out = io.BytesIO()
+	im.resize(size, Image.BILINEAR).save(out, 'JPEG', quality=quality)
+	return out.getvalue()
+
+# Largest size with the aspect ratio of src that fits within size
+def fitSize(src, size):
+	if src[0] * size[1] > src[1] * size[0]:
+	  return (size[0], max(1, src[1] * size[0] / src[0]))
+	return (max(1, src[0] * size[1] / src[1]), size[1])
+
+
+# Playback cache -----------------------------------------------------------
+
+# Decoding a full-size JPEG and scaling it to the screen takes seconds on
+# a Pi, so playback keeps recently shown images as screen-sized Surfaces
+# in a memory-bounded LRU cache, keyed by path, modification time (so an
+# edited or replaced file isn't shown stale) and display size.  While an
+# image is on screen, its neighbors are decoded by a background thread so
+# next/prev is usually a cache hit; only the latest few prefetch requests
+# are kept, so paging quickly past images doesn't queue up stale decodes.
+# hits, misses, bytes and hitRatio() are available for inspection.
+
+class PlaybackCache:
+
+	def __init__(self, maxBytes=8 * 1024 * 1024, depth=4):
+	  self.maxBytes = maxBytes
+	  self.bytes    = 0     # Current size of cached Surfaces
+	  self.hits     = 0
+	  self.misses   = 0
+	  self.items    = collections.OrderedDict() # key -> Surface, LRU first
+	  self.loading  = set() # Keys being decoded
+	  self.cond     = threading.Condition()
+	  self.queue    = collections.deque(maxlen=depth) # Prefetch requests
+	  t = threading.Thread(target=self.worker)
+	  t.daemon = True
+	  t.start()
+
+	def key(self, path, size):
+	  try:
+	    return (path, os.stat(path).st_mtime, size)
+	  except OSError:
+	    return None
+
+	# True if image at path is already decoded at this size (and current)
+	def cached(self, path, size):
+	  k = self.key(path, size)
+	  with self.cond:
+	    return k is not None and k in self.items
+
+	def hitRatio(self):
+	  n = self.hits + self.misses
+	  return float(self.hits) / n if n else 0.0
+
+	# Return screen-sized Surface for image at path, decoding if needed;
+	# None if there's no such file
+	def get(self, path, size):
+	  k = self.key(path, size)
+	  if k is None: return None
+	  with self.cond:
+	    while k in self.loading: # Being prefetched; wait for it
+	      self.cond.wait()
+	    img = self.items.pop(k, None)
+	    if img is not None:
+	      self.hits     += 1
+	      self.items[k]  = img # Move to most-recently-used end
+	      return img
+	    self.misses += 1
+	  img = self.load(path, size)
+	  self.insert(k, img)
+	  return img
+
+	# Decode image in background (oldest request dropped if queue's full)
+	def prefetch(self, path, size):
+	  with self.cond:
+	    self.queue.append((path, size))
+	    self.cond.notify_all()
+
+	# Remove all cached versions of path (e.g. file deleted)
+	def discard(self, path):
+	  with self.cond:
+	    for k in [k for k in self.items if k[0] == path]:
+	      self.evict(k)
+
+	def load(self, path, size):
+	  return loadJPEG(path, size)
+
+	def insert(self, k, img): # (Lock is re-entrant, may already be held)
+	  if k is None: return
+	  with self.cond:
+	    if k in self.items: self.evict(k)
+	    self.items[k] = img
+	    self.bytes   += img.get_pitch() * img.get_height()
+	    while self.bytes > self.maxBytes and len(self.items) > 1:
+	      self.evict(next(iter(self.items)))
+
+	def evict(self, k): # Call with lock held
+	  img         = self.items.pop(k)
+	  self.bytes -= img.get_pitch() * img.get_height()
+
+	def worker(self):
+	  while True:
+	    with self.cond:
+	      while not self.queue: self.cond.wait()
+	      path, size = self.queue.popleft()
+	    k = self.key(path, size)
+	    with self.cond:
+	      if k is None or k in self.items or k in self.loading: continue
+	      self.loading.add(k)
+	    img = None
+	    try:
+	      img = self.load(path, size)
+	    except Exception as e:
+	      print path, e
+	    with self.cond:
+	      if img is not None: self.insert(k, img)
+	      self.loading.discard(k)
+	      self.cond.notify_all()
+
+
+# Burst capture ------------------------------------------------------------
+
+# BurstRing is a fixed set of preallocated slot buffers used as a circular
+# queue between the camera (writing frames via the file-like write()
+# interface, then commit() at the end of each) and a writer thread saving
+# them to files.  Nothing is allocated per frame.  If all slots are full,
+# commit() blocks until the writer frees one; that's the point where
+# storage can't keep up, recorded in stalls and behindAt (frame number
+# of the first stall), so slot count can be sized for the card in use.
+
+class BurstRing:
+
+	def __init__(self, slots, slotBytes):
+	  self.slots     = [bytearray(slotBytes) for i in range(slots)]
+	  self.lengths   = [0] * slots
+	  self.head      = 0     # Slot being filled by camera
+	  self.tail      = 0     # Next slot for writer
+	  self.count     = 0     # Number of filled slots
+	  self.pos       = 0     # Write position within head slot
+	  self.overflow  = False # Current frame exceeded slot size
+	  self.closed    = False
+	  self.cond      = threading.Condition()
+	  self.frames    = 0     # Frames captured
+	  self.written   = 0     # Frames written to files
+	  self.dropped   = 0     # Frames too large for a slot
+	  self.stalls    = 0     # Times camera waited on writer
+	  self.behindAt  = None  # Frame number when writer first fell behind
+	  self.startTime = monotonic()
+	  self.lastFrame = self.startTime
+	  self.lastWrite = self.startTime
+
+	def write(self, data):
+	  slot = self.slots[self.head]
+	  n    = len(data)
+	  if self.pos + n > len(slot):
+	    self.overflow = True
+	    return n
+	  slot[self.pos:self.pos + n] = data
+	  self.pos += n
+	  return n
+
+	def flush(self):
+	  pass
+
+	# End of frame; hand slot to writer and wait for a free one
+	def commit(self):
+	  with self.cond:
+	    self.frames   += 1
+	    self.lastFrame = monotonic()
+	    if self.overflow:
+	      self.dropped += 1
+	    else:
+	      self.lengths[self.head] = self.pos
+	      self.head   = (self.head + 1) % len(self.slots)
+	      self.count += 1
+	      self.cond.notify_all()
+	    self.pos      = 0
+	    self.overflow = False
+	    if self.count == len(self.slots):
+	      self.stalls += 1
+	      if self.behindAt is None: self.behindAt = self.frames
+	      while self.count == len(self.slots):
+	        self.cond.wait()
+
+	def close(self):
+	  with self.cond:
+	    self.closed = True
+	    self.cond.notify_all()
+
+	# Sustained capture and write rates (frames/sec)
+	def captureFps(self):
+	  t = self.lastFrame - self.startTime
+	  return self.frames / t if t > 0 else 0.0
+
+	def writeFps(self):
+	  t = self.lastWrite - self.startTime
+	  return self.written / t if t > 0 else 0.0
+
+	# Summary for stats displays (overlay, control socket)
+	def stats(self):
+	  return { 'frames'    : self.frames,
+	           'written'   : self.written,
+	           'dropped'   : self.dropped,
+	           'stalls'    : self.stalls,
+	           'behindAt'  : self.behindAt,
+	           'captureFps': self.captureFps(),
+	           'writeFps'  : self.writeFps() }
+
+	# Writer thread: save each committed frame to the next filename,
+	# queueing it for upload if requested (Dropbox mode)
+	def writer(self, names, upload=False):
+	  names = list(names)
+	  store = None
+	  while True:
+	    with self.cond:
+	      while self.count == 0 and not self.closed:
+	        self.cond.wait()
+	      if self.count == 0: break
+	      i = self.tail
+	    if names:
+	      filename = names.pop(0)
+	      store    = storage(os.path.dirname(filename))
+	      store.write(filename, buffer(self.slots[i], 0, self.lengths[i]),
+	        self.saved, (filename, upload))
+	    with self.cond:
+	      self.tail       = (self.tail + 1) % len(self.slots)
+	      self.count     -= 1
+	      self.written   += 1
+	      self.lastWrite  = monotonic()
+	      self.cond.notify_all()
+	  if store: store.flush() # Rest of batch, if syncMode is 'batch'
+	  # Frames dropped for size leave reserved slots unused; release them
+	  for filename in names:
+	    imageIndex(os.path.dirname(filename)).remove(int(filename[-8:-4]))
+
+	# Storage callback, once a frame's file is in place (or failed)
+	def saved(self, arg, error):
+	  filename, upload = arg
+	  if error:
+	    print filename, error
+	    imageIndex(os.path.dirname(filename)).remove(int(filename[-8:-4]))
+	  elif upload:
+	    uploads.add(filename)
+
+
+# Pre-shutter buffer -------------------------------------------------------
+
+# PreShutter keeps JPEG frames from a second video port splitter output in
+# a circular buffer, newest last, dropping the oldest when the total size
+# exceeds maxBytes.  Memory use is thus bounded regardless of resolution
+# or quality (zslRes, zslQuality); higher settings just mean fewer frames
+# (less time) in the buffer.  Shutter lag (buffered frame time minus tap
+# time; negative means the frame predates the tap) is kept in lags.
+
+class PreShutter:
+
+	def __init__(self, maxBytes, quality, port=1, window=50):
+	  self.maxBytes = maxBytes
+	  self.quality  = quality
+	  self.port     = port # Video port splitter output used
+	  self.frames   = collections.deque() # (monotonic time, JPEG data)
+	  self.bytes    = 0
+	  self.cond     = threading.Condition()
+	  self.thread   = None
+	  self.running  = False
+	  self.lags     = collections.deque(maxlen=window)
+
+	def start(self):
+	  if self.thread is None:
+	    self.running = True
+	    self.thread  = threading.Thread(target=self.run)
+	    self.thread.daemon = True
+	    self.thread.start()
+
+	def stop(self):
+	  if self.thread is not None:
+	    self.running = False
+	    self.thread.join()
+	    self.thread = None
+	    with self.cond:
+	      self.frames.clear()
+	      self.bytes = 0
+
+	def run(self):
+	  stream = io.BytesIO()
+	  frames = camera.capture_continuous(stream, format='jpeg',
+	    use_video_port=True, splitter_port=self.port, quality=self.quality)
+	  try:
+	    for foo in frames:
+	      t    = monotonic()
+	      data = stream.getvalue()
+	      stream.seek(0)
+	      stream.truncate()
+	      with self.cond:
+	        self.frames.append((t, data))
+	        self.bytes += len(data)
+	        while self.bytes > self.maxBytes and len(self.frames) > 1:
+	          self.bytes -= len(self.frames.popleft()[1])
+	        self.cond.notify_all()
+	      if not self.running: break
+	  finally:
+	    frames.close()
+
+	# Return list of (time, data) for the frame nearest time t plus
+	# 'before' frames preceding and 'after' frames following it
+	# (waiting up to 'timeout' seconds for the latter to arrive).
+	def pick(self, t, before=0, after=0, timeout=2.0):
+	  with self.cond:
+	    if not self.frames: return []
+	    frames = list(self.frames)
+	    i      = min(range(len(frames)), key=lambda i: abs(frames[i][0] - t))
+	    end    = monotonic() + timeout
+	    while (len(frames) - 1 - i < after and self.running and
+	           monotonic() < end):
+	      self.cond.wait(end - monotonic())
+	      frames = list(self.frames)
+	      # Oldest frames may have been evicted meanwhile
+	      i      = min(range(len(frames)), key=lambda i: abs(frames[i][0] - t))
+	    self.lags.append(frames[i][0] - t)
+	    return frames[max(i - before, 0):i + after + 1]
+
+	# Returns (count, mean, min, max) shutter lag over recent shots
+	def lagStats(self):
+	  if not self.lags: return (0, 0.0, 0.0, 0.0)
+	  return (len(self.lags), sum(self.lags) / len(self.lags),
+	    min(self.lags), max(self.lags))
+
+
+# Capture pipeline ---------------------------------------------------------
+
+# takePicture() only does the part that needs the camera: switching to
+# still resolution and reading out the JPEG into memory.  Everything after
+# that runs on worker threads, connected by bounded queues (a full queue
+# blocks the shutter, rather than letting memory use grow unchecked):
+#
+#   shutter -+-> [encode: crop & scale, pre-shutter frames only] ->
+#            +-> storage write-behind buffer (see Storage, below)
+#            |     -> upload queue (Dropbox mode only)
+#            +-> thumbnail (post-shot review, if there's no usable
+#                           embedded thumbnail to show immediately)
+#
+# Each stage's service time, plus end-to-end shot time and shot-to-shot
+# interval, is kept in a rolling window for inspection via stats().
+
+# Monotonic clock for timing; Python 2 has no time.monotonic(), so
+# clock_gettime(CLOCK_MONOTONIC) is called directly if available.
+class timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+  librt = ctypes.CDLL('librt.so.1', use_errno=True)
+  librt.clock_gettime
+except (OSError, AttributeError):
+  librt = None
+
+def monotonic():
+	if librt is None: return time.time()
+	t = timespec()
+	librt.clock_gettime(1, ctypes.byref(t)) # 1 = CLOCK_MONOTONIC
+	return t.tv_sec + t.tv_nsec * 1e-9
+
+# A Shot carries one photo through the pipeline
+class Shot:
+
+	def __init__(self, idx, filename):
+	  self.idx      = idx          # Image index (IMG_XXXX)
+	  self.filename = filename     # Full output path
+	  self.data     = None         # JPEG data (str)
+	  self.size     = sizeData[sizeMode][1] # Review image size
+	  self.store    = storeMode    # Storage mode at time of capture
+	  self.time     = monotonic()  # Shutter time
+	  self.pending  = 1            # Stages left (write, + thumb if used)
+	  self.crop     = None         # (crop window, size) to apply, if any
+
+class CapturePipeline:
+
+	def __init__(self, depth=4, window=50):
+	  self.encodeQ  = Queue.Queue(depth)
+	  self.thumbQ   = Queue.Queue(depth)
+	  self.window   = window
+	  self.times    = {}   # Stage name -> deque of recent times (sec)
+	  self.lock     = threading.Lock()
+	  self.lastShot = None # Shutter time of previous shot
+	  self.bursts   = []   # BurstRing writer threads (see takeBurst())
+	  self.reviewed = None # (Shot, Surface) awaiting showReview()
+	  for target, q in ((self.encode, self.encodeQ),
+	                    (self.thumb , self.thumbQ)):
+	    t = threading.Thread(target=self.worker, args=(target, q))
+	    t.daemon = True
+	    t.start()
+
+	def record(self, stage, t):
+	  with self.lock:
+	    d = self.times.get(stage)
+	    if d is None:
+	      d = self.times[stage] = collections.deque(maxlen=self.window)
+	    d.append(t)
+	  stats.record('pipe-' + stage, t)
+
+	# Returns dict of stage -> (count, mean, max) over the rolling window
+	def stats(self):
+	  with self.lock:
+	    return dict((k, (len(d), sum(d) / len(d), max(d)))
+	      for k, d in self.times.iteritems() if d)
+
+	# Hand off a captured shot.  If the review image was already made
+	# from the embedded thumbnail (see takePicture()), only the write
+	# remains; else the thumbnail stage decodes one in the background.
+	def submit(self, shot, reviewed=False):
+	  if self.lastShot is not None:
+	    self.record('shot-to-shot', shot.time - self.lastShot)
+	  self.lastShot = shot.time
+	  self.record('capture', monotonic() - shot.time)
+	  if not reviewed: shot.pending += 1
+	  if shot.crop: self.encodeQ.put(shot) # Stored once cropped
+	  else:         self.store(shot, reviewed)
+
+	def store(self, shot, reviewed=False):
+	  t = monotonic()
+	  storage(os.path.dirname(shot.filename)).put(shot.filename, shot.data,
+	    self.written, shot)
+	  self.record('write-wait', monotonic() - t) # Backpressure, if any
+	  if not reviewed: self.thumbQ.put(shot)
+
+	# Crop & scale a pre-shutter frame to its size setting, then store it
+	# (as it was, if that fails, rather than lose the shot)
+	def encode(self, shot):
+	  try:
+	    shot.data = cropJPEG(shot.data, shot.crop[0], shot.crop[1],
+	      zslQuality)
+	  except (IOError, ValueError) as e:
+	    print shot.filename, e
+	    shot.size = fitSize(zslRes, shot.size)
+	  self.store(shot)
+
+	# Offer img as the post-shot review of shot (from any thread).  It's
+	# put on screen by the main loop (showReview()), and only if that's
+	# still the viewfinder, so a late review can't replace the image being
+	# played back (which delete would then act on).
+	def review(self, shot, img):
+	  with self.lock:
+	    self.reviewed = (shot, img)
+	  self.record('shot-to-review', monotonic() - shot.time)
+	  wake()
+
+	# Show pending review image, if any (main loop)
+	def showReview(self):
+	  global loadIdx, reviewUntil, scaled, screenModePrior
+	  with self.lock:
+	    r, self.reviewed = self.reviewed, None
+	  if r is None or screenMode != 3: return
+	  scaled          = r[1]
+	  loadIdx         = r[0].idx
+	  reviewUntil     = monotonic() + reviewTime
+	  screenModePrior = -1 # Refresh (viewfinder may be paused, e.g. lapse)
+
+	# Block until all queued shots have been fully processed.
+	# (Pending uploads are journaled and needn't be waited on.)
+	def drain(self):
+	  for t in self.bursts: t.join()
+	  self.bursts = []
+	  self.encodeQ.join()
+	  for s in stores.values(): s.drain()
+	  self.thumbQ.join()
+
+	def worker(self, target, q):
+	  while True:
+	    shot = q.get()
+	    t    = monotonic()
+	    try:
+	      target(shot)
+	    except Exception as e:
+	      print shot.filename, e
+	    self.record(target.__name__, monotonic() - t)
+	    q.task_done()
+
+	def done(self, shot): # Called as each of write (& thumb) finish
+	  with self.lock:
+	    shot.pending -= 1
+	    last          = shot.pending == 0
+	  if last:
+	    shot.data = None # Release JPEG data
+	    self.record('total', monotonic() - shot.time)
+
+	# Storage callback, once the shot's file is in place (or failed)
+	def written(self, shot, error):
+	  if error:
+	    print shot.filename, error
+	    # Release the slot reserved in takePicture()
+	    imageIndex(os.path.dirname(shot.filename)).remove(shot.idx)
+	  else:
+	    self.record('shot-to-disk', monotonic() - shot.time)
+	    if shot.store == 2: # Dropbox
+	      uploads.add(shot.filename)
+	  self.done(shot)
+
+	def thumb(self, shot):
+	  try:
+	    self.review(shot, loadJPEG(shot.data, shot.size))
+	  finally:
+	    self.done(shot)
+
+
+# Storage ------------------------------------------------------------------
+
+# Photos are never written in place.  Data goes to a hidden temp file
+# (.IMG_XXXX.JPG.tmp) that's renamed to its final name only once it's
+# complete, so a crash or pulled card never leaves a partial IMG_XXXX.JPG
+# for the image index to count (stray temp files are deleted at startup).
+# syncMode sets durability: 'shot' fsyncs each file before it's renamed
+# into place, 'batch' fsyncs & renames files syncBatch at a time (or
+# sooner, whenever the queue empties) and 'none' leaves it to the OS.
+# put() queues data in a write-behind buffer of up to maxBytes, drained
+# by a writer thread, so slow media (FAT /boot partition) don't stall the
+# shutter; once full, put() blocks until there's room (backpressure).
+# There's one Storage per directory (target), see storage(), each keeping
+# its own stats: files, bytes, busyTime, stalls & stallTime (time put()
+# spent blocked) and latency (queued to in place, recent files).
+
+tmpPattern = re.compile('^\.IMG_[0-9]{4}\.JPG\.tmp$')
+
+class Storage:
+
+	def __init__(self, path, maxBytes, window=50):
+	  self.path      = path
+	  self.maxBytes  = maxBytes
+	  self.queue     = collections.deque() # (filename, data, cb, arg, time)
+	  self.queued    = 0     # Bytes in queue
+	  self.cond      = threading.Condition()
+	  self.lock      = threading.Lock() # Serializes writes and commits
+	  self.batch     = []    # Written but not yet in place (see commit())
+	  self.files     = 0     # Files put in place
+	  self.bytes     = 0     # Bytes written
+	  self.failures  = 0     # Failed writes
+	  self.syncs     = 0     # Commits with fsync
+	  self.busyTime  = 0.0   # Time spent writing & syncing (sec)
+	  self.stalls    = 0     # Times put() blocked on a full buffer
+	  self.stallTime = 0.0   # Total time put() blocked (sec)
+	  self.latency   = collections.deque(maxlen=window)
+	  try:
+	    for name in os.listdir(path):
+	      if tmpPattern.match(name): os.remove(os.path.join(path, name))
+	  except OSError:
+	    pass
+	  t = threading.Thread(target=self.run)
+	  t.daemon = True
+	  t.start()
+
+	# Queue data (str or buffer) for writing to filename; callback(arg,
+	# error) is called from the writer thread once the file is in place
+	# (error None) or has failed.  Blocks while the buffer is full.
+	def put(self, filename, data, callback=None, arg=None):
+	  with self.cond:
+	    # An oversize item is still accepted once the buffer is empty
+	    if self.queued and self.queued + len(data) > self.maxBytes:
+	      t            = monotonic()
+	      self.stalls += 1
+	      while self.queued and self.queued + len(data) > self.maxBytes:
+	        self.cond.wait()
+	      self.stallTime += monotonic() - t
+	    self.queue.append((filename, data, callback, arg, monotonic()))
+	    self.queued += len(data)
+	    self.cond.notify_all()
+
+	# Write data to filename in the calling thread (e.g. a burst writer,
+	# which is already write-behind), callback as for put().  In 'batch'
+	# mode the file isn't in place until a batch fills or flush().
+	def write(self, filename, data, callback=None, arg=None, since=None):
+	  with self.lock:
+	    t   = monotonic()
+	    tmp = os.path.join(os.path.dirname(filename),
+	      '.' + os.path.basename(filename) + '.tmp')
+	    try:
+	      f = open(tmp, 'wb')
+	      try:
+	        f.write(data)
+	        if syncMode == 'shot':
+	          f.flush()
+	          os.fsync(f.fileno())
+	        # Set image file ownership to pi user, mode to 644
+	        # os.chown(filename, uid, gid) # Not working, why?
+	        os.chmod(tmp,
+	          stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+	      except (IOError, OSError):
+	        f.close()
+	        os.remove(tmp)
+	        raise
+	    except (IOError, OSError) as e:
+	      self.failures += 1
+	      self.busyTime += monotonic() - t
+	      if callback: callback(arg, e)
+	      return
+	    self.bytes    += len(data)
+	    self.busyTime += monotonic() - t
+	    self.batch.append((f, tmp, filename, callback, arg, since or t))
+	    if syncMode != 'batch' or len(self.batch) >= syncBatch:
+	      self.commit()
+
+	# Put any written files of a partial batch in place
+	def flush(self):
+	  with self.lock:
+	    if self.batch: self.commit()
+
+	# Sync (per syncMode) and rename written files into place, then sync
+	# the directory so the renames are durable too.  Lock must be held.
+	def commit(self):
+	  t    = monotonic()
+	  done = []
+	  for f, tmp, filename, callback, arg, since in self.batch:
+	    try:
+	      try:
+	        if syncMode == 'batch':
+	          f.flush()
+	          os.fsync(f.fileno())
+	      finally:
+	        f.close()
+	      os.rename(tmp, filename)
+	      done.append((callback, arg, None, since))
+	    except (IOError, OSError) as e:
+	      self.failures += 1
+	      try:
+	        os.remove(tmp)
+	      except OSError:
+	        pass
+	      done.append((callback, arg, e, since))
+	  self.batch = []
+	  if syncMode != 'none':
+	    try:
+	      fd = os.open(self.path, os.O_RDONLY)
+	      try:
+	        os.fsync(fd)
+	      finally:
+	        os.close(fd)
+	    except OSError:
+	      pass # Directory fsync unsupported on some filesystems
+	    self.syncs += 1
+	  now            = monotonic()
+	  self.busyTime += now - t
+	  for callback, arg, e, since in done:
+	    if e is None:
+	      self.files += 1
+	      self.latency.append(now - since)
+	    if callback: callback(arg, e)
+
+	# Block until everything queued is written and in place
+	def drain(self):
+	  with self.cond:
+	    while self.queue: self.cond.wait()
+
+	def run(self):
+	  while True:
+	    with self.cond:
+	      while not self.queue: self.cond.wait()
+	      filename, data, callback, arg, since = self.queue[0]
+	    self.write(filename, data, callback, arg, since)
+	    with self.cond:
+	      last = len(self.queue) == 1
+	    if last: self.flush() # Don't hold a partial batch while idle
+	    # Item stays queued (counting against maxBytes and holding off
+	    # drain()) until it's written and, if last, in place
+	    with self.cond:
+	      self.queue.popleft()
+	      self.queued -= len(data)
+	      self.cond.notify_all()
+
+	def depth(self):
+	  with self.cond:
+	    return len(self.queue), self.queued
+
+	# Write throughput while busy (bytes/sec)
+	def throughput(self):
+	  return self.bytes / self.busyTime if self.busyTime > 0.0 else 0.0
+
+	# Returns (count, mean, max) of recent queued-to-in-place times (sec)
+	def latencyStats(self):
+	  with self.lock:
+	    l = list(self.latency)
+	  if not l: return (0, 0.0, 0.0)
+	  return (len(l), sum(l) / len(l), max(l))
+
+stores     = {} # Storage objects, keyed by path
+storesLock = threading.Lock()
+
+def storage(path):
+	with storesLock:
+	  s = stores.get(path)
+	  if s is None:
+	    s = stores[path] = Storage(path, writeBuffer)
+	  return s
+
+
+# Dropbox upload queue -----------------------------------------------------
+
+# Files to upload are recorded in an on-disk journal (one path per line,
+# rewritten atomically on each change) so nothing is lost to a failed
+# upload, crash or restart; pending entries are reloaded at startup.
+# A small pool of worker threads runs the uploader script, each call
+# sending a batch of up to 'batch' files.  A failed batch is retried with
+# exponential backoff.  The uploader is any script accepting the
+# dropbox_uploader.sh command line ([-f config] upload FILE... DEST/), so
+# a local stand-in can be substituted for testing (bench/uploader.py, as
+# used by bench/upload.py).
+
+class UploadQueue:
+
+	def __init__(self, journal, workers=2, batch=8,
+	  retryMin=5.0, retryMax=600.0):
+	  self.journal  = journal
+	  self.batch    = batch
+	  self.retryMin = retryMin # Backoff after first failure (sec)
+	  self.retryMax = retryMax # Backoff ceiling (sec)
+	  self.pending  = collections.OrderedDict() # path -> [tries, notBefore]
+	  self.active   = set()    # Paths currently being uploaded
+	  self.cond     = threading.Condition()
+	  self.sent     = 0        # Files uploaded
+	  self.bytes    = 0        # Bytes uploaded
+	  self.failures = 0        # Failed uploader invocations
+	  self.busyTime = 0.0      # Total time spent in uploader (sec)
+	  try:
+	    with open(journal) as f:
+	      for line in f:
+	        path = line.rstrip('\n')
+	        if path: self.pending[path] = [0, 0.0]
+	  except IOError:
+	    pass
+	  for i in range(workers):
+	    t = threading.Thread(target=self.worker)
+	    t.daemon = True
+	    t.start()
+
+	def add(self, path):
+	  with self.cond:
+	    self.pending[path] = [0, 0.0]
+	    self.save()
+	    self.cond.notify()
+
+	# Number of files not yet uploaded (including any in progress)
+	def depth(self):
+	  with self.cond:
+	    return len(self.pending)
+
+	# Returns (files/sec, bytes/sec) while uploading
+	def throughput(self):
+	  with self.cond:
+	    if self.busyTime <= 0.0: return (0.0, 0.0)
+	    return (self.sent / self.busyTime, self.bytes / self.busyTime)
+
+	def save(self): # Call with lock held
+	  tmp = self.journal + '.tmp'
+	  try:
+	    with open(tmp, 'w') as f:
+	      for path in self.pending:
+	        f.write(path + '\n')
+	      f.flush()
+	      os.fsync(f.fileno())
+	    os.rename(tmp, self.journal)
+	  except (IOError, OSError) as e:
+	    print self.journal, e
+
+	# Wait for and claim a batch of paths that are due for upload
+	def take(self):
+	  with self.cond:
+	    while True:
+	      now   = monotonic()
+	      batch = []
+	      wait  = None
+	      for path, (tries, notBefore) in self.pending.iteritems():
+	        if path in self.active: continue
+	        if notBefore <= now:
+	          batch.append(path)
+	          if len(batch) >= self.batch: break
+	        elif wait is None or notBefore - now < wait:
+	          wait = notBefore - now
+	      if batch:
+	        self.active.update(batch)
+	        return batch
+	      self.cond.wait(wait)
+
+	def drop(self, batch):
+	  with self.cond:
+	    self.active.difference_update(batch)
+	    for path in batch:
+	      del self.pending[path]
+	    self.save()
+
+	def finish(self, batch, ok, elapsed):
+	  with self.cond:
+	    self.active.difference_update(batch)
+	    self.busyTime += elapsed
+	    if ok:
+	      for path in batch:
+	        del self.pending[path]
+	        self.sent += 1
+	        try:    self.bytes += os.path.getsize(path)
+	        except OSError: pass # Deleted since
+	      self.save()
+	    else:
+	      self.failures += 1
+	      now = monotonic()
+	      for path in batch:
+	        e     = self.pending[path]
+	        e[0] += 1
+	        e[1]  = now + min(self.retryMin * (2 ** (e[0] - 1)), self.retryMax)
+	    self.cond.notify_all()
+
+	def worker(self):
+	  while True:
+	    batch = self.take()
+	    # Files deleted before upload are simply dropped
+	    gone  = [p for p in batch if not os.path.exists(p)]
+	    if gone: self.drop(gone)
+	    batch = [p for p in batch if p not in gone]
+	    if not batch: continue
+	    cmd = [uploader]
+	    if upconfig: cmd += ['-f', upconfig]
+	    cmd += ['upload'] + batch + ['Photos/']
+	    t = monotonic()
+	    try:
+	      ok = call(cmd) == 0
+	    except OSError as e:
+	      print uploader, e
+	      ok = False
+	    t = monotonic() - t
+	    stats.record('upload', t)
+	    stats.count('uploaded' if ok else 'upload-failed', len(batch))
+	    self.finish(batch, ok, t)
+
+# Time-lapse ---------------------------------------------------------------
+
+# TimeLapse schedules unattended shots every 'interval' seconds.  Deadlines
+# are computed from the start time (t0 + k * interval, monotonic clock),
+# not from the previous shot, so late shots don't accumulate drift; with
+# align set, the first shot is on a multiple of the interval in wall clock
+# time (e.g. on the minute for 60 sec).  A small thread sleeps until each
+# deadline and wakes the main loop, which takes the shot and calls
+# taken().  If a capture overruns past following deadline(s), those shots
+# are skipped ('skip', counted in missed) or taken late, back to back
+# ('queue', up to maxQueue behind; beyond that they're missed too).
+# jitter holds recent shot start times relative to their deadlines;
+# stats() gives counts & jitterStats() for the stats request and dump.
+
+class TimeLapse:
+
+	def __init__(self, maxQueue=3, window=100):
+	  self.maxQueue = maxQueue
+	  self.cond     = threading.Condition()
+	  self.running  = False
+	  self.thread   = None
+	  self.interval = 0.0
+	  self.overrun  = 'skip'
+	  self.t0       = 0.0 # monotonic() time of first deadline
+	  self.k        = 0   # Index of next deadline
+	  self.shots    = 0   # Shots taken
+	  self.missed   = 0   # Deadlines skipped due to overrun
+	  self.late     = 0   # Shots taken late due to overrun ('queue')
+	  self.jitter   = collections.deque(maxlen=window) # Sec after deadline
+
+	def start(self, interval, overrun='skip', align=True):
+	  self.stop()
+	  with self.cond:
+	    self.interval = float(interval)
+	    self.overrun  = overrun
+	    self.t0       = monotonic()
+	    if align: self.t0 += -time.time() % self.interval
+	    self.k        = 0
+	    self.shots    = 0
+	    self.missed   = 0
+	    self.late     = 0
+	    self.jitter.clear()
+	    self.running  = True
+	  self.thread = threading.Thread(target=self.run)
+	  self.thread.daemon = True
+	  self.thread.start()
+
+	def stop(self):
+	  with self.cond:
+	    self.running = False
+	    self.cond.notify_all()
+	  if self.thread:
+	    self.thread.join()
+	    self.thread = None
+
+	def deadline(self):
+	  return self.t0 + self.k * self.interval
+
+	# Is a shot due now?
+	def due(self):
+	  return self.running and monotonic() >= self.deadline()
+
+	# Seconds until next shot (None if not running)
+	def timeUntil(self):
+	  if not self.running: return None
+	  return max(0.0, self.deadline() - monotonic())
+
+	# Record shot for current deadline (started at monotonic time t),
+	# advance to next deadline, handling any overrun.
+	def taken(self, t):
+	  with self.cond:
+	    self.jitter.append(t - self.deadline())
+	    self.shots += 1
+	    self.k     += 1
+	    behind = int((monotonic() - self.deadline()) // self.interval) + 1
+	    if behind > 0: # Capture ran past the next deadline(s)
+	      if self.overrun == 'queue':
+	        self.late += 1
+	        skip       = max(0, behind - self.maxQueue)
+	      else:
+	        skip       = behind
+	      self.missed += skip
+	      self.k      += skip
+	    self.cond.notify_all()
+
+	# Returns (mean, max, standard deviation) of recent jitter (sec)
+	def jitterStats(self):
+	  with self.cond:
+	    j = list(self.jitter)
+	  if not j: return (0.0, 0.0, 0.0)
+	  m = sum(j) / len(j)
+	  return (m, max(j), (sum((x - m) ** 2 for x in j) / len(j)) ** 0.5)
+
+	# Returns dict of schedule & counts, for the stats request & dump
+	def stats(self):
+	  with self.cond:
+	    s = { 'running' : self.running,
+	          'interval': self.interval,
+	          'shots'   : self.shots,
+	          'missed'  : self.missed,
+	          'late'    : self.late }
+	  s['jitter'] = self.jitterStats()
+	  return s
+
+	# Scheduler thread: sleep until the pending deadline, wake the main
+	# loop, then wait for it to take the shot (or for stop()).
+	def run(self):
+	  k = None
+	  while True:
+	    with self.cond:
+	      while self.running and self.k == k: self.cond.wait()
+	      if not self.running: return
+	      k = self.k
+	      t = self.deadline()
+	    # Sleep in short steps so stop() isn't held up by long intervals
+	    d = t - monotonic()
+	    while d > 0 and self.running:
+	      time.sleep(min(d, 0.25))
+	      d = t - monotonic()
+	    if self.running: wake()
+
+
+# Motion trigger -----------------------------------------------------------
+
+# MotionTrigger watches viewfinder frames for movement.  The Y plane of
+# each frame is reduced to factor x factor pixel cells and compared with
+# a running background model by yuv2rgb.luma_motion() (in C, no RGB
+# conversion; well under a millisecond per frame), and update() returns
+# True when more than 'area' (fraction) of the cells within region
+# (normalized x, y, w, h) differ by more than threshold (luma levels).
+# The first few frames after the viewfinder (re)starts only train the
+# background while exposure settles, and after a trigger there's a hold
+# time before the next.  frames, triggers and fps() (frames processed per
+# second of time spent in update()) are kept for tuning.
+
+class MotionTrigger:
+
+	def __init__(self, factor=8, threshold=24, area=0.02,
+	  region=(0.0, 0.0, 1.0, 1.0), shift=4, settle=5, hold=2.0):
+	  self.factor    = factor
+	  self.threshold = threshold
+	  self.area      = area
+	  self.region    = region
+	  self.shift     = shift  # Background adapts by 1/2^shift per frame
+	  self.settle    = settle # Frames to train before triggering
+	  self.hold      = hold   # Min seconds between triggers
+	  self.size      = None   # Frame size bg was made for
+	  self.bg        = None   # Background, 8.8 fixed point per cell
+	  self.cells     = None   # Region in cells
+	  self.limit     = 0      # Changed cell count that triggers
+	  self.wait      = 0      # Frames left to settle
+	  self.until     = 0.0    # monotonic() time hold ends
+	  self.frames    = 0
+	  self.triggers  = 0
+	  self.busyTime  = 0.0
+
+	# Discard background (e.g. viewfinder restarted or reconfigured)
+	def reset(self):
+	  self.size = None
+
+	def update(self, yuv, size):
+	  t = monotonic()
+	  if size != self.size:
+	    w, h       = size[0] / self.factor, size[1] / self.factor
+	    x, y       = int(self.region[0] * w), int(self.region[1] * h)
+	    self.cells = (x, y,
+	      max(1, min(int(self.region[2] * w + 0.5), w - x)),
+	      max(1, min(int(self.region[3] * h + 0.5), h - y)))
+	    self.limit = int(self.area * self.cells[2] * self.cells[3])
+	    self.bg    = bytearray(w * h * 2)
+	    self.size  = size
+	    self.wait  = self.settle
+	    shift      = 0 # Background starts as first frame
+	  else:
+	    shift      = self.shift
+	  n = yuv2rgb.luma_motion(yuv, self.bg, size, self.factor,
+	    self.threshold, shift, self.cells)
+	  self.frames   += 1
+	  fire           = False
+	  if self.wait > 0:
+	    self.wait   -= 1
+	  elif n > self.limit and t >= self.until:
+	    self.until     = t + self.hold
+	    self.triggers += 1
+	    fire           = True
+	  self.busyTime += monotonic() - t
+	  return fire
+
+	def fps(self):
+	  return self.frames / self.busyTime if self.busyTime > 0.0 else 0.0
+
+
+# Live view server ---------------------------------------------------------
+
+# For watching the camera remotely, an optional HTTP server (livePort)
+# serves the viewfinder as an MJPEG stream (/stream.mjpg, or /) and single
+# frames (/snapshot.jpg).  Frames are JPEG-encoded by the GPU on their own
+# video port splitter output, resized to liveRes, so the viewfinder loop
+# does no extra work; the capture thread runs only while there are
+# clients (and the viewfinder is running; main loop calls update()).
+# Each client has a small bounded queue: if it can't keep up, the oldest
+# queued frame is dropped (counted in its 'dropped'), so a slow client
+# never holds up the camera or other clients.  clientStats() gives each
+# client's frame rate.
+
+class LiveClient:
+
+	def __init__(self, addr, depth):
+	  self.addr    = addr
+	  self.queue   = collections.deque(maxlen=depth)
+	  self.sent    = 0
+	  self.dropped = 0
+	  self.start   = monotonic()
+
+	def fps(self):
+	  t = monotonic() - self.start
+	  return self.sent / t if t > 0.0 else 0.0
+
+class LiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	boundary = 'FRAME'
+
+	def do_GET(self):
+	  live = self.server.live
+	  if self.path == '/snapshot.jpg':
+	    data = live.snapshot(self.client_address)
+	    if data is None:
+	      self.send_error(503, 'No frame available')
+	      return
+	    self.send_response(200)
+	    self.send_header('Content-Type'  , 'image/jpeg')
+	    self.send_header('Content-Length', len(data))
+	    self.send_header('Cache-Control' , 'no-cache')
+	    self.end_headers()
+	    self.wfile.write(data)
+	  elif self.path in ('/', '/stream.mjpg'):
+	    self.send_response(200)
+	    self.send_header('Content-Type',
+	      'multipart/x-mixed-replace; boundary=' + self.boundary)
+	    self.send_header('Cache-Control', 'no-cache')
+	    self.end_headers()
+	    client = live.attach(self.client_address)
+	    try:
+	      while True:
+	        data = live.next(client)
+	        self.wfile.write('--%s\r\nContent-Type: image/jpeg\r\n'
+	          'Content-Length: %d\r\n\r\n' % (self.boundary, len(data)))
+	        self.wfile.write(data)
+	        self.wfile.write('\r\n')
+	        client.sent += 1
+	    except IOError:
+	      pass # Client went away
+	    finally:
+	      live.detach(client)
+	  else:
+	    self.send_error(404)
+
+	def log_message(self, format, *args):
+	  pass
+
+class LiveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads      = True
+	allow_reuse_address = True
+
+	# A viewer closing its window mid-frame is routine, not an error
+	def handle_error(self, request, client_address):
+	  if not isinstance(sys.exc_info()[1], IOError):
+	    SocketServer.ThreadingMixIn.handle_error(
+	      self, request, client_address)
+
+class LiveView:
+
+	def __init__(self, res, quality, depth=2, port=2):
+	  self.res      = res
+	  self.quality  = quality
+	  self.depth    = depth # Frames queued per client
+	  self.port     = port  # Video port splitter output used
+	  self.clients  = set()
+	  self.cond     = threading.Condition()
+	  self.thread   = None
+	  self.running  = False
+	  self.server   = None
+	  self.frames   = 0     # Frames captured
+
+	# Start HTTP server on given port (in its own thread)
+	def serve(self, port, host=''):
+	  self.server      = LiveServer((host, port), LiveHandler)
+	  self.server.live = self
+	  t = threading.Thread(target=self.server.serve_forever)
+	  t.daemon = True
+	  t.start()
+
+	# Start or stop capture as clients come & go (called from main loop,
+	# which owns the camera configuration)
+	def update(self):
+	  if self.clients:
+	    if self.thread is None:
+	      self.running = True
+	      self.thread  = threading.Thread(target=self.run)
+	      self.thread.daemon = True
+	      self.thread.start()
+	  elif self.thread is not None:
+	    self.stop()
+
+	def stop(self):
+	  if self.thread is not None:
+	    self.running = False
+	    self.thread.join()
+	    self.thread = None
+
+	def run(self):
+	  stream = io.BytesIO()
+	  frames = camera.capture_continuous(stream, format='jpeg',
+	    use_video_port=True, splitter_port=self.port, resize=self.res,
+	    quality=self.quality)
+	  try:
+	    for foo in frames:
+	      self.publish(stream.getvalue())
+	      stream.seek(0)
+	      stream.truncate()
+	      if not self.running: break
+	  finally:
+	    frames.close()
+
+	def publish(self, data):
+	  with self.cond:
+	    self.frames += 1
+	    for c in self.clients:
+	      if len(c.queue) == c.queue.maxlen: c.dropped += 1
+	      c.queue.append(data)
+	    self.cond.notify_all()
+
+	def attach(self, addr, depth=None):
+	  c = LiveClient(addr, depth or self.depth)
+	  with self.cond:
+	    self.clients.add(c)
+	  wake() # Idle (e.g. headless) main loop starts the viewfinder
+	  return c
+
+	def detach(self, client):
+	  with self.cond:
+	    self.clients.discard(client)
+
+	# Oldest queued frame for client, waiting as long as it takes
+	# (untimed; a timed wait in Python 2 polls, adding latency)
+	def next(self, client):
+	  with self.cond:
+	    while not client.queue: self.cond.wait()
+	    return client.queue.popleft()
+
+	# Next frame captured (None if none within timeout sec, e.g. the
+	# viewfinder isn't running)
+	def snapshot(self, addr, timeout=5.0):
+	  c = self.attach(addr, 1)
+	  t = monotonic() + timeout
+	  try:
+	    with self.cond:
+	      while not c.queue:
+	        left = t - monotonic()
+	        if left <= 0.0: return None
+	        self.cond.wait(left)
+	      c.sent += 1
+	      return c.queue.popleft()
+	  finally:
+	    self.detach(c)
+
+	# Returns list of (address, frames/sec, sent, dropped) per client
+	def clientStats(self):
+	  with self.cond:
+	    return [(c.addr, c.fps(), c.sent, c.dropped) for c in self.clients]
+
+
+# Control socket -----------------------------------------------------------
+
+# Besides the touchscreen, the camera can be driven by other programs
+# (scripts, fleet tools) over a Unix stream socket at controlPath; with
+# headless set (or --headless on the command line) there's no display and
+# this is the only control.  Each request is one line of words:
+#
+#   shoot [n]          n shutter presses (default 1); reply lists files
+#   set <name> <value> setting as in settings(): fx, iso, size, store,
+#                      burst, zsl, lapse or motion; reply is all settings
+#   get                all settings
+#   images             [lowest, highest] image index in storage dir
+#   lapse start|stop   time-lapse at the 'lapse' interval
+#   drain              wait until photos taken so far are fully written
+#   stats              request, capture, storage & time-lapse counters
+#   quit               finish writing photos and exit
+#
+# and gets one line of JSON in reply, {"ok": result} or {"error": text},
+# in request order.  A client needn't wait for each reply before sending
+# the next request, so a script can keep the camera busy back to back
+# (the capture pipeline writes each shot behind the next).  Requests from
+# all connections share one bounded queue; when it's full, connections
+# stop being read, throttling fast clients rather than growing memory.
+# Requests run one at a time in the main loop (poll()), which owns the
+# camera, through the same functions the touchscreen uses.
+
+class Request:
+
+	def __init__(self, words):
+	  self.words = words
+	  self.reply = None        # JSON reply line, once run
+	  self.time  = monotonic() # Time received
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+
+	# Read requests as they arrive, queueing each to run; replies go out
+	# from a second thread as they're ready, in order.
+	def handle(self):
+	  control      = self.server.control
+	  self.pending = collections.deque() # Requests awaiting reply
+	  self.closed  = False
+	  w = threading.Thread(target=self.writer, args=(control,))
+	  w.daemon = True
+	  w.start()
+	  try:
+	    for line in self.rfile:
+	      words = line.split()
+	      if not words: continue
+	      req = Request(words)
+	      with control.cond:
+	        self.pending.append(req)
+	      control.submit(req)
+	  except IOError:
+	    pass # Client went away
+	  finally:
+	    with control.cond:
+	      self.closed = True
+	      control.cond.notify_all()
+	    w.join()
+
+	def writer(self, control):
+	  try:
+	    while True:
+	      with control.cond:
+	        while (not (self.pending and self.pending[0].reply) and
+	               not (self.closed and not self.pending)):
+	          control.cond.wait()
+	        if not self.pending: return
+	        req = self.pending.popleft()
+	      self.wfile.write(req.reply + '\n')
+	  except IOError:
+	    pass
+
+class ControlServer(SocketServer.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+	  if not isinstance(sys.exc_info()[1], IOError):
+	    SocketServer.ThreadingUnixStreamServer.handle_error(
+	      self, request, client_address)
+
+class Controller:
+
+	def __init__(self, depth=64, window=100):
+	  self.depth    = depth # Max requests queued
+	  self.queue    = collections.deque()
+	  self.cond     = threading.Condition()
+	  self.woken    = False
+	  self.quitting = False
+	  self.server   = None
+	  self.path     = None
+	  self.requests = 0     # Requests run
+	  self.errors   = 0     # Requests failed
+	  self.shots    = 0     # Photos taken
+	  self.start    = monotonic()
+	  self.latency  = collections.deque(maxlen=window) # Received to replied
+
+	# Start socket server at path (in its own thread).  A socket left by
+	# an earlier run is replaced; anything else there is an error.
+	def serve(self, path):
+	  if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+	    os.remove(path)
+	  self.server         = ControlServer(path, ControlHandler)
+	  self.server.control = self
+	  self.path           = path
+	  # Owned by pi user (as photos are), read/write by user & group
+	  os.chown(path, uid, gid)
+	  os.chmod(path,
+	    stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
+	  t = threading.Thread(target=self.server.serve_forever)
+	  t.daemon = True
+	  t.start()
+
+	def close(self):
+	  if self.server is not None:
+	    self.server.shutdown()
+	    self.server.server_close()
+	    self.server = None
+	    os.remove(self.path)
+
+	# Queue request to run, blocking while the queue is full.  Called
+	# from connection threads.
+	def submit(self, req):
+	  with self.cond:
+	    while len(self.queue) >= self.depth: self.cond.wait()
+	    self.queue.append(req)
+	    self.cond.notify_all()
+	  wake()
+
+	# End a blocking poll() (e.g. a time-lapse shot is due)
+	def wake(self):
+	  with self.cond:
+	    self.woken = True
+	    self.cond.notify_all()
+
+	# Run the next queued request, if any (main loop).  If block is set,
+	# first wait for one to arrive or for wake().  Returns True if a
+	# request was run.
+	def poll(self, block=False):
+	  with self.cond:
+	    if block:
+	      while not self.queue and not self.woken: self.cond.wait()
+	    self.woken = False
+	    if not self.queue: return False
+	    req = self.queue.popleft()
+	    self.cond.notify_all() # Room for a blocked submit()
+	  reply = self.run(req)
+	  with self.cond:
+	    req.reply = reply
+	    self.latency.append(monotonic() - req.time)
+	    self.cond.notify_all()
+	  return True
+
+	def run(self, req):
+	  fn = getattr(self, 'do_' + req.words[0], None)
+	  try:
+	    if fn is None: raise ValueError('Unknown request ' + req.words[0])
+	    reply = json.dumps({ 'ok' : fn(*req.words[1:]) })
+	  except Exception as e:
+	    self.errors += 1
+	    reply = json.dumps({ 'error' : str(e) })
+	  self.requests += 1
+	  return reply
+
+	def do_shoot(self, n='1'):
+	  files = []
+	  for i in range(int(n)):
+	    slots = takePicture()
+	    if slots is None: raise IOError('Capture failed after %d files' %
+	      len(files))
+	    files.extend(pathData[storeMode] + '/IMG_' + '%04d' % idx + '.JPG'
+	      for idx in slots)
+	    self.shots += len(slots)
+	  return files
+
+	def do_set(self, name, value):
+	  limits = { 'fx' : len(fxData), 'iso'  : len(isoData),
+	    'size' : len(sizeData), 'store' : len(pathData),
+	    'zsl'  : 2, 'motion' : 2, 'burst' : 10000 }
+	  if name not in settings(): raise ValueError('Unknown setting ' + name)
+	  v = float(value) if name == 'lapse' else int(value)
+	  if v < 0 or v >= limits.get(name, v + 1):
+	    raise ValueError('%s out of range' % name)
+	  if name in ('zsl', 'motion'): v = bool(v)
+	  applySettings({ name : v })
+	  saveSettings()
+	  return settings()
+
+	def do_get(self):
+	  return settings()
+
+	def do_images(self):
+	  return imgRange(pathData[storeMode])
+
+	def do_lapse(self, action):
+	  global screenModePrior
+	  if action == 'start':
+	    if lapseInterval <= 0: raise ValueError('Time-lapse interval not set')
+	    if not lapse.running: startTimeLapse()
+	  elif action == 'stop':
+	    lapse.stop()
+	  else:
+	    raise ValueError('lapse start|stop')
+	  screenModePrior = -1 # Refresh display (viewfinder pauses or resumes)
+	  return lapse.running
+
+	def do_drain(self):
+	  pipeline.drain()
+
+	def do_stats(self):
+	  t = monotonic() - self.start
+	  with self.cond:
+	    queued  = len(self.queue)
+	    latency = list(self.latency)
+	  return { 'requests' : self.requests,
+	           'errors'   : self.errors,
+	           'queued'   : queued,
+	           'shots'    : self.shots,
+	           'perMinute': self.shots * 60.0 / t if t > 0.0 else 0.0,
+	           'latency'  : [sum(latency) / len(latency), max(latency)]
+	                        if latency else None,
+	           'pipeline' : pipeline.stats(),
+	           'storage'  : dict((p, { 'files' : s.files, 'bytes' : s.bytes,
+	                          'queued' : s.depth(), 'failures' : s.failures,
+	                          'throughput' : s.throughput(), # Bytes/sec
+	                          'latency' : s.latencyStats() })
+	                          for p, s in stores.items()),
+	           'burst'    : lastBurst.stats() if lastBurst else None,
+	           'lapse'    : lapse.stats(),
+	           'timing'   : stats.summary() if stats.enabled else None }
+
+	def do_quit(self):
+	  self.quitting = True # Main loop exits after replying
+
+
+# Instrumentation ----------------------------------------------------------
+
+# To see where the time goes: with statsEnabled set (or --stats on the
+# command line), named spans (monotonic clock) and counters are kept in
+# 'stats'.  Each span name has a rolling window of recent times, from
+# which summary() gives mean, median, 95th percentile and max:
+#
+#   frame    viewfinder frame interval (so fps; plus 'dropped' count)
+#   capture  camera frame into yuv[] (previewFrame())
+#   convert  yuv2rgb.convert_scaled(), crop/scale/convert for viewfinder
+#   draw     Renderer.frame(): image, Buttons & display update
+#   spinner  busy indicator on screen
+#   shutter  takePicture(), tap to return (viewfinder resumes)
+#   pipe-*   capture pipeline stages (see CapturePipeline.record())
+#   decode   JPEG decode & scale to screen (loadJPEG(): playback, review)
+#   show     showImage(), tap to image ready ('show-hit'/'-miss' counts)
+#   upload   Dropbox uploader call, per batch ('uploaded'/'upload-failed')
+#
+# 'dropped' counts viewfinder frames the camera produced that the loop
+# didn't take, judged from gaps between frames at the camera frame rate.
+# With statsOverlay set, a summary (and the last burst's rates) is drawn
+# atop the screen (StatsOverlay, below); with statsPath set, summary()
+# plus time-lapse stats is written as a line of JSON every statsInterval
+# seconds, appended to that file or, for 'host:port', sent as a UDP
+# datagram.  The control socket's stats request includes it, and the
+# last burst's stats.
+#
+# Disabled, a span is start() returning None and end() returning at once,
+# and counters return at once; bench/stats.py measures this.
+
+class Stats:
+
+	def __init__(self, window=200):
+	  self.enabled   = False
+	  self.window    = window
+	  self.spans     = {}   # Span name -> deque of recent times (sec)
+	  self.totals    = {}   # Span name -> count ever
+	  self.counts    = {}   # Counter name -> value
+	  self.lock      = threading.Lock()
+	  self.lastFrame = None # Time of last viewfinder frame
+	  self.dumpPath  = None # Where dumper thread writes
+	  self.start0    = monotonic()
+
+	def reset(self):
+	  with self.lock:
+	    self.spans.clear()
+	    self.totals.clear()
+	    self.counts.clear()
+	  self.lastFrame = None
+
+	# Span start time (None if disabled), to pass to end()
+	def start(self):
+	  return monotonic() if self.enabled else None
+
+	def end(self, name, t):
+	  if t is None: return
+	  self.record(name, monotonic() - t)
+
+	# Add a time to span 'name', e.g. one measured elsewhere
+	def record(self, name, t):
+	  if not self.enabled: return
+	  with self.lock:
+	    d = self.spans.get(name)
+	    if d is None:
+	      d = self.spans[name] = collections.deque(maxlen=self.window)
+	      self.totals[name] = 0
+	    d.append(t)
+	    self.totals[name] += 1
+
+	def count(self, name, n=1):
+	  if not self.enabled: return
+	  with self.lock:
+	    self.counts[name] = self.counts.get(name, 0) + n
+
+	# Viewfinder frame arrived, camera running at rate frames/sec
+	def frame(self, rate):
+	  t = monotonic()
+	  if self.lastFrame is not None:
+	    d = t - self.lastFrame
+	    self.record('frame', d)
+	    n = int(d * rate + 0.5) - 1 # Frames between this and last
+	    if n > 0: self.count('dropped', n)
+	  self.lastFrame = t
+	  self.count('frames')
+
+	# Returns (count, mean, median, 95th percentile, max) for span name,
+	# or None if there's none
+	def span(self, name):
+	  with self.lock:
+	    d = self.spans.get(name)
+	    if not d: return None
+	    v = sorted(d)
+	    n = self.totals[name]
+	  return (n, sum(v) / len(v), v[len(v) / 2],
+	    v[min(len(v) - 1, len(v) * 95 / 100)], v[-1])
+
+	def summary(self):
+	  with self.lock:
+	    names  = self.spans.keys()
+	    counts = dict(self.counts)
+	  spans = dict((k, self.span(k)) for k in names)
+	  f     = spans.get('frame')
+	  return { 'time'   : time.time(),
+	           'uptime' : monotonic() - self.start0,
+	           'boot'   : bootTime, # Start to first viewfinder frame
+	           'fps'    : 1.0 / f[1] if f and f[1] > 0.0 else 0.0,
+	           'spans'  : spans,
+	           'counts' : counts }
+
+	# Write summary() every interval seconds to path (in its own thread),
+	# in place of any earlier dump(); None stops dumping
+	def dump(self, path, interval):
+	  self.dumpPath = path
+	  if path is None: return
+	  t = threading.Thread(target=self.dumper, args=(path, interval))
+	  t.daemon = True
+	  t.start()
+
+	def dumper(self, path, interval):
+	  sock = None
+	  if ':' in path: # host:port, UDP
+	    host, port = path.rsplit(':', 1)
+	    addr = (host, int(port))
+	    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	  while True:
+	    time.sleep(interval)
+	    if self.dumpPath != path: break
+	    s          = self.summary()
+	    s['lapse'] = lapse.stats()
+	    line       = json.dumps(s)
+	    try:
+	      if sock:
+	        sock.sendto(line, addr)
+	      else:
+	        with open(path, 'a') as f: f.write(line + '\n')
+	    except (IOError, socket.error) as e:
+	      print path, e
+
+	# Short text summary for the overlay, a list of lines
+	def lines(self):
+	  s = self.summary()
+	  def ms(name, field=1):
+	    v = s['spans'].get(name)
+	    return '%.1f' % (v[field] * 1000.0) if v else '-'
+	  c = s['counts']
+	  return [
+	    '%.1f fps  %d dropped  frame %s ms' % (s['fps'],
+	      c.get('dropped', 0), ms('frame')),
+	    'capture %s  convert %s  draw %s ms' % (ms('capture'),
+	      ms('convert'), ms('draw')),
+	    'shutter %s  shot %s  to disk %s ms' % (ms('shutter'),
+	      ms('pipe-total'), ms('pipe-shot-to-disk')),
+	    'decode %s  show %s  upload %s ms' % (ms('decode'), ms('show'),
+	      ms('upload')),
+	    burstLine()]
+
+# Last burst's sustained capture & write rates and where (if anywhere)
+# the writer fell behind, for the overlay
+def burstLine():
+	if lastBurst is None: return 'burst -'
+	b = lastBurst.stats()
+	return 'burst %d: %.1f fps, write %.1f fps, %s' % (b['frames'],
+	  b['captureFps'], b['writeFps'], 'behind at %d' % b['behindAt']
+	  if b['behindAt'] is not None else 'kept up')
+
+# Stats summary on screen: a Button whose cached layer is the rendered
+# text (on a translucent backing, so what's beneath still shows),
+# re-rendered every 'interval' seconds rather than every frame.
+
+class StatsOverlay(Button):
+
+	__slots__ = ('font', 'interval', 'due')
+
+	def __init__(self, rect, interval=0.5):
+	  Button.__init__(self, rect)
+	  self.font     = None
+	  self.interval = interval
+	  self.due      = 0.0 # monotonic() time of next re-render
+
+	def compose(self):
+	  if self.font is None: self.font = pygame.font.Font(None, 14)
+	  s = pygame.Surface(self.rect[2:4], pygame.SRCALPHA, 32)
+	  s.fill((0, 0, 0, 160))
+	  y = 2
+	  for line in stats.lines():
+	    s.blit(self.font.render(line, True, (255, 255, 255)), (4, y))
+	    y += self.font.get_linesize() + 2
+	  self.layer = (s, (0, 0))
+	  self.due   = monotonic() + self.interval
+
+	def draw(self, screen):
+	  if monotonic() >= self.due: self.layer = None
+	  Button.draw(self, screen)
+
+
+# Camera configuration -----------------------------------------------------
+
+# Changing camera resolution or frame rate restarts the camera pipeline,
+# costing hundreds of milliseconds, so all camera settings go through
+# CameraConfig.set(), which skips writes of unchanged values, stops the
+# viewfinder stream first when a restart is needed, and counts writes,
+# restarts and skipped (redundant) writes.
+
+class CameraConfig:
+
+	restart = ('resolution', 'framerate') # Properties that restart pipeline
+
+	def __init__(self, camera):
+	  self.camera   = camera
+	  self.values   = {} # Last value written, by property name
+	  self.writes   = 0  # Property writes
+	  self.restarts = 0  # ...of which restarted the camera pipeline
+	  self.skipped  = 0  # Redundant writes avoided
+
+	# Set properties from (name, value) pairs, in order
+	def set(self, *pairs):
+	  for name, value in pairs:
+	    if name in self.values and self.values[name] == value:
+	      self.skipped += 1
+	      continue
+	    if name in self.restart:
+	      previewStop()
+	      self.restarts += 1
+	    setattr(self.camera, name, value)
+	    self.values[name] = value
+	    self.writes      += 1
+
+
+# Viewfinder stream --------------------------------------------------------
+
+# Rather than a separate camera.capture() (and a new BytesIO object) for
+# each viewfinder frame, which re-arms the capture pipeline every time,
+# a single capture_continuous() generator is kept running on the video
+# port.  Frames are written straight into the global yuv[] buffer by a
+# minimal file-like object, with no per-frame copy (an overrunning chunk
+# is trimmed through a buffer() view, not sliced).
+
+class PreviewOutput:
+
+	def __init__(self, buf):
+	  self.buf = buf # Preallocated destination (bytearray)
+	  self.pos = 0   # Write position within buf
+
+	def write(self, data):
+	  n = len(self.buf) - self.pos
+	  if len(data) < n: n = len(data)
+	  self.buf[self.pos:self.pos + n] = (data if n == len(data)
+	                                     else buffer(data, 0, n))
+	  self.pos += n
+	  return len(data)
+
+	def flush(self):
+	  pass
+
+# FrameBuffer holds the viewfinder conversion buffer and one persistent
+# pygame Surface per viewfinder size.  Where the display is 16-bit RGB565
+# (PiTFT) or 32-bit BGRA, yuv2rgb writes directly into a Surface already
+# in the screen's own pixel format, so blit is a straight copy with no
+# second conversion.  Otherwise RGB Surfaces wrap a (zero-copy) buffer()
+# view of one preallocated bytearray.  Either way, once each viewfinder
+# size has been shown, converting a frame creates no buffers or Surfaces
+# (bench/preview.py measures what the whole frame path allocates).
+
+class FrameBuffer:
+
+	def __init__(self, w, h, display):
+	  self.format   = pixelFormat(display)
+	  self.display  = display
+	  self.rgb      = bytearray(w * h * 3)
+	  self.surfaces = {} # Viewfinder Surfaces, keyed by size
+
+	def surface(self, size):
+	  s = self.surfaces.get(size)
+	  if s is None:
+	    if self.format == yuv2rgb.RGB24:
+	      s = pygame.image.frombuffer(buffer(self.rgb, 0,
+	        size[0] * size[1] * 3), size, 'RGB')
+	    else:
+	      s = pygame.Surface(size, 0, self.display)
+	      if s.get_pitch() != size[0] * s.get_bytesize():
+	        # Padded rows; can't convert in place, use RGB instead
+	        self.format = yuv2rgb.RGB24
+	        self.surfaces.clear()
+	        return self.surface(size)
+	    self.surfaces[size] = s
+	  return s
+
+	# Crop & scale src-sized YUV frame to viewfinder Surface of given
+	# size (converting in the same pass), return Surface
+	def convert(self, yuv, src, crop, size):
+	  t = stats.start()
+	  s = self.surface(size)
+	  if self.format == yuv2rgb.RGB24:
+	    yuv2rgb.convert_scaled(yuv, self.rgb, src, crop, size,
+	      0, convertThreads)
+	  else:
+	    b = s.get_buffer() # Locks Surface until released
+	    yuv2rgb.convert_scaled(yuv, b, src, crop, size,
+	      0, convertThreads, self.format)
+	    del b
+	  stats.end('convert', t)
+	  return s
+
+# Convert a normalized crop window (as in sizeData) to a pixel rect
+# within the previewRes viewfinder frame.
+def cropRect(crop):
+	x = int(crop[0] * previewRes[0] + 0.5)
+	y = int(crop[1] * previewRes[1] + 0.5)
+	return (x, y,
+	  min(int(crop[2] * previewRes[0] + 0.5), previewRes[0] - x),
+	  min(int(crop[3] * previewRes[1] + 0.5), previewRes[1] - y))
+
+# Return the yuv2rgb output format matching a Surface's pixel layout,
+# or RGB24 if there's no direct match.
+def pixelFormat(surface):
+	bits  = surface.get_bitsize()
+	masks = surface.get_masks()[0:3]
+	if bits == 16 and masks == (0xF800, 0x07E0, 0x001F):
+	  return yuv2rgb.RGB565
+	if bits == 32 and masks == (0xFF0000, 0x00FF00, 0x0000FF):
+	  return yuv2rgb.BGRA32
+	return yuv2rgb.RGB24
+
+# Start the continuous capture (if not already running), configuring the
+# camera as needed.  Normally the camera stays set up for stills (full
+# resolution & crop window) and the video port is resized by the GPU to
+# the viewfinder size, so taking a picture needs no reconfiguration.
+# In pre-shutter mode, the camera runs at zslRes (full field of view)
+# for the PreShutter frames, the viewfinder stream is resized to
+# previewRes and the crop window applied in software.
+def previewStart():
+	global fpsCount, fpsTime, previewFrames, previewRect, previewSize
+	if previewFrames is None:
+	  if zslEnabled:
+	    cfg.set(('resolution', zslRes),
+	            ('crop'      , (0.0, 0.0, 1.0, 1.0)),
+	            ('framerate' , previewFps))
+	    previewSize = previewRes
+	    previewRect = cropRect(sizeData[sizeMode][2])
+	  else:
+	    res = sizeData[sizeMode][0]
+	    cfg.set(('resolution', res),
+	            ('crop'      , sizeData[sizeMode][2]),
+	            ('framerate' , previewFps if res[0] * res[1] <= 1920 * 1080
+	                           else min(previewFps, 15))) # Sensor limit
+	    previewSize = sizeData[sizeMode][1]
+	    previewRect = (0, 0) + previewSize
+	  previewOut.pos = 0
+	  previewFrames  = camera.capture_continuous(previewOut,
+	    format='raw', use_video_port=True, resize=previewSize)
+	  fpsCount       = 0 # Measure frame rate from here
+	  fpsTime        = time.time()
+	  if zslEnabled: zsl.start()
+
+def previewStop():
+	global previewFrames
+	zsl.stop()
+	liveView.stop()
+	motion.reset()
+	stats.lastFrame = None # Gap until restart isn't dropped frames
+	if previewFrames is not None:
+	  previewFrames.close()
+	  previewFrames = None
+
+# Read next viewfinder frame into yuv[], updating the measured frame rate.
+def previewFrame():
+	global fps, fpsCount, fpsTime
+	previewStart()
+	liveView.update()
+	previewOut.pos = 0
+	t = stats.start()
+	next(previewFrames)
+	stats.end('capture', t)
+	if stats.enabled: stats.frame(cfg.values['framerate'])
+	fpsCount += 1
+	t = time.time()
+	if t - fpsTime >= 1.0:
+	  fps      = fpsCount / (t - fpsTime)
+	  fpsCount = 0
+	  fpsTime  = t
 
 
 # Initialization -----------------------------------------------------------
 
+if '--headless' in sys.argv[1:]: headless = True
+if '--stats'    in sys.argv[1:]: statsEnabled = True
+if headless and not controlPath: controlPath = '/tmp/cam.sock'
+
 # Init framebuffer/touchscreen environment variables
-os.putenv('SDL_VIDEODRIVER', 'fbcon')
-os.putenv('SDL_FBDEV'      , '/dev/fb1')
-os.putenv('SDL_MOUSEDRV'   , 'TSLIB')
-os.putenv('SDL_MOUSEDEV'   , '/dev/input/touchscreen')
+if headless: # No display; screen is drawn (unseen) in memory
+  os.putenv('SDL_VIDEODRIVER', 'dummy')
+else:
+  os.putenv('SDL_VIDEODRIVER', 'fbcon')
+  os.putenv('SDL_FBDEV'      , '/dev/fb1')
+  os.putenv('SDL_MOUSEDRV'   , 'TSLIB')
+  os.putenv('SDL_MOUSEDEV'   , '/dev/input/touchscreen')
 
 # Get user & group IDs for file & folder creation
 # (Want these to be 'pi' or other user, not root)
@@ -560,85 +3066,135 @@ s = os.getenv("SUDO_GID")
 gid = int(s) if s else os.getgid()
 
 # Buffers for viewfinder data
-rgb = bytearray(320 * 240 * 3)
-yuv = bytearray(320 * 240 * 3 / 2)
+# (Frames arrive padded to 32x16 multiples; previewRes already is)
+yuv = bytearray(previewRes[0] * previewRes[1] * 3 / 2)
+previewOut = PreviewOutput(yuv)
+
+# Timing stats (see Instrumentation); disabled unless statsEnabled
+stats = Stats()
+stats.enabled = statsEnabled
+if statsEnabled and statsPath: stats.dump(statsPath, statsInterval)
+
+# Background stages for photos after capture
+zsl      = PreShutter(zslMemory, zslQuality)
+uploads  = UploadQueue('upload.journal')
+pipeline = CapturePipeline()
+lapse    = TimeLapse()
+motion   = MotionTrigger()
+liveView = LiveView(liveRes, liveQuality)
+if livePort: liveView.serve(livePort)
+control  = Controller()
+if controlPath:
+  control.serve(controlPath)
+  atexit.register(control.close)
+playCache = PlaybackCache()
 
 # Init pygame and screen
 pygame.init()
 pygame.mouse.set_visible(False)
-screen = pygame.display.set_mode((0,0), pygame.FULLSCREEN)
+if headless: screen = pygame.display.set_mode((320, 240), 0, 16) # As PiTFT
+else:        screen = pygame.display.set_mode((0,0), pygame.FULLSCREEN)
+frameBuf = FrameBuffer(320, 240, screen) # Viewfinder in screen's format
+renderer = Renderer(screen)
+overlay  = StatsOverlay((0, 0, 320, 64)) # Drawn if statsOverlay is set
+clock    = pygame.time.Clock() # Paces viewfinder refresh
 
 # Init camera and set up default values
 camera            = picamera.PiCamera()
 atexit.register(camera.close)
-camera.resolution = sizeData[sizeMode][1]
-#camera.crop       = sizeData[sizeMode][2]
-camera.crop       = (0.0, 0.0, 1.0, 1.0)
+cfg               = CameraConfig(camera) # Configured by previewStart()
 # Leave raw format at default YUV, don't touch, don't set to RGB!
 
-# Load all icons at startup.
-for file in os.listdir(iconPath):
-  if fnmatch.fnmatch(file, '*.png'):
-    icons.append(Icon(file.split('.')[0]))
+# Load icon atlas at startup (bitmaps themselves are converted on demand)
+atlas = IconAtlas(atlasPath, iconPath)
+for name in atlas.names():
+  icons[name] = Icon(name)
 
-# Assign Icons to Buttons, now that they're loaded
+# Assign Icons to Buttons, now that they're known
 for s in buttons:        # For each screenful of buttons...
   for b in s:            #  For each button on screen...
-    for i in icons:      #   For each icon...
-      if b.bg == i.name: #    Compare names; match?
-        b.iconBg = i     #     Assign Icon to Button
-        b.bg     = None  #     Name no longer used; allow garbage collection
-      if b.fg == i.name:
-        b.iconFg = i
-        b.fg     = None
+    if b.bg in icons:    #   Icon with that name?
+      b.iconBg = icons[b.bg] # Assign Icon to Button
+      b.bg     = None    #   Name no longer used; allow garbage collection
+    if b.fg in icons:
+      b.iconFg = icons[b.fg]
+      b.fg     = None
+
+# Create viewfinder Surfaces up front so none are made in the main loop
+for s in sizeData:
+  frameBuf.surface(s[1])
 
 loadSettings() # Must come last; fiddles with Button/Icon states
 
 
 # Main loop ----------------------------------------------------------------
 
+# Headless, control socket requests are all there is: run each as it
+# arrives, and time-lapse shots as they come due.  The viewfinder stream
+# runs only while something uses it (motion trigger, live view clients);
+# otherwise the loop sleeps until a request arrives or wake() is called.
+while headless:
+  live = motionEnabled or bool(liveView.clients)
+  if not live: previewStop()
+  control.poll(not live and not lapse.due())
+  if control.quitting: quitCallback()
+  if lapse.due(): takeTimeLapse()
+  if live:
+    previewFrame()
+    if motionEnabled and motion.update(yuv, previewSize): takePicture()
+
 while(True):
 
-  # Process touchscreen input
+  # Process touchscreen input.  In viewfinder or settings modes, handle
+  # any pending input then refresh the display to show the live preview,
+  # at no more than previewFps.  In other modes (image playback, etc.)
+  # nothing is animating, so sleep until input arrives (or wake() is
+  # called), refreshing the screen only when screenMode changes.
+  # During a time-lapse the viewfinder is paused likewise; the scheduler
+  # thread wakes the loop when each shot is due.
   while True:
-    for event in pygame.event.get():
+    live = screenMode > 3 or (screenMode == 3 and not lapse.running)
+    if live or screenMode != screenModePrior or lapse.due():
+      events = pygame.event.get()
+    else:
+      t      = monotonic()
+      c      = sum(os.times()[0:2])
+      events = [pygame.event.wait()]
+      events.extend(pygame.event.get())
+      wakeups  += 1
+      idleWall += monotonic() - t
+      idleCpu  += sum(os.times()[0:2]) - c
+    for event in events:
       if(event.type is MOUSEBUTTONDOWN):
-        pos = pygame.mouse.get_pos()
-        for b in buttons[screenMode]:
-          if b.selected(pos): break
-    # If in viewfinder or settings modes, stop processing touchscreen
-    # and refresh the display to show the live preview.  In other modes
-    # (image playback, etc.), stop and refresh the screen only when
-    # screenMode changes.
-    if screenMode >= 3 or screenMode != screenModePrior: break
+        dispatch(pygame.mouse.get_pos())
+    control.poll() # Control socket request, if any
+    if control.quitting: quitCallback()
+    pipeline.showReview() # Post-shot review image, if one's ready
+    if lapse.due(): takeTimeLapse()
+    live = screenMode > 3 or (screenMode == 3 and not lapse.running)
+    if live or screenMode != screenModePrior: break
+
+  if live: clock.tick(previewFps)
+  else:    previewStop() # No-op unless just paused
 
   # Refresh display
-  if screenMode >= 3: # Viewfinder or settings modes
-    stream = io.BytesIO() # Capture into in-memory stream
-    camera.capture(stream, use_video_port=True, format='raw')
-    stream.seek(0)
-    stream.readinto(yuv)  # stream -> YUV buffer
-    stream.close()
-    yuv2rgb.convert(yuv, rgb, sizeData[sizeMode][1][0],
-      sizeData[sizeMode][1][1])
-    img = pygame.image.frombuffer(rgb[0:
-      (sizeData[sizeMode][1][0] * sizeData[sizeMode][1][1] * 3)],
-      sizeData[sizeMode][1], 'RGB')
+  if screenMode == 3 and (monotonic() < reviewUntil or lapse.running):
+    img = scaled # Reviewing the photo just taken (or last time-lapse shot)
+  elif screenMode >= 3: # Viewfinder or settings modes
+    previewFrame() # Continuous capture -> YUV buffer
+    img = frameBuf.convert(yuv, previewSize, previewRect, sizeData[sizeMode][1])
+    if (motionEnabled and screenMode == 3 and
+        motion.update(yuv, previewSize)):
+      takePicture()
   elif screenMode < 2: # Playback mode or delete confirmation
     img = scaled       # Show last-loaded image
   else:                # 'No Photos' mode
     img = None         # You get nothing, good day sir
 
-  if img is None or img.get_height() < 240: # Letterbox, clear background
-    screen.fill(0)
-  if img:
-    screen.blit(img,
-      ((320 - img.get_width() ) / 2,
-       (240 - img.get_height()) / 2))
-
-  # Overlay buttons on display and update
-  for i,b in enumerate(buttons[screenMode]):
-    b.draw(screen)
-  pygame.display.update()
+  # Draw image, overlay buttons and update display
+  renderer.frame(img, buttons[screenMode], screenMode != screenModePrior)
+
+  if bootTime is None and screenMode == 3: # Kept for stats summary()
+    bootTime = time.time() - startTime
 
   screenModePrior = screenMode
@@ -10,6 +10,11 @@
    BSD license, all text above must be included in any redistribution. */
 
 #include <python2.7/Python.h>
+#include <pthread.h>
+#include <string.h>
+#include <unistd.h>
+
+#define MAX_THREADS 16
 
 static PyObject *convert(PyObject *self, PyObject *args) {
 	Py_buffer      inBuf, outBuf;
@@ -67,12 +72,354 @@ static PyObject *convert(PyObject *self, PyObject *args) {
 	return Py_None;
 }
 
+// Parallel conversion.  Same math and output as convert() above, but the
+// frame is split into horizontal bands that are converted concurrently by
+// worker threads, with the GIL released so the UI thread can keep running.
+// Math is done at int width with branchless clamping, which gcc can
+// vectorize (short/char intermediates defeat this).
+// Several output formats are available, so the result can match the
+// display's native pixel format and needn't be converted again on blit:
+//   RGB24  - 3 bytes/pixel R,G,B; same padded layout as convert()
+//   RGB565 - 2 bytes/pixel, little-endian (PiTFT framebuffer format)
+//   BGRA32 - 4 bytes/pixel B,G,R,A (32-bit 0xAARRGGBB little-endian)
+//   GRAY   - 1 byte/pixel, luma (Y plane) only
+// Other than RGB24 (kept byte-compatible with convert()), output rows are
+// w pixels wide and only h rows are written, so the destination can be a
+// w x h Surface pixel buffer without alignment padding.
+
+#define RGB24  0
+#define RGB565 1
+#define BGRA32 2
+#define GRAY   3
+
+static const int bytesPerPixel[] = { 3, 2, 4, 1 };
+
+typedef struct {
+	unsigned char *yuv;        // Source Y plane (U, V follow)
+	unsigned char *out;        // Destination buffer
+	int            sw, sh;     // Source Y plane stride & rows (padded)
+	int            ow, oh;     // Output pixels per row, rows
+	int            fmt;        // Output format (RGB24, RGB565, etc.)
+	int           *xMap;       // Source column per output column (or NULL)
+	int           *yMap;       // Source row per output row (or NULL)
+	int            row0, row1; // Band of rows to convert [row0, row1)
+} Band;
+
+static inline int clamp(int c) {
+	return (c > 255) ? 255 : (c < 0) ? 0 : c;
+}
+
+// Per-pixel conversion, yields r, g, b for source column sx of current row
+#define YUV2RGB(sx)                                      \
+	u = uRow[(sx) >> 1] - 128;                           \
+	v = vRow[(sx) >> 1] - 128;                           \
+	y = yRow[sx];                                        \
+	r = clamp(y +  ((359 * v)              >> 8));       \
+	g = clamp(y - (((183 * v) + (88 * u))  >> 8));       \
+	b = clamp(y +  ((454 * u)              >> 8));
+
+// Convert one output row in band->fmt, source column for output column x
+// given by expression SX.  Expanded twice, for the straight (SX = x) and
+// mapped (SX = xMap[x]) cases, so the former stays vectorizable.
+#define CONVERT_ROW(SX)                                  \
+	switch(band->fmt) {                                  \
+	   case RGB24:                                       \
+		for(x=0; x<ow; x++) {                            \
+			YUV2RGB(SX);                                 \
+			out[x * 3    ] = r;                          \
+			out[x * 3 + 1] = g;                          \
+			out[x * 3 + 2] = b;                          \
+		}                                                \
+		break;                                           \
+	   case RGB565:                                      \
+		for(x=0; x<ow; x++) {                            \
+			YUV2RGB(SX);                                 \
+			r = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3); \
+			out[x * 2    ] = r;                          \
+			out[x * 2 + 1] = r >> 8;                     \
+		}                                                \
+		break;                                           \
+	   case BGRA32:                                      \
+		for(x=0; x<ow; x++) {                            \
+			YUV2RGB(SX);                                 \
+			out[x * 4    ] = b;                          \
+			out[x * 4 + 1] = g;                          \
+			out[x * 4 + 2] = r;                          \
+			out[x * 4 + 3] = 255;                        \
+		}                                                \
+		break;                                           \
+	   case GRAY:                                        \
+		for(x=0; x<ow; x++) out[x] = yRow[SX];           \
+		break;                                           \
+	}
+
+static void *convertBand(void *arg) {
+	Band          *band = (Band *)arg;
+	int            ow   = band->ow, row, srow, x, u, v, y, r, g, b;
+	int           *xMap = band->xMap;
+	unsigned char *yRow, *uRow, *vRow, *out;
+
+	for(row=band->row0; row<band->row1; row++) {
+		srow = band->yMap ? band->yMap[row] : row;
+		yRow = &band->yuv[srow * band->sw];
+		uRow = &band->yuv[band->sw * band->sh + (srow >> 1) * (band->sw >> 1)];
+		vRow = &uRow[(band->sw * band->sh) >> 2];
+		out  = &band->out[row * ow * bytesPerPixel[band->fmt]];
+		if(xMap) {
+			CONVERT_ROW(xMap[x]);
+		} else {
+			CONVERT_ROW(x);
+		}
+	}
+
+	return NULL;
+}
+
+// Split rows [0, oh) into n bands of whole row pairs (chroma rows are
+// shared by pairs) and run them, the last one on the calling thread.
+static void runBands(Band *proto, int n) {
+	Band      bands[MAX_THREADS];
+	pthread_t threads[MAX_THREADS];
+	int       i, started[MAX_THREADS], pairs = (proto->oh + 1) >> 1;
+
+	if(n > pairs)       n = pairs;
+	if(n < 1)           n = 1;
+	if(n > MAX_THREADS) n = MAX_THREADS;
+
+	for(i=0; i<n; i++) {
+		bands[i]      = *proto;
+		bands[i].row0 = (pairs *  i      / n) << 1;
+		bands[i].row1 = (pairs * (i + 1) / n) << 1;
+		if(bands[i].row1 > proto->oh) bands[i].row1 = proto->oh;
+		started[i]    = 0;
+	}
+	for(i=0; i<n-1; i++) {
+		started[i] = !pthread_create(&threads[i], NULL,
+		  convertBand, &bands[i]);
+		// Thread creation failed?  Do the band here instead.
+		if(!started[i]) convertBand(&bands[i]);
+	}
+	convertBand(&bands[n - 1]);
+	for(i=0; i<n-1; i++) {
+		if(started[i]) pthread_join(threads[i], NULL);
+	}
+}
+
+// Default worker count when caller passes 0: one per online CPU core.
+static int defaultThreads(int threads) {
+	if(threads < 1) threads = sysconf(_SC_NPROCESSORS_ONLN);
+	return (threads < 1) ? 1 : threads;
+}
+
+static PyObject *convert_parallel(PyObject *self, PyObject *args) {
+	Py_buffer inBuf, outBuf;
+	short     w, h;
+	int       threads = 0, fmt = RGB24;
+	Band      band;
+
+	if(!PyArg_ParseTuple(args, "s*w*hh|ii", &inBuf, &outBuf, &w, &h,
+	  &threads, &fmt))
+		return NULL;
+
+	if((fmt < RGB24) || (fmt > GRAY) || (w < 1) || (h < 1)) {
+		PyBuffer_Release(&inBuf);
+		PyBuffer_Release(&outBuf);
+		PyErr_SetString(PyExc_ValueError, "bad size or format");
+		return NULL;
+	}
+
+	band.sw  = (w + 31) & ~31; // Width rounded up to multiple of 32
+	band.sh  = (h + 15) & ~15; // Height rounded up to multiple of 16
+	band.ow  = (fmt == RGB24) ? band.sw : w;
+	band.oh  = (fmt == RGB24) ? band.sh : h;
+	band.fmt  = fmt;
+	band.xMap = band.yMap = NULL;
+	band.yuv  = inBuf.buf;
+	band.out = outBuf.buf;
+
+	if((inBuf.len  < band.sw * band.sh * 3 / 2) ||
+	   (outBuf.len < band.ow * band.oh * bytesPerPixel[fmt])) {
+		PyBuffer_Release(&inBuf);
+		PyBuffer_Release(&outBuf);
+		PyErr_SetString(PyExc_ValueError, "buffer too small");
+		return NULL;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	runBands(&band, defaultThreads(threads));
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&inBuf);
+	PyBuffer_Release(&outBuf);
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+// Fused crop + scale + conversion.  Crop rectangle (x, y, w, h) of a
+// srcW x srcH source frame is nearest-neighbor resampled to dstW x dstH
+// output pixels in a single pass, reading only the source pixels that
+// are actually used.  Output is tightly packed (no alignment padding) in
+// any of the formats above.  Source layout is planar YUV420 with a Y row
+// stride of 'stride' bytes (0 = width rounded up to a multiple of 32, as
+// the camera delivers it) and height rounded up to a multiple of 16.
+// Usage: convert_scaled(yuv, out, (srcW, srcH), (x, y, w, h),
+//                       (dstW, dstH)[, stride[, threads[, format]]])
+
+static PyObject *convert_scaled(PyObject *self, PyObject *args) {
+	Py_buffer inBuf, outBuf;
+	int       srcW, srcH, cx, cy, cw, ch, dstW, dstH, stride = 0,
+	          threads = 0, fmt = RGB24, i;
+	Band      band;
+	PyObject *result = NULL;
+
+	if(!PyArg_ParseTuple(args, "s*w*(ii)(iiii)(ii)|iii", &inBuf, &outBuf,
+	  &srcW, &srcH, &cx, &cy, &cw, &ch, &dstW, &dstH, &stride, &threads,
+	  &fmt))
+		return NULL;
+
+	band.xMap = band.yMap = NULL;
+
+	if((fmt < RGB24) || (fmt > GRAY) || (srcW < 1) || (srcH < 1) ||
+	   (dstW < 1) || (dstH < 1) || (cw < 1) || (ch < 1) ||
+	   (cx < 0) || (cy < 0) || (cx + cw > srcW) || (cy + ch > srcH) ||
+	   ((stride > 0) && ((stride < srcW) || (stride & 1)))) {
+		PyErr_SetString(PyExc_ValueError, "bad size, crop or format");
+		goto done;
+	}
+
+	band.sw  = (stride > 0) ? stride : (srcW + 31) & ~31;
+	band.sh  = (srcH + 15) & ~15;
+	band.ow  = dstW;
+	band.oh  = dstH;
+	band.fmt = fmt;
+	band.yuv = inBuf.buf;
+	band.out = outBuf.buf;
+
+	if((inBuf.len  < band.sw * band.sh * 3 / 2) ||
+	   (outBuf.len < dstW * dstH * bytesPerPixel[fmt])) {
+		PyErr_SetString(PyExc_ValueError, "buffer too small");
+		goto done;
+	}
+
+	// Sample at the center of each output pixel's source footprint
+	band.xMap = PyMem_Malloc(dstW * sizeof(int));
+	band.yMap = PyMem_Malloc(dstH * sizeof(int));
+	if(!band.xMap || !band.yMap) {
+		PyErr_NoMemory();
+		goto done;
+	}
+	for(i=0; i<dstW; i++)
+		band.xMap[i] = cx + (int)(((2LL * i + 1) * cw) / (2LL * dstW));
+	for(i=0; i<dstH; i++)
+		band.yMap[i] = cy + (int)(((2LL * i + 1) * ch) / (2LL * dstH));
+
+	Py_BEGIN_ALLOW_THREADS
+	runBands(&band, defaultThreads(threads));
+	Py_END_ALLOW_THREADS
+
+	Py_INCREF(Py_None);
+	result = Py_None;
+
+  done:
+	PyMem_Free(band.xMap);
+	PyMem_Free(band.yMap);
+	PyBuffer_Release(&inBuf);
+	PyBuffer_Release(&outBuf);
+	return result;
+}
+
+// Motion detection on the Y (luma) plane, no RGB conversion: the srcW x
+// srcH frame is reduced to cells of factor x factor pixels (block
+// average), each compared against a running background model 'bg'
+// (one unsigned short per cell, 8.8 fixed point, so bg must be at least
+// 2 * (srcW / factor) * (srcH / factor) bytes).  Returns the number of
+// cells within region (x, y, w, h, in cells; default = all) whose
+// average luma differs from background by more than threshold.  The
+// background then moves toward the frame by 1/2^shift of the difference
+// (shift 0 = replace, e.g. for the first frame).  Stride is as for
+// convert_scaled().
+// Usage: luma_motion(yuv, bg, (srcW, srcH), factor, threshold
+//                    [, shift[, (x, y, w, h)[, stride]]])
+
+static PyObject *luma_motion(PyObject *self, PyObject *args) {
+	Py_buffer       inBuf, bgBuf;
+	int             srcW, srcH, factor, threshold, shift = 4, stride = 0,
+	                rx = 0, ry = 0, rw = -1, rh = -1,
+	                cw, ch, cx, cy, x, y, sum, d, count = 0;
+	unsigned char  *row;
+	unsigned short *bg;
+	PyObject       *result = NULL;
+
+	if(!PyArg_ParseTuple(args, "s*w*(ii)ii|i(iiii)i", &inBuf, &bgBuf,
+	  &srcW, &srcH, &factor, &threshold, &shift, &rx, &ry, &rw, &rh,
+	  &stride))
+		return NULL;
+
+	if((factor < 1) || (factor > 64)) cw = ch = 0;
+	else {
+		cw = srcW / factor;
+		ch = srcH / factor;
+	}
+	if(rw < 0) rw = cw - rx;
+	if(rh < 0) rh = ch - ry;
+
+	if((cw < 1) || (ch < 1) || (shift < 0) || (shift > 8) ||
+	   (rx < 0) || (ry < 0) || (rx + rw > cw) || (ry + rh > ch) ||
+	   ((stride > 0) && (stride < srcW))) {
+		PyErr_SetString(PyExc_ValueError, "bad size, factor or region");
+		goto done;
+	}
+	if(stride <= 0) stride = (srcW + 31) & ~31;
+
+	if((inBuf.len < stride * srcH) ||
+	   (bgBuf.len < cw * ch * (Py_ssize_t)sizeof(unsigned short))) {
+		PyErr_SetString(PyExc_ValueError, "buffer too small");
+		goto done;
+	}
+
+	bg         = bgBuf.buf;
+	threshold *= factor * factor; // Compare sums, not averages
+	Py_BEGIN_ALLOW_THREADS
+	for(cy=0; cy<ch; cy++) {
+		for(cx=0; cx<cw; cx++, bg++) {
+			row = (unsigned char *)inBuf.buf +
+			  cy * factor * stride + cx * factor;
+			for(sum=y=0; y<factor; y++, row += stride)
+				for(x=0; x<factor; x++) sum += row[x];
+			// Background (8.8) scaled to a sum over the cell
+			d = sum - ((*bg * factor * factor + 128) >> 8);
+			if(((d > threshold) || (d < -threshold)) &&
+			   (cx >= rx) && (cx < rx + rw) && (cy >= ry) && (cy < ry + rh))
+				count++;
+			sum = (sum << 8) / (factor * factor); // Cell average, 8.8
+			*bg += (sum - *bg) / (1 << shift);
+		}
+	}
+	Py_END_ALLOW_THREADS
+
+	result = PyInt_FromLong(count);
+
+  done:
+	PyBuffer_Release(&inBuf);
+	PyBuffer_Release(&bgBuf);
+	return result;
+}
+
 static PyMethodDef yuv2rgb_methods[] = {
-	{"convert", convert, METH_VARARGS},
+	{"convert"         , convert         , METH_VARARGS},
+	{"convert_parallel", convert_parallel, METH_VARARGS},
+	{"convert_scaled"  , convert_scaled  , METH_VARARGS},
+	{"luma_motion"     , luma_motion     , METH_VARARGS},
 	{NULL,NULL}
 };
 
 PyMODINIT_FUNC inityuv2rgb(void) {
-	(void)Py_InitModule("yuv2rgb", yuv2rgb_methods);
+	PyObject *m = Py_InitModule("yuv2rgb", yuv2rgb_methods);
+	if(m == NULL) return;
+	PyModule_AddIntConstant(m, "RGB24" , RGB24);
+	PyModule_AddIntConstant(m, "RGB565", RGB565);
+	PyModule_AddIntConstant(m, "BGRA32", BGRA32);
+	PyModule_AddIntConstant(m, "GRAY"  , GRAY);
 }
 